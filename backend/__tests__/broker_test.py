@@ -0,0 +1,149 @@
+import sqlite3
+import time
+import pytest
+from backend.broker import InProcessBroker, SQLiteBroker, create_broker
+from backend.settings import Settings
+
+
+"""
+    Waiting until the condition holds or the timeout runs out
+"""
+def wait_for(condition, timeout=2.0):
+    deadline = time.monotonic() + timeout
+    while not condition():
+        if time.monotonic() > deadline:
+            return False
+        time.sleep(0.005)
+    return True
+
+
+"""
+    Test that the in-process broker delivers straight to its callback
+"""
+def test_in_process_broker():
+    received = []
+    broker = InProcessBroker()
+    broker.start(lambda chat_id, event: received.append((chat_id, event)))
+    broker.publish(1, {"type": "message.created"})
+    assert received == [(1, {"type": "message.created"})]
+
+
+"""
+    Test that two SQLite brokers sharing a log see each other's events, and each sees its own
+    events exactly once
+"""
+def test_sqlite_broker_between_workers(tmp_path):
+    path = str(tmp_path / "events.db")
+    first_received, second_received = [], []
+    first = SQLiteBroker(path, poll_interval=0.001)
+    second = SQLiteBroker(path, poll_interval=0.001)
+    first.start(lambda chat_id, event: first_received.append((chat_id, event)))
+    second.start(lambda chat_id, event: second_received.append((chat_id, event)))
+    try:
+        first.publish(1, {"n": 1})
+        second.publish(2, {"n": 2})
+        assert wait_for(lambda: len(first_received) == 2 and len(second_received) == 2)
+        time.sleep(0.05)
+        assert first_received == [(1, {"n": 1}), (2, {"n": 2})]
+        assert second_received == [(2, {"n": 2}), (1, {"n": 1})]
+    finally:
+        first.close()
+        second.close()
+
+
+"""
+    Test that a failed read or prune on the poll thread is logged and that events keep coming
+    in afterwards
+"""
+def test_sqlite_broker_survives_poll_errors(tmp_path, caplog):
+    path = str(tmp_path / "events.db")
+    publisher, subscriber = SQLiteBroker(path, poll_interval=0.001), SQLiteBroker(path, poll_interval=0.001, retention=0.01)
+    received = []
+    failures = {"read": 2, "prune": 2}
+
+    def failing(name, method):
+        def call():
+            if failures[name]:
+                failures[name] -= 1
+                raise sqlite3.OperationalError("database is locked")
+            return method()
+        return call
+
+    subscriber._read_new_events = failing("read", subscriber._read_new_events)
+    subscriber._prune = failing("prune", subscriber._prune)
+    publisher.start(lambda chat_id, event: None)
+    subscriber.start(lambda chat_id, event: received.append(event))
+    try:
+        publisher.publish(1, {"n": 1})
+        assert wait_for(lambda: received == [{"n": 1}])
+        assert wait_for(lambda: failures == {"read": 0, "prune": 0})
+        publisher.publish(1, {"n": 2})
+        assert wait_for(lambda: received == [{"n": 1}, {"n": 2}])
+        assert subscriber._thread.is_alive()
+    finally:
+        publisher.close()
+        subscriber.close()
+    assert "Event broker poll failed" in caplog.text
+
+
+def log_size(path):
+    with sqlite3.connect(path) as conn:
+        return conn.execute("SELECT count(*) FROM events").fetchone()[0]
+
+
+"""
+    Test that publishing doesn't wait while another process holds the log's lock, and that the
+    event still reaches the other workers once the lock is released
+"""
+def test_sqlite_broker_publish_does_not_block(tmp_path):
+    path = str(tmp_path / "events.db")
+    publisher, subscriber = SQLiteBroker(path, poll_interval=0.001), SQLiteBroker(path, poll_interval=0.001)
+    local, remote = [], []
+    publisher.start(lambda chat_id, event: local.append(event))
+    subscriber.start(lambda chat_id, event: remote.append(event))
+    locker = sqlite3.connect(path, isolation_level=None)
+    try:
+        locker.execute("BEGIN EXCLUSIVE")
+        start = time.monotonic()
+        publisher.publish(1, {"n": 1})
+        assert time.monotonic() - start < 0.1
+        assert local == [{"n": 1}]
+        locker.execute("COMMIT")
+        assert wait_for(lambda: remote)
+        assert remote == [{"n": 1}]
+    finally:
+        locker.close()
+        publisher.close()
+        subscriber.close()
+
+
+"""
+    Test that a broker joining late does not receive events published before it started
+"""
+def test_sqlite_broker_starts_at_end_of_log(tmp_path):
+    path = str(tmp_path / "events.db")
+    first = SQLiteBroker(path, poll_interval=0.001)
+    first.start(lambda chat_id, event: None)
+    first.publish(1, {"n": 1})
+    assert wait_for(lambda: log_size(path) == 1)
+
+    received = []
+    second = SQLiteBroker(path, poll_interval=0.001)
+    second.start(lambda chat_id, event: received.append(event))
+    try:
+        first.publish(1, {"n": 2})
+        assert wait_for(lambda: received)
+        assert received == [{"n": 2}]
+    finally:
+        first.close()
+        second.close()
+
+
+"""
+    Test that the broker is chosen from the settings
+"""
+def test_create_broker(tmp_path):
+    assert isinstance(create_broker(Settings(event_broker="memory")), InProcessBroker)
+    assert isinstance(create_broker(Settings(event_broker="sqlite", event_broker_path=str(tmp_path / "e.db"))), SQLiteBroker)
+    with pytest.raises(ValueError):
+        create_broker(Settings(event_broker="kafka"))
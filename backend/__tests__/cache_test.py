@@ -0,0 +1,155 @@
+import pytest
+from datetime import datetime, timezone
+from jose import jwt
+from backend import auth, cache
+from backend import queries as db
+from backend.cache import TTLCache
+from backend.database.schema import DBAccount
+from backend.exceptions import ExpiredAccessTokenError, InvalidAccessTokenError
+
+
+"""
+    Creating a token for an account that expires after the given number of seconds
+"""
+def create_token(account_id: int, expires_in: int = 3600):
+    iat = int(datetime.now(timezone.utc).timestamp())
+    payload = {"sub": str(account_id), "iss": auth.JWT_ISSUER, "iat": iat, "exp": iat + expires_in}
+    return jwt.encode(payload, auth.JWT_SECRET_KEY, algorithm=auth.JWT_ALGORITHM)
+
+
+"""
+    Counting the account lookups that reach the database
+"""
+@pytest.fixture
+def account_lookups(monkeypatch):
+    calls = []
+    get_account = db.get_account
+
+    def counting_get_account(session, account_id):
+        calls.append(account_id)
+        return get_account(session, account_id)
+
+    monkeypatch.setattr(db, "get_account", counting_get_account)
+    return calls
+
+
+"""
+    A clock for the caches that only moves when the test moves it
+"""
+class FakeClock:
+    def __init__(self):
+        self.now = 0.0
+
+    def __call__(self) -> float:
+        return self.now
+
+    def advance(self, seconds: float):
+        self.now += seconds
+
+
+@pytest.fixture
+def account(session):
+    session.add(DBAccount(id=1, username="a", email="a", hashed_password="a"))
+    session.commit()
+
+
+"""
+    Test that the least recently used entry is evicted once the cache is full
+"""
+def test_ttl_cache_evicts_least_recently_used():
+    lru = TTLCache(maxsize=2, ttl=60)
+    lru.set("a", 1)
+    lru.set("b", 2)
+    assert lru.get("a") == 1
+    lru.set("c", 3)
+    assert lru.get("b") is None
+    assert lru.get("a") == 1
+    assert lru.get("c") == 3
+    assert lru.stats() == {"size": 2, "maxsize": 2, "hits": 3, "misses": 1}
+
+
+"""
+    Test that entries expire after the cache's ttl, or their own when it is shorter
+"""
+def test_ttl_cache_expires_entries():
+    clock = FakeClock()
+    ttl = TTLCache(maxsize=10, ttl=0.05, clock=clock)
+    ttl.set("a", 1)
+    ttl.set("b", 2, ttl=60)
+    ttl.set("c", 3, ttl=0)
+    assert ttl.get("a") == 1
+    assert ttl.get("c") is None
+    clock.advance(0.06)
+    assert ttl.get("a") is None
+    assert ttl.get("b") is None
+
+
+"""
+    Test that a token is verified and its account loaded once, then served from the caches
+"""
+def test_extract_account_is_cached(session, account, account_lookups):
+    token = create_token(1)
+    first = auth.extract_account(session, token)
+    second = auth.extract_account(session, token)
+
+    assert first.id == second.id == 1
+    assert first.username == "a"
+    assert account_lookups == [1]
+    assert cache.token_cache.stats()["hits"] == 1
+    assert cache.account_cache.stats()["hits"] == 1
+
+
+"""
+    Test that a token is not kept in the cache once it has expired
+"""
+def test_expired_token_is_not_served_from_cache(session, account, monkeypatch):
+    clock = FakeClock()
+    monkeypatch.setattr(cache.token_cache, "clock", clock)
+    token = create_token(1, expires_in=1)
+    assert auth.extract_account(session, token).id == 1
+    assert cache.token_cache.get(token) is not None
+
+    clock.advance(1)
+    assert cache.token_cache.get(token) is None
+    # Verified again once it is out of the cache, which fails once the token has expired
+    with pytest.raises(ExpiredAccessTokenError):
+        auth.extract_account(session, create_token(1, expires_in=-1))
+
+
+"""
+    Test that updating an account invalidates its cache entry
+"""
+def test_update_account_invalidates_cache(session, account, account_lookups):
+    token = create_token(1)
+    auth.extract_account(session, token)
+    db.update_account(session, 1, username="renamed")
+
+    assert auth.extract_account(session, token).username == "renamed"
+    assert account_lookups == [1, 1]
+
+
+"""
+    Test that a deleted account can't keep authenticating from the cache
+"""
+def test_delete_account_invalidates_cache(session, account):
+    token = create_token(1)
+    auth.extract_account(session, token)
+    db.delete_account(session, 1)
+
+    with pytest.raises(InvalidAccessTokenError):
+        auth.extract_account(session, token)
+
+
+"""
+    Test that the cache counts are reported with the server's metrics
+"""
+def test_cache_metrics(session, account, client):
+    headers = {"Authorization": f"Bearer {create_token(1)}"}
+    client.get("/accounts/me", headers=headers)
+    client.get("/accounts/me", headers=headers)
+
+    response = client.get("/metrics")
+    assert response.status_code == 200
+    assert 'cache_hits_total{cache="tokens"} 1\n' in response.text
+    assert 'cache_misses_total{cache="accounts"} 1\n' in response.text
+    assert client.get("/status/cache").status_code == 404
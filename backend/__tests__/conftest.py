@@ -1,28 +1,91 @@
 import pytest
-from sqlmodel import Session, SQLModel, StaticPool, create_engine
+from contextlib import contextmanager
+from sqlalchemy import Engine, event
+from sqlalchemy.ext.asyncio import create_async_engine
+from sqlalchemy.pool import NullPool
+from sqlmodel import Session, SQLModel, create_engine
+from sqlmodel.ext.asyncio.session import AsyncSession
 from starlette.testclient import TestClient
+from backend.database.engine import apply_pragmas, sqlite_pragmas
 from backend.database.schema import *
 from backend.dependencies import get_session
-from backend import app
+from backend import app, cache, hashing
+from backend.settings import settings
 
+"""
+    Hashing passwords at the lowest bcrypt cost, so the tests don't pay the production cost
+"""
+@pytest.fixture(autouse=True)
+def fast_password_hashing(monkeypatch):
+    monkeypatch.setattr(hashing.hasher, "rounds", 4)
+
+"""
+    Starting every test with empty authentication caches
+"""
+@pytest.fixture(autouse=True)
+def clear_caches():
+    cache.token_cache.clear()
+    cache.account_cache.clear()
+    yield
+    cache.token_cache.clear()
+    cache.account_cache.clear()
+
+"""
+    A database file of its own for every test, shared by the test's session and the app's
+    async sessions
+"""
 @pytest.fixture
-def session():
+def database_path(tmp_path):
+    return tmp_path / "test.db"
+
+@pytest.fixture
+def session(database_path):
     engine = create_engine(
-        "sqlite://",
+        f"sqlite:///{database_path}",
         connect_args={"check_same_thread": False},
-        poolclass=StaticPool,
     )
+    apply_pragmas(engine, sqlite_pragmas(settings))
     SQLModel.metadata.create_all(engine)
     with Session(engine) as s:
         yield s
+    engine.dispose()
 
 @pytest.fixture
-def client(session):
-    def _get_session_override():
-        return session
+def client(session, database_path):
+    # Every TestClient request runs on an event loop of its own, so don't pool connections
+    async_engine = create_async_engine(f"sqlite+aiosqlite:///{database_path}", poolclass=NullPool)
+    apply_pragmas(async_engine.sync_engine, sqlite_pragmas(settings))
+
+    async def _get_session_override():
+        async with AsyncSession(async_engine, expire_on_commit=False) as s:
+            yield s
     
     app.dependency_overrides[get_session] = _get_session_override
     yield TestClient(app)
     app.dependency_overrides.clear()
 
+"""
+    Asserting that a block runs at most a given number of SQL statements, on any engine:
+
+        with max_queries(3):
+            client.get("/chats/1/messages")
+
+    The statements are yielded, to look at them when the assertion fails.
+"""
+@pytest.fixture
+def max_queries():
+    @contextmanager
+    def _max_queries(limit: int):
+        statements = []
+
+        def _record(conn, cursor, statement, parameters, context, executemany):
+            statements.append(statement)
+
+        event.listen(Engine, "before_cursor_execute", _record)
+        try:
+            yield statements
+        finally:
+            event.remove(Engine, "before_cursor_execute", _record)
+        assert len(statements) <= limit, f"{len(statements)} queries, expected at most {limit}:\n" + "\n".join(statements)
 
+    return _max_queries
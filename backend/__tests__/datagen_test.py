@@ -0,0 +1,57 @@
+from collections import Counter
+from datetime import datetime
+from sqlalchemy import text
+from sqlmodel import select
+from backend.database.schema import *
+from backend import datagen
+from backend import queries as db
+
+
+"""
+    Test that the generated rows add up, that the skews make a few chats and authors much busier
+    than the rest, and that timestamps stay within the range
+"""
+def test_generate(session):
+    session.add(DBAccount(id=1, username="existing", email="existing", hashed_password="x"))
+    session.commit()
+    engine = session.get_bind()
+
+    counts = datagen.generate(
+        engine, accounts=200, chats=20, messages=5_000, members=10,
+        chat_size_skew=1.5, author_skew=1.5, rounds=4, batch_size=1_000, progress=lambda done: None,
+    )
+    assert counts["accounts"] == 200 and counts["chats"] == 20 and counts["messages"] == 5_000
+    assert len(session.exec(select(DBAccount)).all()) == 201
+    assert len(session.exec(select(DBChatMembership)).all()) == counts["memberships"]
+
+    messages = session.exec(select(DBMessage)).all()
+    assert len(messages) == 5_000
+    assert min(message.account_id for message in messages) > 1
+    per_chat = Counter(message.chat_id for message in messages).most_common()
+    assert per_chat[0][1] > 10 * per_chat[-1][1]
+    per_author = Counter(message.account_id for message in messages).most_common()
+    assert per_author[0][1] > 50 * per_author[len(per_author) // 2][1]
+    assert all(datetime(2024, 1, 1) <= message.created_at < datetime(2025, 1, 1) for message in messages)
+
+    # Every message was written by a member of its chat, and every chat's owner is a member
+    memberships = {(m.chat_id, m.account_id) for m in session.exec(select(DBChatMembership))}
+    assert all((message.chat_id, message.account_id) in memberships for message in messages)
+    assert all((chat.id, chat.owner_id) in memberships for chat in session.exec(select(DBChat)))
+
+
+"""
+    Test that generated messages are searchable, and that messages written afterwards are
+    indexed again as they are created
+"""
+def test_generate_search_index(session):
+    engine = session.get_bind()
+    datagen.generate(engine, accounts=10, chats=2, messages=500, members=5, rounds=4, progress=lambda done: None)
+
+    assert session.exec(text("SELECT count(*) FROM messages_fts")).one()[0] == 500
+    message = session.get(DBMessage, 1)
+    hits, _ = db.search_messages(session, message.chat_id, message.text, limit=db.SEARCH_PAGE_SIZE_MAX)
+    assert message.id in [hit.id for hit, _, _ in hits]
+
+    created = db.create_message(session, message.chat_id, "zyzzyva", message.account_id)
+    hits, _ = db.search_messages(session, message.chat_id, "zyzzyva")
+    assert [hit.id for hit, _, _ in hits] == [created.id]
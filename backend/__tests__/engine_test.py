@@ -0,0 +1,64 @@
+import asyncio
+from sqlalchemy import text
+from backend.database.engine import async_database_url, create_async_db_engine, create_db_engine, sqlite_pragmas
+from backend.settings import Settings
+
+
+# Reads the pragmas a connection ended up with
+PRAGMAS_QUERY = "SELECT * FROM pragma_journal_mode, pragma_synchronous, pragma_foreign_keys, pragma_busy_timeout, pragma_temp_store"
+
+
+"""
+    Test that the settings turn into pragmas, leaving out the ones set to None
+"""
+def test_sqlite_pragmas():
+    pragmas = sqlite_pragmas(Settings(sqlite_mmap_size=None, sqlite_foreign_keys=True))
+    assert "mmap_size" not in pragmas
+    assert pragmas["journal_mode"] == "wal"
+    assert pragmas["foreign_keys"] == "ON"
+    assert list(pragmas)[0] == "journal_mode"
+
+
+"""
+    Test the async URL for the same database
+"""
+def test_async_database_url():
+    assert async_database_url("sqlite:///backend/database/development.db") == "sqlite+aiosqlite:///backend/database/development.db"
+    assert async_database_url("sqlite://") == "sqlite+aiosqlite://"
+
+
+"""
+    Test that every connection of the sync engine gets the pragmas
+"""
+def test_sync_engine_pragmas(tmp_path):
+    engine = create_db_engine(Settings(database_url=f"sqlite:///{tmp_path / 'test.db'}"))
+    with engine.connect() as conn:
+        assert tuple(conn.execute(text(PRAGMAS_QUERY)).one()) == ("wal", 1, 1, 5000, 2)
+    engine.dispose()
+
+
+"""
+    Test that every connection of the async engine gets the pragmas
+"""
+def test_async_engine_pragmas(tmp_path):
+    engine = create_async_db_engine(Settings(database_url=f"sqlite:///{tmp_path / 'test.db'}", sqlite_busy_timeout=100))
+
+    async def read_pragmas():
+        async with engine.connect() as conn:
+            result = tuple((await conn.execute(text(PRAGMAS_QUERY))).one())
+        await engine.dispose()
+        return result
+
+    assert asyncio.run(read_pragmas()) == ("wal", 1, 1, 100, 2)
+
+
+"""
+    Test that with every pragma unset the connections keep SQLite's defaults
+"""
+def test_default_profile_keeps_sqlite_defaults(tmp_path):
+    unset = {field: None for field in ("sqlite_journal_mode", "sqlite_synchronous", "sqlite_mmap_size", "sqlite_cache_size", "sqlite_busy_timeout", "sqlite_temp_store", "sqlite_foreign_keys")}
+    engine = create_db_engine(Settings(database_url=f"sqlite:///{tmp_path / 'test.db'}", **unset))
+    with engine.connect() as conn:
+        journal_mode, synchronous, foreign_keys, _, _ = conn.execute(text(PRAGMAS_QUERY)).one()
+    assert (journal_mode, synchronous, foreign_keys) == ("delete", 2, 0)
+    engine.dispose()
@@ -0,0 +1,96 @@
+import asyncio
+import pytest
+from datetime import datetime
+from types import SimpleNamespace
+from backend.events import EventHub, SubscriberOverflow, hub, message_event, sse_stream
+
+
+"""
+    Test that every subscriber of a chat receives its events and other chats' subscribers don't
+"""
+def test_publish_fans_out_per_chat():
+    async def scenario():
+        hub = EventHub()
+        first = hub.subscribe(1)
+        second = hub.subscribe(1)
+        other = hub.subscribe(2)
+
+        hub.publish(1, {"n": 1})
+        assert await first.get() == {"n": 1}
+        assert await second.get() == {"n": 1}
+        assert other.queue.empty()
+
+        hub.unsubscribe(first)
+        hub.unsubscribe(second)
+        assert hub.subscriber_count(1) == 0
+
+    asyncio.run(scenario())
+
+
+"""
+    Test that publishing from another thread reaches the subscriber's loop
+"""
+def test_publish_from_thread():
+    async def scenario():
+        hub = EventHub()
+        subscription = hub.subscribe(1)
+        await asyncio.to_thread(hub.publish, 1, {"n": 1})
+        assert await asyncio.wait_for(subscription.get(), 1) == {"n": 1}
+
+    asyncio.run(scenario())
+
+
+"""
+    Test that a slow subscriber is cut off without affecting a subscriber that keeps up
+"""
+def test_slow_subscriber_overflows():
+    async def scenario():
+        hub = EventHub(queue_size=2)
+        slow = hub.subscribe(1)
+        fast = hub.subscribe(1)
+
+        for n in range(3):
+            hub.publish(1, {"n": n})
+            await asyncio.sleep(0)
+            assert await fast.get() == {"n": n}
+
+        with pytest.raises(SubscriberOverflow):
+            await slow.get()
+
+    asyncio.run(scenario())
+
+
+"""
+    Collecting the next n chunks of an async generator
+"""
+async def take(stream, n):
+    return [await anext(stream) for _ in range(n)]
+
+
+"""
+    Test that the event stream replays messages after Last-Event-ID, then delivers live events
+    without repeating the ones it already replayed
+"""
+def test_sse_stream_resumes_after_last_event_id():
+    messages = [SimpleNamespace(id=i, text=f"m{i}", account_id=1, chat_id=1, created_at=datetime(2020, 5, 17)) for i in range(1, 6)]
+
+    async def fetch_page(cursor):
+        page = [m for m in messages if m.id > cursor][:2]
+        more = page and page[-1].id < messages[-1].id
+        return page, page[-1].id if more else None
+
+    async def scenario():
+        stream = sse_stream(1, 2, fetch_page, keepalive=0.05)
+        replayed = await take(stream, 3)
+        assert [chunk.splitlines()[0] for chunk in replayed] == ["id: 3", "id: 4", "id: 5"]
+
+        # An event for a replayed message is skipped, a new one is delivered
+        hub.publish(1, message_event("message.created", messages[4]))
+        hub.publish(1, message_event("message.updated", messages[3]))
+        updated = await anext(stream)
+        assert updated.startswith("event: message.updated\n")
+        assert await anext(stream) == ": keep-alive\n\n"
+        await stream.aclose()
+        assert hub.subscriber_count(1) == 0
+
+    asyncio.run(scenario())
@@ -0,0 +1,84 @@
+import asyncio
+import gzip
+import json
+import pytest
+from sqlalchemy.ext.asyncio import create_async_engine
+from sqlalchemy.pool import AsyncAdaptedQueuePool, NullPool
+from sqlmodel.ext.asyncio.session import AsyncSession
+from backend import async_queries, export
+from backend.__tests__.main_test import auth_headers, setup_db
+
+
+"""
+    Test exporting a chat as gzip NDJSON, one message per line in id order
+"""
+def test_export_chat(setup_db, client):
+    response = client.get("/chats/1/export", headers=auth_headers(1))
+    assert response.status_code == 200
+    assert response.headers["content-type"] == "application/gzip"
+    assert response.headers["content-disposition"] == 'attachment; filename="chat-1.ndjson.gz"'
+
+    lines = gzip.decompress(response.content).decode("utf-8").splitlines()
+    messages = [json.loads(line) for line in lines]
+    assert [message["id"] for message in messages] == [1, 2]
+    assert set(messages[0]) == {"id", "chat_id", "account_id", "text", "created_at"}
+    assert all(message["chat_id"] == 1 for message in messages)
+
+
+"""
+    Test exporting without compression, and with zstd when this server can't produce it
+"""
+def test_export_chat_compression(setup_db, client):
+    response = client.get("/chats/1/export", params={"compression": "none"}, headers=auth_headers(1))
+    assert response.headers["content-type"] == "application/x-ndjson"
+    assert [json.loads(line)["id"] for line in response.text.splitlines()] == [1, 2]
+
+    response = client.get("/chats/1/export", params={"compression": "zstd"}, headers=auth_headers(1))
+    if export.zstandard is None:
+        assert response.status_code == 422
+        assert response.json()["error"] == "compression_unavailable"
+    else:
+        lines = export.zstandard.ZstdDecompressor().decompressobj().decompress(response.content).splitlines()
+        assert [json.loads(line)["id"] for line in lines] == [1, 2]
+
+
+"""
+    Test that only members can export a chat, and that a missing chat is not found
+"""
+def test_export_chat_access(setup_db, client):
+    response = client.get("/chats/1/export", headers=auth_headers(3))
+    assert response.status_code == 422
+    assert response.json()["error"] == "chat_membership_required"
+
+    response = client.get("/chats/999/export", headers=auth_headers(1))
+    assert response.status_code == 404
+
+
+"""
+    Test that the messages are read in batches of the given size
+"""
+def test_export_messages_batches(setup_db, database_path):
+    async def batches():
+        engine = create_async_engine(f"sqlite+aiosqlite:///{database_path}", poolclass=NullPool)
+        try:
+            async with AsyncSession(engine) as session:
+                return [[row.id for row in rows] async for rows in async_queries.export_messages(session, 1, batch_size=1)]
+        finally:
+            await engine.dispose()
+
+    assert asyncio.run(batches()) == [[1], [2]]
+
+
+"""
+    Test that no connection is held between batches while the export is being sent
+"""
+def test_export_messages_releases_connection(setup_db, database_path):
+    async def connections_between_batches():
+        engine = create_async_engine(f"sqlite+aiosqlite:///{database_path}", poolclass=AsyncAdaptedQueuePool, pool_size=1, max_overflow=0)
+        try:
+            async with AsyncSession(engine) as session:
+                return [engine.pool.checkedout() async for _ in async_queries.export_messages(session, 1, batch_size=1)]
+        finally:
+            await engine.dispose()
+
+    assert asyncio.run(connections_between_batches()) == [0, 0]
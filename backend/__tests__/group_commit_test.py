@@ -0,0 +1,116 @@
+import asyncio
+import pytest
+from sqlalchemy.ext.asyncio import create_async_engine
+from sqlalchemy.pool import NullPool
+from sqlmodel import select
+from backend.database.schema import *
+from backend.exceptions import ChatMembershipError, ModelDNE
+from backend import group_commit
+from backend import queries as db
+from backend.settings import settings
+from backend.__tests__.main_test import auth_headers, setup_db
+
+
+"""
+    Running a coroutine with a writer-ready engine on the test database
+"""
+def run_with_engine(database_path, fn):
+    async def _run():
+        engine = create_async_engine(f"sqlite+aiosqlite:///{database_path}", poolclass=NullPool)
+        try:
+            return await fn(engine)
+        finally:
+            await group_commit.close()
+            await engine.dispose()
+    return asyncio.run(_run())
+
+
+"""
+    Test creating messages of several chats in one transaction, each checked on its own
+"""
+def test_create_message_group(setup_db, session):
+    results = db.create_message_group(session, [(1, "first", 1), (3, "elsewhere", 1), (1, "not a member", 3), (9, "no chat", 1), (1, "second", 2)])
+
+    assert [(m.id, m.chat_id, m.text) for m in results[:2]] == [(4, 1, "first"), (5, 3, "elsewhere")]
+    assert isinstance(results[2], ChatMembershipError)
+    assert isinstance(results[3], ModelDNE)
+    assert (results[4].id, results[4].account_id) == (6, 2)
+
+    changes = session.exec(select(DBChange.chat_id, DBChange.entity_id).where(DBChange.entity == "message")).all()
+    assert sorted(changes) == [(1, 4), (1, 6), (3, 5)]
+    assert db.get_version(session, db.chat_version_key(1)) == 1
+    assert db.get_version(session, db.chat_version_key(3)) == 1
+
+    # Nothing left to insert
+    assert [type(result) for result in db.create_message_group(session, [(9, "no chat", 1)])] == [ModelDNE]
+
+
+"""
+    Test that concurrent posts go out together, each poster getting its own message or error
+"""
+def test_writer_groups_posts(setup_db, database_path, monkeypatch):
+    groups = []
+    create_message_group = db.create_message_group
+
+    def recording(session, messages):
+        groups.append(len(messages))
+        return create_message_group(session, messages)
+
+    monkeypatch.setattr(db, "create_message_group", recording)
+
+    async def post(engine):
+        writer = group_commit.writer(engine)
+        posts = [writer.submit(1, f"message {n}", 1 + n % 2) for n in range(20)]
+        return await asyncio.gather(writer.submit(1, "denied", 3), *posts, return_exceptions=True)
+
+    results = run_with_engine(database_path, post)
+    assert isinstance(results[0], ChatMembershipError)
+    assert [message.text for message in results[1:]] == [f"message {n}" for n in range(20)]
+    assert [message.id for message in results[1:]] == list(range(4, 24))
+    assert groups == [21]
+
+
+"""
+    Test that closing the writer commits the posts still waiting
+"""
+def test_writer_close(setup_db, database_path, session):
+    async def post(engine):
+        writer = group_commit.writer(engine)
+        pending = asyncio.ensure_future(writer.submit(1, "last one", 1))
+        await asyncio.sleep(0)
+        await group_commit.close()
+        return await pending
+
+    assert run_with_engine(database_path, post).text == "last one"
+    assert session.exec(select(DBMessage).where(DBMessage.text == "last one")).first() is not None
+
+
+"""
+    Test that the route goes through the writer with group commit on, with the same errors
+"""
+def test_create_message_group_commit(setup_db, client, monkeypatch):
+    monkeypatch.setattr(settings, "message_group_commit", True)
+    response = client.post("/chats/1/messages", json={"text": "grouped", "account_id": 1}, headers=auth_headers(1))
+    assert response.status_code == 201
+    assert (response.json()["id"], response.json()["text"]) == (4, "grouped")
+
+    response = client.post("/chats/2/messages", json={"text": "grouped", "account_id": 1}, headers=auth_headers(1))
+    assert response.status_code == 422
+    assert response.json()["error"] == "chat_membership_required"
+
+
+"""
+    Test that a writer whose task stopped is replaced, and its waiting posts still committed
+"""
+def test_writer_restarts(setup_db, database_path):
+    async def post(engine):
+        stopped = group_commit.writer(engine)
+        stopped.task.cancel()
+        await asyncio.sleep(0)
+        pending = asyncio.ensure_future(stopped.submit(1, "left waiting", 1))
+        await asyncio.sleep(0)
+        restarted = group_commit.writer(engine)
+        assert restarted is not stopped
+        return await asyncio.gather(pending, restarted.submit(1, "after restart", 2))
+
+    assert [message.text for message in run_with_engine(database_path, post)] == ["left waiting", "after restart"]
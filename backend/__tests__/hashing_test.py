@@ -0,0 +1,210 @@
+import asyncio
+import os
+import threading
+import time
+import bcrypt
+import pytest
+from concurrent.futures.process import BrokenProcessPool
+from backend import hashing
+from backend.database.schema import DBAccount
+from backend.exceptions import ServiceOverloaded
+from backend.hashing import PasswordHasher
+
+
+"""
+    Test that hashes made on the process pool verify with bcrypt and back through the pool
+"""
+def test_hash_and_check_on_process_pool():
+    hasher = PasswordHasher(workers=1, queue_size=0, retry_after=1)
+    try:
+        hashed_password = hasher.hash("password")
+        assert bcrypt.checkpw(b"password", hashed_password.encode("utf-8"))
+        assert hasher.check("password", hashed_password)
+        assert not hasher.check("wrong", hashed_password)
+    finally:
+        hasher.shutdown()
+
+    metrics = hasher.metrics()
+    assert metrics["in_flight"] == 0
+    assert metrics["latency_seconds_count"] == 3
+    assert metrics["latency_seconds_buckets"]["5.0"] == 3
+
+
+"""
+    Test that the async entry points await the process pool and share its bound
+"""
+def test_hash_and_check_async():
+    hasher = PasswordHasher(workers=1, queue_size=0, retry_after=1, rounds=4)
+
+    async def scenario():
+        hashed_password = await hasher.hash_async("password")
+        assert await hasher.check_async("password", hashed_password)
+        # Two hashes at once don't fit a pool of one with no queue
+        results = await asyncio.gather(hasher.hash_async("a"), hasher.hash_async("b"), return_exceptions=True)
+        assert sum(isinstance(result, ServiceOverloaded) for result in results) == 1
+
+    try:
+        asyncio.run(scenario())
+    finally:
+        hasher.shutdown()
+    assert hasher.metrics()["in_flight"] == 0
+    assert hasher.metrics()["rejected_total"] == 1
+
+
+
+"""
+    Test that a hash whose request is cancelled keeps its slot until the pool is done with it
+"""
+def test_cancelled_hash_keeps_its_slot():
+    hasher = PasswordHasher(workers=1, queue_size=0, retry_after=1, rounds=4)
+
+    async def scenario():
+        # Starting the pool's process first, so the slow hash below is running when cancelled
+        await hasher.hash_async("warm up")
+        task = asyncio.create_task(hasher._run_async(time.sleep, 0.5))
+        await asyncio.sleep(0.1)
+        task.cancel()
+        with pytest.raises(asyncio.CancelledError):
+            await task
+        assert hasher.metrics()["in_flight"] == 1
+        with pytest.raises(ServiceOverloaded):
+            await hasher.hash_async("password")
+
+        for _ in range(50):
+            if hasher.metrics()["in_flight"] == 0:
+                break
+            await asyncio.sleep(0.1)
+        assert hasher.metrics()["in_flight"] == 0
+        await hasher.hash_async("password")
+
+    try:
+        asyncio.run(scenario())
+    finally:
+        hasher.shutdown()
+
+
+"""
+    Test that a pool whose process died is shut down and replaced by a fresh one
+"""
+def test_broken_pool_is_replaced(monkeypatch):
+    hasher = PasswordHasher(workers=1, queue_size=0, retry_after=1, rounds=4)
+    try:
+        broken = hasher._get_executor()
+        shutdowns = []
+        monkeypatch.setattr(broken, "shutdown", lambda **kwargs: shutdowns.append(kwargs))
+        with pytest.raises(BrokenProcessPool):
+            broken.submit(os._exit, 1).result()
+        with pytest.raises(ServiceOverloaded):
+            hasher.hash("password")
+        assert shutdowns == [{"wait": False, "cancel_futures": True}]
+        assert hasher.metrics()["in_flight"] == 0
+
+        assert hasher.check("password", hasher.hash("password"))
+        assert hasher._get_executor() is not broken
+    finally:
+        hasher.shutdown()
+
+"""
+    Test that a request past the pool and queue capacity is shed instead of waiting
+"""
+def test_hasher_sheds_load_when_full(monkeypatch):
+    release = threading.Event()
+    started = threading.Event()
+
+    def slow_hashpw(password, rounds):
+        started.set()
+        release.wait(5)
+        return b"hashed"
+
+    monkeypatch.setattr(hashing, "_hashpw", slow_hashpw)
+    hasher = PasswordHasher(workers=0, queue_size=0, retry_after=3)
+    worker = threading.Thread(target=hasher.hash, args=("password",))
+    worker.start()
+    try:
+        assert started.wait(5)
+        assert hasher.metrics()["in_flight"] == 1
+        with pytest.raises(ServiceOverloaded) as exc:
+            hasher.hash("password")
+        assert exc.value.retry_after == 3
+        assert hasher.metrics()["rejected_total"] == 1
+    finally:
+        release.set()
+        worker.join()
+
+    # The slot is given back once the hash finishes
+    assert hasher.hash("password") == "hashed"
+
+
+"""
+    Test that only hashes made with a lower cost than the configured one need a rehash
+"""
+def test_needs_rehash():
+    hasher = PasswordHasher(workers=0, queue_size=0, retry_after=1, rounds=5)
+    assert not hasher.needs_rehash(bcrypt.hashpw(b"password", bcrypt.gensalt(5)).decode("utf-8"))
+    assert hasher.needs_rehash(bcrypt.hashpw(b"password", bcrypt.gensalt(4)).decode("utf-8"))
+    assert not hasher.needs_rehash(bcrypt.hashpw(b"password", bcrypt.gensalt(6)).decode("utf-8"))
+    assert not hasher.needs_rehash("not a bcrypt hash")
+
+
+"""
+    Test that logging in with a hash of an outdated cost rehashes it at the configured cost
+"""
+def test_get_token_rehashes_outdated_cost(client, session, monkeypatch):
+    monkeypatch.setattr(hashing.hasher, "rounds", 5)
+    outdated = bcrypt.hashpw(b"password", bcrypt.gensalt(4)).decode("utf-8")
+    session.add(DBAccount(id=1, username="a", email="a", hashed_password=outdated))
+    session.commit()
+
+    response = client.post("/auth/token", data={"username": "a", "password": "password"})
+    assert response.status_code == 200
+
+    account = session.get(DBAccount, 1)
+    assert account.hashed_password.startswith("$2b$05$")
+    assert bcrypt.checkpw(b"password", account.hashed_password.encode("utf-8"))
+
+    # The new hash is used from then on, and is not redone
+    rehashed = account.hashed_password
+    assert client.post("/auth/token", data={"username": "a", "password": "password"}).status_code == 200
+    assert session.get(DBAccount, 1).hashed_password == rehashed
+
+
+"""
+    Test that a failed login leaves the outdated hash alone
+"""
+def test_failed_login_does_not_rehash(client, session, monkeypatch):
+    monkeypatch.setattr(hashing.hasher, "rounds", 5)
+    outdated = bcrypt.hashpw(b"password", bcrypt.gensalt(4)).decode("utf-8")
+    session.add(DBAccount(id=1, username="a", email="a", hashed_password=outdated))
+    session.commit()
+
+    response = client.post("/auth/token", data={"username": "a", "password": "wrong"})
+    assert response.status_code == 401
+    assert session.get(DBAccount, 1).hashed_password == outdated
+
+
+"""
+    Test that a shed login answers 503 with Retry-After
+"""
+def test_get_token_overloaded(client, session, monkeypatch):
+    session.add(DBAccount(username="a", email="a", hashed_password=bcrypt.hashpw(b"password", bcrypt.gensalt(rounds=4)).decode("utf-8")))
+    session.commit()
+
+    async def overloaded(*args):
+        raise ServiceOverloaded(2)
+
+    monkeypatch.setattr(hashing.hasher, "check_async", overloaded)
+    response = client.post("/auth/token", data={"username": "a", "password": "password"})
+    assert response.status_code == 503
+    assert response.headers["retry-after"] == "2"
+    assert response.json() == {"error": "service_overloaded", "message": "Server is busy, try again later"}
+
+
+"""
+    Test that the hashing pool's load is reported with the server's metrics
+"""
+def test_hashing_metrics(client):
+    response = client.get("/metrics")
+    assert response.status_code == 200
+    for name in ["password_hash_in_flight", "password_hash_queue_depth", "password_hash_rejected_total", "password_hash_duration_seconds_count"]:
+        assert f"\n{name} " in response.text
+    assert client.get("/status/hashing").status_code == 404
@@ -0,0 +1,134 @@
+import gzip
+import json
+import pytest
+from datetime import datetime
+from sqlmodel import select
+from backend.database.schema import *
+from backend import importer
+from backend import queries as db
+
+
+"""
+    Seeding a chat to import into, and accounts for some of the authors
+"""
+@pytest.fixture
+def chat(session):
+    session.add(DBAccount(id=1, username="alice", email="alice", hashed_password="a"))
+    session.add(DBAccount(id=2, username="bob", email="bob", hashed_password="b"))
+    session.add(DBAccount(id=3, username="carol", email="carol", hashed_password="c"))
+    session.add(DBChat(id=1, name="chat1", owner_id=1))
+    session.add(DBChatMembership(account_id=1, chat_id=1))
+    session.add(DBChatMembership(account_id=2, chat_id=1))
+    session.commit()
+    return session
+
+
+def write_history(path, records, compress=False):
+    lines = "".join((record if isinstance(record, str) else json.dumps(record)) + "\n" for record in records)
+    with (gzip.open if compress else open)(path, "wt") as file:
+        file.write(lines)
+
+
+def import_quietly(session, path, **kwargs):
+    return importer.import_file(session.get_bind(), str(path), 1, progress=lambda line: None, **kwargs)
+
+
+"""
+    Test importing a gzip file: authors mapped to the accounts of members, the original
+    timestamps kept, and lines that aren't messages skipped
+"""
+def test_import_file(chat, tmp_path):
+    path = tmp_path / "history.ndjson.gz"
+    write_history(path, [
+        {"author": "u-1", "text": "first", "created_at": "2019-03-02T10:15:00"},
+        {"author": "u-2", "text": "second", "created_at": "2019-03-02T10:16:00"},
+        "not json",
+        {"author": "u-9", "text": "from someone gone", "created_at": "2019-03-02T10:17:00"},
+        {"author": "u-1", "created_at": "2019-03-02T10:18:00"},
+        {"text": "no author", "created_at": "2019-03-02T10:19:00"},
+        {"author": "u-3", "text": "from outside", "created_at": "2019-03-02T10:20:00"},
+    ], compress=True)
+
+    authors = importer.AuthorLookup({"u-1": "alice", "u-2": "bob", "u-3": "carol"})
+    counts = import_quietly(chat, path, authors=authors, batch_size=2)
+    assert counts == {"lines": 7, "imported": 5, "unknown_authors": 1, "non_members": 1, "skipped": 2}
+
+    messages = chat.exec(select(DBMessage).order_by(DBMessage.id)).all()
+    assert [(m.text, m.account_id) for m in messages] == [
+        ("first", 1), ("second", 2), ("from someone gone", None), ("no author", None), ("from outside", None),
+    ]
+    assert messages[0].created_at == datetime(2019, 3, 2, 10, 15)
+
+    checkpoint = db.get_import_checkpoint(chat, str(path))
+    assert (checkpoint.lines, checkpoint.imported, checkpoint.offset) == (7, 5, len(gzip.decompress(path.read_bytes())))
+    changes = chat.exec(select(DBChange).where(DBChange.entity == "message")).all()
+    assert sorted(change.entity_id for change in changes) == [m.id for m in messages]
+    hits, _ = db.search_messages(chat, 1, "someone")
+    assert [hit.text for hit, _, _ in hits] == ["from someone gone"]
+
+
+"""
+    Test that an import that failed half way resumes after its last committed batch, and that
+    importing a finished source again imports nothing
+"""
+def test_import_file_resumes(chat, tmp_path, monkeypatch):
+    path = tmp_path / "history.ndjson"
+    write_history(path, [
+        {"author": "alice", "text": f"message {n}", "created_at": f"2019-03-02T10:{n:02}:00"}
+        for n in range(10)
+    ])
+
+    import_messages = db.import_messages
+    batches = []
+
+    def failing_import_messages(session, *args):
+        batches.append(args)
+        if len(batches) == 3:
+            raise RuntimeError("connection lost")
+        return import_messages(session, *args)
+
+    monkeypatch.setattr(db, "import_messages", failing_import_messages)
+    with pytest.raises(RuntimeError):
+        import_quietly(chat, path, batch_size=3)
+    monkeypatch.setattr(db, "import_messages", import_messages)
+
+    chat.expire_all()
+    assert db.get_import_checkpoint(chat, str(path)).lines == 6
+    counts = import_quietly(chat, path, batch_size=3)
+    assert counts == {"lines": 4, "imported": 4, "unknown_authors": 0, "non_members": 0, "skipped": 0}
+    texts = [m.text for m in chat.exec(select(DBMessage).order_by(DBMessage.id))]
+    assert texts == [f"message {n}" for n in range(10)]
+
+    assert import_quietly(chat, path)["imported"] == 0
+
+
+"""
+    Test that a source can't be resumed into another chat than the one it was imported into,
+    nor restarted once it has messages in
+"""
+def test_import_file_other_chat(chat, tmp_path):
+    path = tmp_path / "history.ndjson"
+    write_history(path, [{"author": "alice", "text": "hi", "created_at": "2019-03-02T10:15:00"}])
+    import_quietly(chat, path)
+
+    chat.add(DBChat(id=2, name="chat2", owner_id=1))
+    chat.commit()
+    with pytest.raises(ValueError):
+        importer.import_file(chat.get_bind(), str(path), 2, progress=lambda line: None)
+    with pytest.raises(ValueError):
+        importer.import_file(chat.get_bind(), str(path), 2, restart=True, progress=lambda line: None)
+    assert len(chat.exec(select(DBMessage)).all()) == 1
+
+
+"""
+    Test that a source none of whose messages went in can be imported again from the start
+"""
+def test_import_file_restart(chat, tmp_path):
+    path = tmp_path / "history.ndjson"
+    write_history(path, ["not json"])
+    assert import_quietly(chat, path)["skipped"] == 1
+    assert import_quietly(chat, path)["lines"] == 0
+
+    write_history(path, [{"author": "alice", "text": "fixed", "created_at": "2019-03-02T10:15:00"}])
+    assert import_quietly(chat, path, restart=True)["imported"] == 1
+    assert db.get_import_checkpoint(chat, str(path)).imported == 1
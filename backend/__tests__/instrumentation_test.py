@@ -0,0 +1,71 @@
+import json
+import logging
+import pytest
+from backend.__tests__.main_test import auth_headers, setup_db
+from backend import instrumentation
+
+# (method, path, authenticated as, JSON body, most queries); the route's own queries, plus
+# one to look up the account when authenticated, since every test starts with empty caches
+QUERY_BUDGETS = [
+    ("GET", "/accounts", None, None, 2),
+    ("GET", "/accounts/1", None, None, 1),
+    ("GET", "/chats", None, None, 2),
+    ("GET", "/chats/1", None, None, 1),
+    ("GET", "/chats/1/messages", None, None, 3),
+    ("GET", "/chats/1/accounts", None, None, 3),
+    ("POST", "/chats", 1, {"name": "new chat", "owner_id": 1}, 8),
+    ("PUT", "/chats/1", None, {"name": "renamed", "owner_id": 2}, 8),
+    ("DELETE", "/chats/3", None, None, 8),
+    ("POST", "/chats/1/messages", 1, {"text": "hello", "account_id": 1}, 6),
+    ("POST", "/chats/1/messages/batch", 1, {"messages": [{"text": "hi", "account_id": 1}] * 10}, 6),
+    ("PUT", "/chats/1/messages/1", None, {"text": "edited"}, 6),
+    ("DELETE", "/chats/1/messages/1", None, None, 5),
+    ("POST", "/chats/1/accounts", None, {"account_id": 3}, 7),
+    ("POST", "/chats/1/accounts/batch", None, {"account_ids": [1, 2, 3]}, 5),
+    ("DELETE", "/chats/1/accounts/2", None, None, 7),
+    ("DELETE", "/chats/1/accounts/batch", None, {"account_ids": [2, 3]}, 7),
+    ("GET", "/chats/1/messages/search?q=hel", 1, None, 5),
+    ("GET", "/search?q=hel", 1, None, 4),
+    ("GET", "/sync?since=0", 1, None, 3),
+]
+
+
+"""
+    Test that no route runs more queries than it needs, so extra round trips don't creep in
+"""
+@pytest.mark.parametrize("method, path, account_id, body, limit", QUERY_BUDGETS, ids=[f"{m} {p}" for m, p, *_ in QUERY_BUDGETS])
+def test_query_budget(setup_db, client, max_queries, method, path, account_id, body, limit):
+    headers = auth_headers(account_id) if account_id is not None else {}
+    with max_queries(limit):
+        response = client.request(method, path, json=body, headers=headers)
+    assert response.status_code < 400, response.json()
+
+
+"""
+    Test that every response reports its query count and timings in a Server-Timing header
+"""
+def test_server_timing_header(setup_db, client):
+    response = client.get("/chats/1/messages", headers=auth_headers(1))
+    metrics = {metric.split(";")[0]: metric for metric in response.headers["Server-Timing"].split(", ")}
+    assert set(metrics) == {"db", "auth", "render", "total"}
+    assert 'desc="3 queries"' in metrics["db"]
+
+    response = client.get("/chats/999")
+    assert response.status_code == 404
+    assert 'desc="1 queries"' in response.headers["Server-Timing"]
+
+
+"""
+    Test that every request is logged as one line of JSON with the same measurements
+"""
+def test_request_log(setup_db, client, caplog):
+    with caplog.at_level(logging.INFO, logger=instrumentation.logger.name):
+        client.post("/chats/1/messages", json={"text": "hello", "account_id": 1}, headers=auth_headers(1))
+
+    record = json.loads(caplog.records[-1].getMessage())
+    assert record["method"] == "POST"
+    assert record["path"] == "/chats/1/messages"
+    assert record["status"] == 201
+    assert record["queries"] == 6
+    assert record["auth_ms"] > 0
+    assert set(record) >= {"db_ms", "render_ms", "total_ms"}
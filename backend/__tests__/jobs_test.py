@@ -0,0 +1,211 @@
+import asyncio
+import pytest
+from datetime import datetime, timedelta
+from sqlalchemy.ext.asyncio import create_async_engine
+from sqlalchemy.pool import NullPool
+from sqlmodel import select, update
+from backend.database.schema import *
+from backend import jobs
+from backend import queries as db
+from backend.settings import settings
+
+LEASE = timedelta(seconds=60)
+
+
+"""
+    Running the next due job on the test database, as a job worker would
+"""
+def run_next(database_path, worker_id="worker", job_id=None) -> bool:
+    async def _run():
+        engine = create_async_engine(f"sqlite+aiosqlite:///{database_path}", poolclass=NullPool)
+        try:
+            return await jobs.run_next(engine, worker_id, job_id)
+        finally:
+            await engine.dispose()
+    return asyncio.run(_run())
+
+
+"""
+    Test that a job goes to one worker at a time, and to another once its lease runs out
+"""
+def test_lease_job(session):
+    job_id = db.enqueue_job(session, db.REBUILD_SEARCH_INDEX).id
+    session.commit()
+
+    job = db.lease_job(session, "first", LEASE)
+    assert (job.id, job.status, job.leased_by, job.attempts) == (job_id, "running", "first", 1)
+    assert db.lease_job(session, "second", LEASE) is None
+
+    assert db.extend_lease(session, job_id, "first", timedelta(seconds=-1))
+    job = db.lease_job(session, "second", LEASE)
+    assert (job.id, job.leased_by, job.attempts) == (job_id, "second", 2)
+    assert not db.extend_lease(session, job_id, "first", LEASE)
+
+    # The worker that lost the job can't finish it
+    db.complete_job(session, job_id, "first")
+    assert db.get_job(session, job_id).status == "running"
+    db.complete_job(session, job_id, "second")
+    assert db.get_job(session, job_id).status == "done"
+    assert db.lease_job(session, "third", LEASE) is None
+
+
+"""
+    Test that a failed job waits longer before every retry, and fails for good after its last
+    attempt
+"""
+def test_fail_job(session):
+    job_id = db.enqueue_job(session, db.REBUILD_SEARCH_INDEX, max_attempts=3).id
+    session.commit()
+
+    waits = []
+    for attempt in range(1, 4):
+        db.lease_job(session, "worker", LEASE, job_id)
+        before = datetime.now()
+        db.fail_job(session, job_id, "worker", f"failure {attempt}", timedelta(seconds=10))
+        job = db.get_job(session, job_id)
+        assert job.error == f"failure {attempt}"
+        if job.status == "pending":
+            waits.append(round((job.run_at - before).total_seconds()))
+            assert db.lease_job(session, "worker", LEASE) is None
+            job.run_at = datetime.now()
+            session.commit()
+
+    assert waits == [10, 20]
+    assert job.status == "failed" and job.attempts == 3
+    assert db.lease_job(session, "worker", LEASE) is None
+
+
+"""
+    Test that a failed job can be queued again with a fresh set of attempts, and that only
+    failed jobs are
+"""
+def test_retry_jobs(session):
+    failed = db.enqueue_job(session, db.PURGE_CHAT, 1, max_attempts=1).id
+    pending = db.enqueue_job(session, db.PURGE_CHAT, 2).id
+    session.commit()
+    db.lease_job(session, "worker", LEASE, failed)
+    db.fail_job(session, failed, "worker", "boom", timedelta(seconds=10))
+
+    assert db.retry_jobs(session, kind=db.REBUILD_SEARCH_INDEX) == []
+    assert db.retry_jobs(session, kind=db.PURGE_CHAT) == [failed]
+    session.expire_all()
+    job = db.get_job(session, failed)
+    assert (job.status, job.attempts) == ("pending", 0)
+    assert db.lease_job(session, "worker", LEASE, failed).id == failed
+    assert db.retry_jobs(session, [pending]) == []
+
+
+"""
+    Test that a worker runs a job with its handler and retries it when it raises
+"""
+def test_run_next(session, database_path, monkeypatch):
+    calls = []
+
+    def flaky(session, job_id):
+        calls.append(job_id)
+        if len(calls) == 1:
+            raise RuntimeError("try again")
+
+    monkeypatch.setitem(jobs.HANDLERS, "flaky", flaky)
+    monkeypatch.setattr(settings, "job_retry_backoff", 0)
+    job_id = db.enqueue_job(session, "flaky").id
+    session.commit()
+
+    assert run_next(database_path)
+    session.expire_all()
+    job = db.get_job(session, job_id)
+    assert (job.status, job.error, job.attempts) == ("pending", "try again", 1)
+
+    assert run_next(database_path)
+    session.expire_all()
+    job = db.get_job(session, job_id)
+    assert (job.status, job.error, job.attempts) == ("done", None, 2)
+    assert calls == [job_id, job_id]
+    assert not run_next(database_path)
+
+
+"""
+    Test that a job of an unknown kind fails rather than stalling the queue
+"""
+def test_run_next_unknown_kind(session, database_path):
+    job_id = db.enqueue_job(session, "unknown", max_attempts=1).id
+    session.commit()
+
+    assert run_next(database_path)
+    session.expire_all()
+    job = db.get_job(session, job_id)
+    assert job.status == "failed"
+    assert job.error == "No handler for jobs of kind 'unknown'"
+
+
+"""
+    Test that the search index rebuild runs as a job and reports its progress
+"""
+def test_rebuild_search_index_job(session, database_path):
+    session.add(DBAccount(id=1, username="a", email="a", hashed_password="a"))
+    session.add(DBChat(id=1, name="chat1", owner_id=1))
+    session.add(DBMessage(id=1, text="hello", account_id=1, chat_id=1))
+    session.add(DBMessage(id=2, text="world", account_id=1, chat_id=1))
+    job_id = db.enqueue_job(session, db.REBUILD_SEARCH_INDEX).id
+    session.commit()
+
+    assert run_next(database_path)
+    session.expire_all()
+    job = db.get_job(session, job_id)
+    assert (job.status, job.done, job.total) == ("done", 2, 2)
+
+
+"""
+    Test that compacting the change log schedules the next compaction, once however often it is
+    scheduled
+"""
+def test_compact_change_log_job(session, database_path, monkeypatch):
+    monkeypatch.setattr(settings, "change_log_retention", -1)
+    session.add(DBChange(chat_id=1, entity="message", entity_id=1, op="create"))
+    first = db.schedule_job(session, db.COMPACT_CHANGE_LOG, datetime.now()).id
+    assert db.schedule_job(session, db.COMPACT_CHANGE_LOG, datetime.now()).id == first
+
+    assert run_next(database_path)
+    session.expire_all()
+    assert db.get_job(session, first).status == "done"
+    assert session.exec(select(DBChange)).all() == []
+    following = session.exec(select(DBJob).where(DBJob.status == "pending")).one()
+    assert following.kind == db.COMPACT_CHANGE_LOG
+    assert following.run_at > datetime.now() + timedelta(seconds=settings.change_log_compaction_interval - 60)
+    assert not run_next(database_path)
+
+
+"""
+    Test that deleting an account leaves a purge leased by another worker to that worker, and
+    queues a failed one again, waiting for both without using up its attempts
+"""
+def test_account_deletion_waits_for_leased_purges(session, database_path, monkeypatch):
+    monkeypatch.setattr(db, "ACCOUNT_DELETION_RECHECK", timedelta(0))
+    session.add(DBAccount(id=1, username="a", email="a", hashed_password="a"))
+    for chat_id in [1, 2]:
+        session.add(DBChat(id=chat_id, name=f"chat{chat_id}", owner_id=1))
+        session.add(DBMessage(text="hello", account_id=1, chat_id=chat_id))
+    session.commit()
+    leased = db.delete_chat(session, 1, purge_threshold=0).id
+    failed = db.delete_chat(session, 2, purge_threshold=0).id
+    session.exec(update(DBJob).where(DBJob.id == failed).values(status="failed", attempts=5))
+    session.commit()
+    assert db.lease_job(session, "other", LEASE, leased).id == leased
+    job_id = db.delete_account(session, 1).id
+
+    assert run_next(database_path, job_id=job_id)
+    session.expire_all()
+    job, purge = db.get_job(session, job_id), db.get_job(session, leased)
+    assert (job.status, job.attempts) == ("pending", 0)
+    assert (purge.status, purge.leased_by, purge.done, purge.total) == ("running", "other", 0, None)
+    assert db.get_job(session, failed).status == "pending"
+
+    # The other worker finishes its purge, the failed one runs again, then the account goes
+    db.purge_chat(session, leased)
+    db.complete_job(session, leased, "other")
+    while run_next(database_path):
+        pass
+    session.expire_all()
+    assert [db.get_job(session, id).status for id in [leased, failed, job_id]] == ["done", "done", "done"]
+    assert db.get_job(session, leased).done == 1
+    assert session.get(DBAccount, 1) is None
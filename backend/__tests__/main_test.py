@@ -5,6 +5,11 @@ from jose import jwt
 import os
 from backend.auth import JWT_SECRET_KEY, JWT_ALGORITHM, JWT_ISSUER
 import bcrypt
+from starlette.websockets import WebSocketDisconnect
+from backend import queries as db
+from backend.__tests__.jobs_test import run_next
+from backend.settings import settings
+from sqlmodel import select
 
 # ------------------------------------ Helper Functions ------------------------------------
 
@@ -148,7 +153,7 @@ def test_get_messages_1(setup_db , client):
     response = client.get("/chats/1/messages")
     assert response.status_code == 200
     assert response.json() == {
-        "metadata": {"count": 2},
+        "metadata": {"count": 2, "next_cursor": None},
         "messages": [
             {"id":1, "text":"Hello", "account_id":1, "chat_id":1, "created_at":"2020-05-17T00:00:00"},
             {"id":2, "text":"Hey", "account_id":2, "chat_id":1, "created_at":"2020-05-17T00:00:00"},
@@ -162,7 +167,7 @@ def test_get_messages_3(setup_db , client):
     response = client.get("/chats/3/messages")
     assert response.status_code == 200
     assert response.json() == {
-        "metadata": {"count": 0},
+        "metadata": {"count": 0, "next_cursor": None},
         "messages": [
         ]
     }
@@ -181,6 +186,61 @@ def test_get_messages_dne(setup_db , client):
     }
 
 
+"""
+    Test to page forwards through the messages of a chat using the after cursor
+"""
+def test_get_messages_after_cursor(setup_db, session, client):
+    for i in range(4, 9):
+        session.add(DBMessage(id = i, text = f"msg{i}", account_id = 1, chat_id = 1, created_at = datetime(2020, 5, 17)))
+    session.commit()
+
+    response = client.get("/chats/1/messages", params={"after": 0, "limit": 3})
+    assert response.status_code == 200
+    assert response.json()["metadata"] == {"count": 3, "next_cursor": 4}
+    assert [m["id"] for m in response.json()["messages"]] == [1, 2, 4]
+
+    response = client.get("/chats/1/messages", params={"after": 4, "limit": 3})
+    assert response.status_code == 200
+    assert response.json()["metadata"] == {"count": 3, "next_cursor": 7}
+    assert [m["id"] for m in response.json()["messages"]] == [5, 6, 7]
+
+    response = client.get("/chats/1/messages", params={"after": 7, "limit": 3})
+    assert response.json()["metadata"] == {"count": 1, "next_cursor": None}
+    assert [m["id"] for m in response.json()["messages"]] == [8]
+
+
+"""
+    Test to page backwards through the messages of a chat using the before cursor
+"""
+def test_get_messages_before_cursor(setup_db, session, client):
+    for i in range(4, 9):
+        session.add(DBMessage(id = i, text = f"msg{i}", account_id = 1, chat_id = 1, created_at = datetime(2020, 5, 17)))
+    session.commit()
+
+    # Without a cursor, the newest messages
+    response = client.get("/chats/1/messages", params={"limit": 3})
+    assert response.status_code == 200
+    assert response.json()["metadata"] == {"count": 3, "next_cursor": 6}
+    assert [m["id"] for m in response.json()["messages"]] == [6, 7, 8]
+
+    response = client.get("/chats/1/messages", params={"before": 8, "limit": 3})
+    assert response.status_code == 200
+    assert response.json()["metadata"] == {"count": 3, "next_cursor": 5}
+    assert [m["id"] for m in response.json()["messages"]] == [5, 6, 7]
+
+    response = client.get("/chats/1/messages", params={"before": 5, "limit": 3})
+    assert response.json()["metadata"] == {"count": 3, "next_cursor": None}
+    assert [m["id"] for m in response.json()["messages"]] == [1, 2, 4]
+
+
+"""
+    Test to return a validation error for a page size above the maximum
+"""
+def test_get_messages_limit_too_large(setup_db, client):
+    response = client.get("/chats/1/messages", params={"limit": 100000})
+    assert response.status_code == 422
+
+
 """
     Test to get all accounts associated with chat_id = 1 in the chat_memberships table
 """
@@ -342,6 +402,65 @@ def test_delete_chat(setup_db, client):
     assert response.status_code == 404
 
 
+"""
+    Test that deleting a chat with more messages than the purge threshold answers 202 and hides
+    the chat at once, and that the job then purges its messages
+"""
+def test_delete_chat_purge(setup_db, session, client, monkeypatch):
+    monkeypatch.setattr(settings, "chat_purge_threshold", 1)
+    response = client.delete("/chats/1")
+    assert response.status_code == 202
+    job = response.json()
+    assert job["kind"] == "purge_chat" and job["target_id"] == 1
+    assert response.headers["location"] == f"/jobs/{job['id']}"
+
+    # The test client runs the purge before returning
+    response = client.get(f"/jobs/{job['id']}", headers=auth_headers(1))
+    assert response.status_code == 200
+    assert response.json()["status"] == "done"
+    assert response.json()["done"] == response.json()["total"] == 2
+    assert client.get("/chats/1").status_code == 404
+    assert session.exec(select(DBMessage).where(DBMessage.chat_id == 1)).all() == []
+    assert session.exec(select(DBChatMembership).where(DBChatMembership.chat_id == 1)).all() == []
+
+
+"""
+    Test that a chat waiting to be purged can't be seen or changed
+"""
+def test_delete_chat_purge_hides_chat(setup_db, session, client):
+    job = db.delete_chat(session, 1, purge_threshold=1)
+    assert job.status == "pending"
+    assert client.get("/chats/1").status_code == 404
+    assert [chat["id"] for chat in client.get("/chats").json()["chats"]] == [2, 3]
+    assert client.put("/chats/1", json={"name": "renamed"}).status_code == 404
+    assert client.get(f"/jobs/{job.id}", headers=auth_headers(1)).json()["status"] == "pending"
+
+
+"""
+    Test to get a job that doesn't exist
+"""
+def test_get_job_dne(setup_db, client):
+    response = client.get("/jobs/999", headers=auth_headers(1))
+    assert response.status_code == 404
+    assert response.json() == {"error": "entity_not_found", "message": "Unable to find job with id=999"}
+
+
+"""
+    Test that a job can only be followed by the account it was started for
+"""
+def test_get_job_of_another_account(setup_db, session, client):
+    purge = db.delete_chat(session, 1, purge_threshold=1)
+    compaction = db.enqueue_job(session, db.COMPACT_CHANGE_LOG)
+    session.commit()
+    assert purge.account_id == 1
+
+    assert client.get(f"/jobs/{purge.id}").status_code == 403
+    response = client.get(f"/jobs/{purge.id}", headers=auth_headers(2))
+    assert response.status_code == 404
+    assert response.json() == {"error": "entity_not_found", "message": f"Unable to find job with id={purge.id}"}
+    assert client.get(f"/jobs/{compaction.id}", headers=auth_headers(1)).status_code == 404
+
+
 """
     Test to delete a chat when the chat_id doesn't correspond to a chat in the database
     (ModelDNE exception thrown)
@@ -374,6 +493,71 @@ def test_create_message(setup_db, client):
     assert data["text"] == "This is a new message"
 
 
+"""
+    Test to create several messages at once, ids coming back in the order they were sent
+"""
+def test_create_messages_batch(setup_db, client, session):
+    headers = auth_headers(1)
+    request_data = {"messages": [{"text": f"batch {n}", "account_id": 1} for n in range(3)]}
+    response = client.post("/chats/1/messages/batch", json=request_data, headers=headers)
+
+    assert response.status_code == 201
+    assert response.json() == {"metadata": {"count": 3, "failed": 0}, "ids": [4, 5, 6], "errors": []}
+    assert [session.get(DBMessage, id).text for id in [4, 5, 6]] == ["batch 0", "batch 1", "batch 2"]
+    assert [message.id for message, _, _ in db.search_messages(session, 1, "batch")[0]] == [4, 5, 6]
+    assert db.get_version(session, db.chat_version_key(1)) == 1
+
+
+"""
+    Test that every id goes with its own message when the insert takes several statements and
+    some messages are left out
+"""
+def test_create_messages_ids_follow_input_order(setup_db, session):
+    messages = [(f"message {n}", 3 if n % 7 == 0 else 1 + n % 2) for n in range(2500)]
+    results = db.create_messages(session, 1, messages, partial=True)
+
+    created = [result for result in results if isinstance(result, DBMessage)]
+    assert len(created) == 2500 - 358
+    assert [message.id for message in created] == list(range(4, 4 + len(created)))
+    stored = dict(session.exec(select(DBMessage.id, DBMessage.text).where(DBMessage.id >= 4)).all())
+    assert all(stored[message.id] == message.text for message in created)
+
+
+"""
+    Test that an invalid message fails the whole batch, unless partial results are asked for
+"""
+def test_create_messages_batch_errors(setup_db, client, session):
+    headers = auth_headers(1)
+    messages = [
+        {"text": "fine", "account_id": 1},
+        {"text": "someone else", "account_id": 2},
+        {"text": "also fine", "account_id": 1},
+    ]
+    response = client.post("/chats/1/messages/batch", json={"messages": messages}, headers=headers)
+    assert response.status_code == 403
+    assert response.json()["error"] == "access_denied"
+    assert session.get(DBMessage, 4) is None
+
+    response = client.post("/chats/1/messages/batch", json={"messages": messages, "partial": True}, headers=headers)
+    assert response.status_code == 201
+    assert response.json() == {
+        "metadata": {"count": 3, "failed": 1},
+        "ids": [4, None, 5],
+        "errors": [{"index": 1, "error": "access_denied", "message": "Cannot create message on behalf of different account"}],
+    }
+
+    # Account 1 isn't a member of chat 2
+    response = client.post("/chats/2/messages/batch", json={"messages": messages[:1]}, headers=headers)
+    assert response.status_code == 422
+    assert response.json()["error"] == "chat_membership_required"
+
+    response = client.post("/chats/999/messages/batch", json={"messages": messages[:1]}, headers=headers)
+    assert response.status_code == 404
+
+    response = client.post("/chats/1/messages/batch", json={"messages": []}, headers=headers)
+    assert response.status_code == 422
+
+
 """
     Test to create a message when the chat_id doesn't correspond to a chat in the database
     (ModelDNE exception thrown)
@@ -665,6 +849,44 @@ def test_delete_chat_membership_account_is_owner(setup_db, client):
     }
 
 
+"""
+    Test to add many accounts to a chat at once, counting the ones that were already members
+"""
+def test_add_chat_members_batch(setup_db, client):
+    response = client.post("/chats/1/accounts/batch", json={"account_ids": [1, 2, 3, 3]})
+    assert response.status_code == 200
+    assert response.json() == {"chat_id": 1, "created": 1, "existing": 2}
+
+    members = client.get("/chats/1/accounts").json()["accounts"]
+    assert [member["id"] for member in members] == [1, 2, 3]
+
+    # Nothing is added when one of the accounts doesn't exist
+    response = client.post("/chats/2/accounts/batch", json={"account_ids": [1, 999]})
+    assert response.status_code == 404
+    assert response.json()["message"] == "Unable to find account with id=999"
+    assert client.get("/chats/2/accounts").json()["accounts"] == []
+
+
+"""
+    Test to remove many members from a chat at once, keeping their messages without an author
+"""
+def test_delete_chat_members_batch(setup_db, client):
+    response = client.request("DELETE", "/chats/1/accounts/batch", json={"account_ids": [2, 3]})
+    assert response.status_code == 200
+    assert response.json() == {"chat_id": 1, "removed": 1, "not_members": 1}
+
+    assert [member["id"] for member in client.get("/chats/1/accounts").json()["accounts"]] == [1]
+    messages = client.get("/chats/1/messages").json()["messages"]
+    assert [message["account_id"] for message in messages] == [1, None]
+
+    # The owner can't be removed, and nobody else is removed with it
+    client.post("/chats/1/accounts/batch", json={"account_ids": [2]})
+    response = client.request("DELETE", "/chats/1/accounts/batch", json={"account_ids": [1, 2]})
+    assert response.status_code == 422
+    assert response.json()["error"] == "chat_owner_removal"
+    assert len(client.get("/chats/1/accounts").json()["accounts"]) == 2
+
+
 """
     Test to add an authenticated account to the database (no exceptions raised)
 """
@@ -1003,6 +1225,38 @@ def test_delete_account_with_owned_chats(setup_db, client):
     }
 
 
+"""
+    Test that an owner whose chats are all being purged can delete their account, which a job
+    does once the chats are gone
+"""
+def test_delete_account_owning_purged_chats(setup_db, session, client, database_path, monkeypatch):
+    monkeypatch.setattr(db, "ACCOUNT_DELETION_RECHECK", timedelta(0))
+    db.delete_chat(session, 1, purge_threshold=1)
+    db.delete_chat(session, 3, purge_threshold=0)
+
+    response = client.delete("/accounts/me", headers=auth_headers(1))
+    assert response.status_code == 202
+    job = response.json()
+    assert (job["kind"], job["target_id"]) == ("delete_account", 1)
+    assert response.headers["location"] == f"/jobs/{job['id']}"
+
+    # The test client runs the job before returning, which waits for the purges
+    session.expire_all()
+    deferred = db.get_job(session, job["id"])
+    assert (deferred.status, deferred.attempts) == ("pending", 0)
+    assert client.get(response.headers["location"], headers=auth_headers(1)).json()["status"] == "pending"
+    assert client.get("/accounts/1").status_code == 200
+
+    while run_next(database_path):
+        pass
+    session.expire_all()
+    assert db.get_job(session, job["id"]).status == "done"
+    assert client.get("/accounts/1").status_code == 404
+    session.expire_all()
+    assert session.exec(select(DBChat).where(DBChat.owner_id == 1)).all() == []
+    assert session.exec(select(DBMessage).where(DBMessage.chat_id == 1)).all() == []
+
+
 """
     Test the authentication required error when no token is provided
 """
@@ -1075,4 +1329,251 @@ def test_expired_token(setup_db, client):
     assert response.json() == {
         "error": "expired_access_token",
         "message": "Authentication failed: expired access token"
-    }
\ No newline at end of file
+    }
+# -------------------------------------- Realtime --------------------------------------
+
+"""
+    Test that a chat member's websocket receives created, updated and deleted message events
+"""
+def test_chat_websocket_message_events(setup_db, client):
+    with client.websocket_connect("/chats/1/ws", headers=auth_headers(1)) as websocket:
+        response = client.post("/chats/1/messages", json={"text": "new", "account_id": 1}, headers=auth_headers(1))
+        message_id = response.json()["id"]
+        event = websocket.receive_json()
+        assert event["type"] == "message.created"
+        assert event["chat_id"] == 1
+        assert event["message"]["id"] == message_id
+        assert event["message"]["text"] == "new"
+
+        client.put(f"/chats/1/messages/{message_id}", json={"text": "edited"})
+        event = websocket.receive_json()
+        assert event["type"] == "message.updated"
+        assert event["message"]["text"] == "edited"
+
+        client.delete(f"/chats/1/messages/{message_id}")
+        event = websocket.receive_json()
+        assert event == {"type": "message.deleted", "chat_id": 1, "message": {"id": message_id}}
+
+
+"""
+    Test that the websocket accepts the token from the pony_express_token cookie
+"""
+def test_chat_websocket_cookie_token(setup_db, client):
+    client.cookies.set("pony_express_token", create_test_token(2))
+    with client.websocket_connect("/chats/1/ws") as websocket:
+        client.delete("/chats/1/messages/2")
+        assert websocket.receive_json()["type"] == "message.deleted"
+
+
+"""
+    Test that the websocket is closed for a missing token and for an account outside the chat
+"""
+def test_chat_websocket_rejected(setup_db, client):
+    with pytest.raises(WebSocketDisconnect) as exc:
+        with client.websocket_connect("/chats/1/ws"):
+            pass
+    assert exc.value.code == 1008
+
+    with pytest.raises(WebSocketDisconnect) as exc:
+        with client.websocket_connect("/chats/2/ws", headers=auth_headers(1)):
+            pass
+    assert exc.value.code == 1008
+
+
+"""
+    Test that the event stream is refused to an account that is not a member of the chat
+"""
+def test_chat_events_not_member(setup_db, client):
+    response = client.get("/chats/2/events", headers=auth_headers(1))
+    assert response.status_code == 422
+    assert response.json()["error"] == "chat_membership_required"
+
+# -------------------------------------- Conditional GETs --------------------------------------
+
+"""
+    Test that the chat list is answered with 304 until a chat changes
+"""
+def test_get_chats_not_modified(setup_db, client):
+    response = client.get("/chats")
+    etag = response.headers["ETag"]
+    assert response.status_code == 200
+
+    response = client.get("/chats", headers={"If-None-Match": etag})
+    assert response.status_code == 304
+    assert response.headers["ETag"] == etag
+    assert response.content == b""
+
+    client.post("/chats", json={"name": "chat4", "owner_id": 1}, headers=auth_headers(1))
+    response = client.get("/chats", headers={"If-None-Match": etag})
+    assert response.status_code == 200
+    assert response.headers["ETag"] != etag
+    assert response.json()["metadata"]["count"] == 4
+
+
+"""
+    Test that the account list changes its ETag when an account registers
+"""
+def test_get_accounts_not_modified(setup_db, client):
+    etag = client.get("/accounts").headers["ETag"]
+    assert client.get("/accounts", headers={"If-None-Match": etag}).status_code == 304
+
+    client.post("/auth/registration", data={"username": "d", "email": "d", "password": "d"})
+    assert client.get("/accounts", headers={"If-None-Match": etag}).status_code == 200
+
+
+"""
+    Test that a chat's messages are answered with 304 until a message of that chat changes,
+    and that each page of the messages has its own ETag
+"""
+def test_get_messages_not_modified(setup_db, client):
+    etag = client.get("/chats/1/messages").headers["ETag"]
+    assert client.get("/chats/1/messages", headers={"If-None-Match": etag}).status_code == 304
+    assert client.get("/chats/1/messages", params={"limit": 1}).headers["ETag"] != etag
+
+    # Messages of other chats don't affect it
+    client.put("/chats/2/messages/3", json={"text": "edited"})
+    assert client.get("/chats/1/messages", headers={"If-None-Match": etag}).status_code == 304
+
+    client.put("/chats/1/messages/1", json={"text": "edited"})
+    response = client.get("/chats/1/messages", headers={"If-None-Match": etag})
+    assert response.status_code == 200
+    assert response.json()["messages"][0]["text"] == "edited"
+
+
+"""
+    Test that a chat's accounts change their ETag when a member changes its username
+"""
+def test_get_chat_id_accounts_not_modified(setup_db, client):
+    etag = client.get("/chats/1/accounts").headers["ETag"]
+    assert client.get("/chats/1/accounts", headers={"If-None-Match": etag}).status_code == 304
+
+    client.put("/accounts/me", json={"username": "z"}, headers=auth_headers(2))
+    response = client.get("/chats/1/accounts", headers={"If-None-Match": etag})
+    assert response.status_code == 200
+    assert response.json()["accounts"][1]["username"] == "z"
+
+
+"""
+    Test that an ETag never turns the error for a missing chat into a 304
+"""
+def test_get_messages_deleted_chat(setup_db, client):
+    etag = client.get("/chats/3/messages").headers["ETag"]
+    client.delete("/chats/3")
+    assert client.get("/chats/3/messages", headers={"If-None-Match": etag}).status_code == 404
+
+
+"""
+    Test that a chat that never existed is not found, even with the ETag its version 0 would have
+"""
+def test_get_chat_lists_unknown_chat(setup_db, client):
+    for path, etag in [("/chats/999/messages", '"chat:999.0"'), ("/chats/999/accounts", '"chat:999.accounts.0"')]:
+        assert client.get(path, headers={"If-None-Match": etag}).status_code == 404
+        assert client.get(path, headers={"If-None-Match": "*"}).status_code == 404
+
+# -------------------------------------- Delta Sync --------------------------------------
+
+"""
+    Test that sync returns inserts, edits and deletes of the caller's chats after the token
+"""
+def test_sync_changes_since_token(setup_db, client):
+    response = client.get("/sync", headers=auth_headers(1))
+    assert response.status_code == 200
+    assert response.json()["changes"] == []
+    token = response.json()["metadata"]["next_token"]
+
+    message_id = client.post("/chats/1/messages", json={"text": "new", "account_id": 1}, headers=auth_headers(1)).json()["id"]
+    client.put("/chats/1/messages/1", json={"text": "edited"})
+    client.delete("/chats/1/messages/2")
+    # Account 1 is not a member of chat 2
+    client.put("/chats/2/messages/3", json={"text": "hidden"})
+
+    response = client.get("/sync", params={"since": token}, headers=auth_headers(1))
+    assert response.status_code == 200
+    changes = response.json()["changes"]
+    assert [(c["entity"], c["entity_id"], c["op"]) for c in changes] == [
+        ("message", message_id, "insert"),
+        ("message", 1, "update"),
+        ("message", 2, "delete"),
+    ]
+    assert changes[0]["message"]["text"] == "new"
+    assert changes[1]["message"]["text"] == "edited"
+    assert changes[2]["message"] is None
+    assert response.json()["metadata"]["has_more"] is False
+
+    next_token = response.json()["metadata"]["next_token"]
+    response = client.get("/sync", params={"since": next_token}, headers=auth_headers(1))
+    assert response.json() == {"metadata": {"count": 0, "next_token": next_token, "has_more": False}, "changes": []}
+
+
+"""
+    Test that sync pages through the changes with has_more
+"""
+def test_sync_pages(setup_db, client):
+    token = client.get("/sync", headers=auth_headers(1)).json()["metadata"]["next_token"]
+    for text in ["a", "b", "c"]:
+        client.post("/chats/1/messages", json={"text": text, "account_id": 1}, headers=auth_headers(1))
+
+    response = client.get("/sync", params={"since": token, "limit": 2}, headers=auth_headers(1))
+    assert response.json()["metadata"]["count"] == 2
+    assert response.json()["metadata"]["has_more"] is True
+
+    token = response.json()["metadata"]["next_token"]
+    response = client.get("/sync", params={"since": token, "limit": 2}, headers=auth_headers(1))
+    assert [c["message"]["text"] for c in response.json()["changes"]] == ["c"]
+    assert response.json()["metadata"]["has_more"] is False
+
+
+"""
+    Test that a removed member still sees the tombstone of its own membership, and that the
+    author of its messages is cleared for the remaining members
+"""
+def test_sync_membership_removed(setup_db, client):
+    token = client.get("/sync", headers=auth_headers(2)).json()["metadata"]["next_token"]
+    client.delete("/chats/1/accounts/2")
+
+    changes = client.get("/sync", params={"since": token}, headers=auth_headers(2)).json()["changes"]
+    assert [(c["entity"], c["entity_id"], c["op"]) for c in changes] == [("membership", 2, "delete")]
+
+    changes = client.get("/sync", params={"since": token}, headers=auth_headers(1)).json()["changes"]
+    assert [(c["entity"], c["entity_id"], c["op"]) for c in changes] == [
+        ("message", 2, "update"),
+        ("membership", 2, "delete"),
+    ]
+    assert changes[0]["message"]["account_id"] is None
+
+
+"""
+    Test that every member gets a tombstone when a chat is deleted
+"""
+def test_sync_chat_deleted(setup_db, client):
+    token = client.get("/sync", headers=auth_headers(2)).json()["metadata"]["next_token"]
+    client.delete("/chats/1")
+
+    changes = client.get("/sync", params={"since": token}, headers=auth_headers(2)).json()["changes"]
+    assert [(c["entity"], c["entity_id"], c["op"]) for c in changes] == [("membership", 2, "delete")]
+
+
+"""
+    Test that a token older than the compacted change log is refused
+"""
+def test_sync_token_expired(setup_db, client, session):
+    token = client.get("/sync", headers=auth_headers(1)).json()["metadata"]["next_token"]
+    client.post("/chats/1/messages", json={"text": "new", "account_id": 1}, headers=auth_headers(1))
+    assert db.compact_changes(session, timedelta(seconds=-1)) == 1
+
+    response = client.get("/sync", params={"since": token}, headers=auth_headers(1))
+    assert response.status_code == 410
+    assert response.json()["error"] == "sync_token_expired"
+
+    # A fresh token works again
+    token = client.get("/sync", headers=auth_headers(1)).json()["metadata"]["next_token"]
+    assert client.get("/sync", params={"since": token}, headers=auth_headers(1)).status_code == 200
+
+
+"""
+    Test that a token that was never handed out is a validation error, not an expired token
+"""
+def test_sync_token_malformed(setup_db, client):
+    for token in ["abc", "-1", "1.5"]:
+        response = client.get("/sync", params={"since": token}, headers=auth_headers(1))
+        assert response.status_code == 422
@@ -0,0 +1,153 @@
+import asyncio
+import json
+import subprocess
+import sys
+from sqlalchemy.ext.asyncio import create_async_engine
+from sqlalchemy.pool import AsyncAdaptedQueuePool
+from sqlmodel import select
+from sqlmodel.ext.asyncio.session import AsyncSession
+from backend.__tests__.main_test import setup_db
+from backend import metrics
+from backend.settings import settings
+
+
+"""
+    Reading the samples of an exposition into a dict from sample (with labels) to value
+"""
+def parse(exposition: str) -> dict[str, float]:
+    samples = {}
+    for line in exposition.splitlines():
+        if line and not line.startswith("#"):
+            sample, value = line.rsplit(" ", 1)
+            samples[sample] = float(value)
+    return samples
+
+
+"""
+    The pid of a process that has exited
+"""
+def exited_pid() -> int:
+    process = subprocess.Popen([sys.executable, "-c", "pass"])
+    process.wait()
+    return process.pid
+
+
+"""
+    Test that requests are counted by route template and status, and timed
+"""
+def test_metrics_endpoint(setup_db, client):
+    before = parse(client.get("/metrics").text)
+    client.get("/chats/1")
+    client.get("/chats/2")
+    client.get("/chats/999")
+
+    response = client.get("/metrics")
+    assert response.status_code == 200
+    assert response.headers["content-type"].startswith("text/plain; version=0.0.4")
+    assert "# TYPE http_request_duration_seconds histogram" in response.text
+    after = parse(response.text)
+
+    def delta(sample):
+        return after.get(sample, 0) - before.get(sample, 0)
+
+    assert delta('http_requests_total{method="GET",route="/chats/{chat_id}",status="200"}') == 2
+    assert delta('http_requests_total{method="GET",route="/chats/{chat_id}",status="404"}') == 1
+    assert delta('http_request_duration_seconds_count{method="GET",route="/chats/{chat_id}"}') == 3
+    assert delta('http_request_duration_seconds_bucket{le="+Inf",method="GET",route="/chats/{chat_id}"}') == 3
+    # the scrape itself is in flight while it renders
+    assert after['http_requests_in_flight{method="GET"}'] == 1
+    for sample in ["threadpool_threads_max", "password_hash_queue_depth", 'cache_hit_ratio{cache="tokens"}']:
+        assert sample in after
+
+
+"""
+    Test that histogram buckets are cumulative and the last one counts every observation
+"""
+def test_histogram():
+    histogram = metrics.Histogram((0.1, 1.0))
+    for value in [0.05, 0.5, 0.7, 3.0]:
+        histogram.observe(("GET",), value)
+    samples = {(name, labels.get("le")): value for name, labels, value in histogram.samples("latency", ("method",))}
+    assert samples[("latency_bucket", "0.1")] == 1
+    assert samples[("latency_bucket", "1.0")] == 3
+    assert samples[("latency_bucket", "+Inf")] == 4
+    assert samples[("latency_count", None)] == 4
+    assert samples[("latency_sum", None)] == 4.25
+
+
+"""
+    Test that the workers' snapshots in the metrics directory are added up: counters of every
+    worker, gauges of the running ones only, and cache hit ratios of the totals
+"""
+def test_metrics_across_workers(tmp_path, monkeypatch):
+    monkeypatch.setattr(settings, "metrics_dir", str(tmp_path))
+    other = {
+        "pid": exited_pid(),
+        "metrics": {
+            "http_requests_total": [["http_requests_total", {"method": "GET", "route": "/metrics-test", "status": "200"}, 5]],
+            "http_requests_in_flight": [["http_requests_in_flight", {"method": "GET"}, 100]],
+            "cache_hits_total": [["cache_hits_total", {"cache": "metrics-test"}, 3]],
+            "cache_misses_total": [["cache_misses_total", {"cache": "metrics-test"}, 1]],
+        },
+    }
+    (tmp_path / f"metrics-{other['pid']}.json").write_text(json.dumps(other))
+    metrics.request_started("GET")
+    metrics.request_finished("GET", "/metrics-test", 200, 0.01)
+
+    # Snapshots are taken on the event loop, which the threadpool statistics belong to
+    async def scrape():
+        return await metrics.exposition()
+
+    samples = parse(asyncio.run(scrape()))
+    assert samples['http_requests_total{method="GET",route="/metrics-test",status="200"}'] == 6
+    assert samples.get('http_requests_in_flight{method="GET"}', 0) < 100
+    assert samples['cache_hit_ratio{cache="metrics-test"}'] == 0.75
+    assert len(list(tmp_path.glob("metrics-*.json"))) == 2
+
+
+"""
+    Test that checkouts are timed when a session first needs a connection, and only then
+"""
+def test_time_checkouts(tmp_path):
+    engine = create_async_engine(f"sqlite+aiosqlite:///{tmp_path / 'pool.db'}", poolclass=AsyncAdaptedQueuePool)
+    metrics.time_checkouts("metrics-test", engine.pool)
+
+    async def use():
+        async with AsyncSession(engine) as session:
+            pass
+        assert ("metrics-test",) not in metrics.pool_wait.series
+        async with AsyncSession(engine) as session:
+            await session.exec(select(1))
+        await engine.dispose()
+
+    asyncio.run(use())
+    assert sum(metrics.pool_wait.series.pop(("metrics-test",))[:-1]) == 1
+
+
+"""
+    Test that a checkout from an exhausted pool is timed until a connection is checked back in
+"""
+def test_time_checkouts_waiting(tmp_path):
+    engine = create_async_engine(
+        f"sqlite+aiosqlite:///{tmp_path / 'pool.db'}", poolclass=AsyncAdaptedQueuePool, pool_size=1, max_overflow=0
+    )
+    metrics.time_checkouts("metrics-test", engine.pool)
+
+    async def hold():
+        async with AsyncSession(engine) as session:
+            await session.exec(select(1))
+            await asyncio.sleep(0.1)
+
+    async def wait():
+        await asyncio.sleep(0.02)
+        async with AsyncSession(engine) as session:
+            await session.exec(select(1))
+
+    async def use():
+        await asyncio.gather(hold(), wait())
+        await engine.dispose()
+
+    asyncio.run(use())
+    series = metrics.pool_wait.series.pop(("metrics-test",))
+    assert sum(series[:-1]) == 2
+    assert 0.05 < series[-1] < 0.5
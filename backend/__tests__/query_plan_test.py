@@ -0,0 +1,206 @@
+import inspect
+import pytest
+import bcrypt
+from datetime import datetime, timedelta
+from sqlalchemy import event, text
+from sqlmodel import select
+from backend.database.schema import *
+from backend.exceptions import JobDeferred
+from backend import dependencies
+from backend import queries as db
+
+# ------------------------------------ Helper Functions ------------------------------------
+
+"""
+    Seeding a small database, account 1 has a real password hash so the credential checks work
+"""
+@pytest.fixture
+def seeded(session):
+    hashed_password = bcrypt.hashpw(b"password", bcrypt.gensalt(rounds=4)).decode("utf-8")
+    session.add(DBAccount(id = 1, username = "a", email = "a", hashed_password = hashed_password))
+    session.add(DBAccount(id = 2, username = "b", email = "b", hashed_password = hashed_password))
+    session.add(DBAccount(id = 3, username = "c", email = "c", hashed_password = hashed_password))
+    session.add(DBChat(id = 1, name = "chat1", owner_id = 1))
+    session.add(DBChat(id = 2, name = "chat2", owner_id = 1))
+    session.add(DBMessage(id = 1, text = "Hello", account_id = 1, chat_id = 1, created_at = datetime(2020, 5, 17)))
+    session.add(DBMessage(id = 2, text = "Hey", account_id = 2, chat_id = 1, created_at = datetime(2020, 5, 17)))
+    session.add(DBChatMembership(account_id = 1, chat_id = 1))
+    session.add(DBChatMembership(account_id = 2, chat_id = 1))
+    session.add(DBChatMembership(account_id = 1, chat_id = 2))
+    session.commit()
+    return session
+
+
+"""
+    Recording every statement (and its parameters) the session sends to the database
+"""
+def capture_statements(session, fn):
+    statements = []
+
+    def _record(conn, cursor, statement, parameters, context, executemany):
+        if not executemany:
+            statements.append((statement, parameters))
+
+    engine = session.get_bind()
+    event.listen(engine, "before_cursor_execute", _record)
+    try:
+        fn(session)
+    finally:
+        event.remove(engine, "before_cursor_execute", _record)
+    return statements
+
+
+"""
+    Getting the tables that EXPLAIN QUERY PLAN reports as full scans for a statement
+"""
+def full_table_scans(session, statement, parameters):
+    conn = session.connection()
+    plan = conn.exec_driver_sql(f"EXPLAIN QUERY PLAN {statement}", parameters).all()
+    scans = []
+    for row in plan:
+        detail = row[-1]
+        # "(subquery-N)" is SQLite's own sorted copy of rows for a window function, not a table
+        if detail.startswith("SCAN ") and not detail.startswith("SCAN (subquery-"):
+            scans.append(detail.split()[1])
+    return scans
+
+"""
+    Deleting account 1 once the purges of its chats are done, deferred until then
+"""
+def finish_account_deletion(session):
+    db.delete_chat(session, 1, purge_threshold=0)
+    db.delete_chat(session, 2, purge_threshold=0)
+    job_id = db.delete_account(session, 1).id
+    with pytest.raises(JobDeferred):
+        db.finish_account_deletion(session, job_id)
+    for purge in session.exec(select(DBJob).where(DBJob.kind == db.PURGE_CHAT)).all():
+        db.purge_chat(session, purge.id)
+        purge.status = db.JOB_DONE
+    session.commit()
+    db.finish_account_deletion(session, job_id)
+
+# -------------------------------------------------------------------------------------------
+
+"""
+    One call per query function, plus the tables each call is allowed to scan in full.
+    Listing endpoints return the whole table, so a scan is the expected plan for them.
+"""
+QUERY_CASES = {
+    "get_accounts": (lambda s: db.get_accounts(s), {"accounts"}),
+    "get_account": (lambda s: db.get_account(s, 1), set()),
+    "get_account_by_username": (lambda s: db.get_account_by_username(s, "a"), set()),
+    "get_chats": (lambda s: db.get_chats(s), {"chats"}),
+    "get_chat": (lambda s: db.get_chat(s, 1), set()),
+    "get_messages": (lambda s: db.get_messages(s, 1, before=2, after=0, limit=10), set()),
+    "get_chat_id_accounts": (lambda s: db.get_chat_id_accounts(s, 1), set()),
+    "create_chat": (lambda s: db.create_chat(s, "chat3", 2, 2), set()),
+    "update_chat": (lambda s: db.update_chat(s, 1, "renamed", 2), set()),
+    "delete_chat": (lambda s: db.delete_chat(s, 1), set()),
+    "create_message": (lambda s: db.create_message(s, 1, "new", 1), set()),
+    "insert_messages": (lambda s: db.insert_messages(s, [(1, "new", 1), (2, "new", 1)], [None, None]), set()),
+    "add_chat_members": (lambda s: db.add_chat_members(s, 2, [1, 2, 3]), set()),
+    "delete_chat_members": (lambda s: db.delete_chat_members(s, 1, [2, 3]), set()),
+    "create_messages": (lambda s: db.create_messages(s, 1, [("new", 1), ("newer", 2), ("no", 3)], partial=True), set()),
+    "create_message_group": (lambda s: db.create_message_group(s, [(1, "new", 1), (1, "newer", 2), (2, "other", 1), (9, "gone", 1)]), set()),
+    "update_message": (lambda s: db.update_message(s, 1, 1, "edited"), set()),
+    "delete_message": (lambda s: db.delete_message(s, 1, 1), set()),
+    "add_account_as_chat_member": (lambda s: db.add_account_as_chat_member(s, 1, 3), set()),
+    "delete_chat_membership": (lambda s: db.delete_chat_membership(s, 1, 2), set()),
+    "register_account": (lambda s: db.register_account(s, "d", "d", "password"), set()),
+    "check_account_available": (lambda s: db.check_account_available(s, "d", "d"), set()),
+    "add_account": (lambda s: db.add_account(s, "d", "d", "hashed"), set()),
+    "set_password_hash": (lambda s: db.set_password_hash(s, db.get_account(s, 1), "hashed"), set()),
+    "get_verified_user": (lambda s: db.get_verified_user(s, "a", "password"), set()),
+    "rehash_password_if_needed": (lambda s: db.rehash_password_if_needed(s, db.get_account(s, 1), "password"), set()),
+    "update_account": (lambda s: db.update_account(s, 3, "e", "e"), set()),
+    "update_password": (lambda s: db.update_password(s, 3, "password", "new_password"), set()),
+    "delete_account": (lambda s: db.delete_account(s, 3), set()),
+    "remove_account": (lambda s: db.remove_account(s, db.get_account(s, 3)), set()),
+    "finish_account_deletion": (finish_account_deletion, set()),
+    "chat_exists": (lambda s: db.chat_exists(s, 1), set()),
+    "account_exists": (lambda s: db.account_exists(s, 1), set()),
+    "account_in_chat_membership": (lambda s: db.account_in_chat_membership(s, 1, 1), set()),
+    "check_duplicate_chat_name": (lambda s: db.check_duplicate_chat_name(s, "unused"), set()),
+    "owner_exists_in_membership": (lambda s: db.owner_exists_in_membership(s, 1, 2), set()),
+    "verify_message": (lambda s: db.verify_message(s, 1, 1), set()),
+    "is_account_chat_owner": (lambda s: db.is_account_chat_owner(s, db.chat_exists(s, 1), 2), set()),
+    "delete_all_messages": (lambda s: db.delete_all_messages(s, 1, 2), set()),
+    "member_chat_version_keys": (lambda s: db.member_chat_version_keys(s, 1), set()),
+    "get_version": (lambda s: db.get_version(s, db.chat_version_key(1)), set()),
+    "get_chat_version": (lambda s: db.get_chat_version(s, 1), set()),
+    "bump_versions": (lambda s: db.bump_versions(s, db.CHATS_VERSION, db.chat_version_key(1)), set()),
+    "set_version": (lambda s: db.set_version(s, db.COMPACTED_THROUGH, 1), set()),
+    "record_change": (lambda s: db.record_change(s, 1, "chat", 1, "update"), set()),
+    "record_membership_changes": (lambda s: db.record_membership_changes(s, "update", DBChatMembership.account_id == 1), set()),
+    "record_message_changes": (lambda s: db.record_message_changes(s, "update", DBMessage.account_id == 1), set()),
+    "get_changes": (lambda s: db.get_changes(s, 2, 0), set()),
+    "get_change_log_head": (lambda s: db.get_change_log_head(s), set()),
+    "get_changed_entities": (lambda s: db.get_changed_entities(s, db.get_changes(s, 1, 0)[0]), set()),
+    # SQLite reports every lookup in a virtual table as a SCAN, the FTS5 index serves it
+    "search_messages": (lambda s: db.search_messages(s, 1, "hel", cursor="-1.0:1", limit=10), {"messages_fts"}),
+    # top_hits is the ranked subquery of the page's matches, read once to keep the best of each chat
+    "search_chats": (lambda s: db.search_chats(s, 1, "hel", cursor="-1.0:1", limit=10), {"messages_fts", "top_hits"}),
+    "rebuild_message_search": (lambda s: db.rebuild_message_search(s, batch_size=1), {"messages_fts"}),
+    "compact_changes": (lambda s: (db.create_message(s, 1, "new", 1), db.compact_changes(s, timedelta(seconds=-1))), set()),
+    "export_messages": (lambda s: db.export_messages(s, 1, after=1, limit=10), set()),
+    "get_account_ids_by_username": (lambda s: db.get_account_ids_by_username(s, ["a", "b", "missing"]), set()),
+    "get_chat_member_ids": (lambda s: db.get_chat_member_ids(s, 1, [1, 2, 3]), set()),
+    "get_import_checkpoint": (lambda s: db.get_import_checkpoint(s, "history.ndjson"), set()),
+    "import_messages": (lambda s: db.import_messages(s, 1, [("old", 1, datetime(2019, 1, 1))], "history.ndjson", 10, 1), set()),
+    "has_more_messages": (lambda s: db.has_more_messages(s, 1, 1), set()),
+    "purge_chat": (lambda s: db.purge_chat(s, db.delete_chat(s, 1, purge_threshold=0).id, batch_size=1), set()),
+    "get_job": (lambda s: db.get_job(s, db.delete_chat(s, 1, purge_threshold=0).id), set()),
+    "enqueue_job": (lambda s: db.enqueue_job(s, db.REBUILD_SEARCH_INDEX), set()),
+    "lease_job": (lambda s: db.lease_job(s, "worker", timedelta(seconds=60), db.enqueue_job(s, db.REBUILD_SEARCH_INDEX).id), set()),
+    "extend_lease": (lambda s: db.extend_lease(s, 1, "worker", timedelta(seconds=60)), set()),
+    "complete_job": (lambda s: db.complete_job(s, 1, "worker"), set()),
+    "fail_job": (lambda s: db.fail_job(s, db.enqueue_job(s, db.REBUILD_SEARCH_INDEX).id, "worker", "boom", timedelta(seconds=1)), set()),
+    "schedule_job": (lambda s: db.schedule_job(s, db.COMPACT_CHANGE_LOG, datetime.now()), set()),
+    "defer_job": (lambda s: db.defer_job(s, db.enqueue_job(s, db.REBUILD_SEARCH_INDEX).id, "worker", timedelta(seconds=5), "waiting"), set()),
+    "retry_jobs": (lambda s: db.retry_jobs(s, kind=db.PURGE_CHAT), set()),
+}
+
+
+"""
+    Test that every function in queries.py that talks to the database has a query plan case
+"""
+def test_every_query_function_is_covered():
+    query_functions = {
+        name
+        for name, fn in inspect.getmembers(db, inspect.isfunction)
+        if fn.__module__ == db.__name__ and "session" in inspect.signature(fn).parameters
+    }
+    assert query_functions - QUERY_CASES.keys() == set()
+
+
+"""
+    Test that no statement issued by a query function needs a full table scan
+"""
+@pytest.mark.parametrize("name", sorted(QUERY_CASES))
+def test_query_plan_uses_indexes(seeded, name):
+    call, allowed_scans = QUERY_CASES[name]
+    statements = capture_statements(seeded, call)
+    seeded.rollback()
+
+    for statement, parameters in statements:
+        if not statement.lstrip().upper().startswith(("SELECT", "INSERT", "UPDATE", "DELETE")):
+            continue
+        scans = set(full_table_scans(seeded, statement, parameters))
+        assert scans <= allowed_scans, f"{name} scans {scans - allowed_scans}: {statement}"
+
+
+"""
+    Test that the missing indexes are added to a database from before them, even one whose
+    chat names aren't unique, since nothing enforced that
+"""
+def test_create_db_tables_adds_missing_indexes(session, monkeypatch):
+    session.exec(text("DROP INDEX ix_chats_name"))
+    session.add(DBAccount(id = 1, username = "a", email = "a", hashed_password = "a"))
+    session.add(DBChat(id = 1, name = "dup", owner_id = 1))
+    session.add(DBChat(id = 2, name = "dup", owner_id = 1))
+    session.commit()
+
+    monkeypatch.setattr(dependencies, "engine", session.get_bind())
+    dependencies.create_db_tables()
+    indexes = session.exec(text("SELECT name FROM sqlite_master WHERE type = 'index' AND tbl_name = 'chats'")).all()
+    assert ("ix_chats_name",) in indexes
@@ -0,0 +1,196 @@
+import pytest
+from datetime import datetime
+from sqlalchemy import text
+from backend.database.schema import *
+from backend import queries as db
+from backend.__tests__.main_test import auth_headers
+
+
+"""
+    Seeding two chats whose messages share some words
+"""
+@pytest.fixture
+def messages(session):
+    session.add(DBAccount(id=1, username="a", email="a", hashed_password="a"))
+    session.add(DBChat(id=1, name="chat1", owner_id=1))
+    session.add(DBChat(id=2, name="chat2", owner_id=1))
+    session.add(DBChatMembership(account_id=1, chat_id=1))
+    texts = ["hello world", "hello there, hello again", "world peace", "Héllo from the café", "nothing to see"]
+    for i, message_text in enumerate(texts, start=1):
+        session.add(DBMessage(id=i, text=message_text, account_id=1, chat_id=1, created_at=datetime(2020, 5, 17)))
+    session.add(DBMessage(id=6, text="hello from chat two", account_id=1, chat_id=2, created_at=datetime(2020, 5, 17)))
+    session.commit()
+    return session
+
+
+"""
+    Test that search ranks the best match first, matches word prefixes and ignores accents,
+    and stays within the chat
+"""
+def test_search_messages(messages, client):
+    response = client.get("/chats/1/messages/search", params={"q": "hel"}, headers=auth_headers(1))
+    assert response.status_code == 200
+    body = response.json()
+    assert body["metadata"] == {"count": 3, "next_cursor": None}
+    assert [hit["message"]["id"] for hit in body["hits"]] == [2, 1, 4]
+    assert body["hits"][0]["snippet"] == "[hello] there, [hello] again"
+    assert body["hits"][0]["score"] > body["hits"][1]["score"]
+
+
+"""
+    Test that every word has to match, and that FTS5 syntax in the query is taken literally
+"""
+def test_search_messages_all_words(messages, client):
+    response = client.get("/chats/1/messages/search", params={"q": "world hello"}, headers=auth_headers(1))
+    assert [hit["message"]["id"] for hit in response.json()["hits"]] == [1]
+
+    response = client.get("/chats/1/messages/search", params={"q": 'hello OR "peace'}, headers=auth_headers(1))
+    assert response.status_code == 200
+    assert response.json()["hits"] == []
+
+    response = client.get("/chats/1/messages/search", params={"q": "   "}, headers=auth_headers(1))
+    assert response.json()["hits"] == []
+
+
+"""
+    Test walking through the results a page at a time
+"""
+def test_search_messages_pagination(messages, client):
+    ids = []
+    cursor = None
+    while True:
+        params = {"q": "hello", "limit": 1}
+        if cursor is not None:
+            params["cursor"] = cursor
+        body = client.get("/chats/1/messages/search", params=params, headers=auth_headers(1)).json()
+        ids += [hit["message"]["id"] for hit in body["hits"]]
+        cursor = body["metadata"]["next_cursor"]
+        if cursor is None:
+            break
+    assert ids == [2, 1, 4]
+
+
+"""
+    Test that edits and deletions are reflected in the results
+"""
+def test_search_follows_message_changes(messages, client):
+    db.update_message(messages, 1, 1, "goodbye world")
+    db.delete_message(messages, 1, 2)
+    db.create_message(messages, 1, "hello newcomer", 1)
+
+    response = client.get("/chats/1/messages/search", params={"q": "hello"}, headers=auth_headers(1))
+    assert [hit["message"]["text"] for hit in response.json()["hits"]] == ["hello newcomer", "Héllo from the café"]
+
+
+"""
+    Test searching a chat that doesn't exist, a chat the account isn't a member of, without
+    logging in, and with a made-up cursor
+"""
+def test_search_messages_errors(messages, client):
+    response = client.get("/chats/99/messages/search", params={"q": "hello"}, headers=auth_headers(1))
+    assert response.status_code == 404
+
+    response = client.get("/chats/2/messages/search", params={"q": "hello"}, headers=auth_headers(1))
+    assert response.status_code == 422
+
+    response = client.get("/chats/1/messages/search", params={"q": "hello"})
+    assert response.status_code == 403
+
+    response = client.get("/chats/1/messages/search", params={"q": "hello", "cursor": "nope"}, headers=auth_headers(1))
+    assert response.status_code == 400
+    assert response.json()["error"] == "invalid_cursor"
+
+
+"""
+    Test that rebuilding the index brings back messages it is missing and drops stale ones
+"""
+def test_rebuild_message_search(messages):
+    messages.exec(text("DELETE FROM messages_fts"))
+    messages.exec(text("INSERT INTO messages_fts(rowid, text) VALUES (3, 'hello stale')"))
+    messages.commit()
+    assert [message.id for message, _, _ in db.search_messages(messages, 1, "hello")[0]] == [3]
+
+    batches = []
+    indexed = db.rebuild_message_search(messages, batch_size=2, progress=lambda *batch: batches.append(batch))
+    assert indexed == 6
+    assert batches[-1] == (6, 6, 6)
+    assert [message.id for message, _, _ in db.search_messages(messages, 1, "hello")[0]] == [2, 1, 4]
+    assert messages.exec(text("SELECT count(*) FROM messages_fts")).one()[0] == 6
+
+
+"""
+    Seeding chats across two accounts for searching every chat at once: account 1 is a member
+    of chats 1 to 3, account 2 only of chat 4
+"""
+@pytest.fixture
+def chats(session):
+    session.add(DBAccount(id=1, username="a", email="a", hashed_password="a"))
+    session.add(DBAccount(id=2, username="b", email="b", hashed_password="b"))
+    for chat_id, owner_id in [(1, 1), (2, 1), (3, 1), (4, 2)]:
+        session.add(DBChat(id=chat_id, name=f"chat{chat_id}", owner_id=owner_id))
+        session.add(DBChatMembership(account_id=owner_id, chat_id=chat_id))
+    texts = {
+        1: ["hello world", "hello"],
+        2: ["hello hello hello", "hello there", "hello again", "goodbye"],
+        3: ["nothing to see"],
+        4: ["hello from a chat account 1 isn't in"],
+    }
+    message_id = 1
+    for chat_id, chat_texts in texts.items():
+        for message_text in chat_texts:
+            owner_id = 2 if chat_id == 4 else 1
+            session.add(DBMessage(id=message_id, text=message_text, account_id=owner_id, chat_id=chat_id, created_at=datetime(2020, 5, 17)))
+            message_id += 1
+    session.commit()
+    return session
+
+
+"""
+    Test that searching every chat only finds the caller's chats, grouped with their hit counts
+    and their best hits first
+"""
+def test_search_chats(chats, client):
+    response = client.get("/search", params={"q": "hel", "hits": 2}, headers=auth_headers(1))
+    assert response.status_code == 200
+    body = response.json()
+    assert body["metadata"] == {"count": 2, "next_cursor": None}
+    assert [(result["chat"]["id"], result["count"]) for result in body["chats"]] == [(2, 3), (1, 2)]
+    assert [hit["message"]["id"] for hit in body["chats"][0]["hits"]] == [3, 4]
+    assert body["chats"][0]["hits"][0]["snippet"] == "[hello] [hello] [hello]"
+    assert [hit["message"]["id"] for hit in body["chats"][1]["hits"]] == [2, 1]
+
+    response = client.get("/search", params={"q": "hello"}, headers=auth_headers(2))
+    assert [result["chat"]["id"] for result in response.json()["chats"]] == [4]
+
+
+"""
+    Test walking through the chats a page at a time
+"""
+def test_search_chats_pagination(chats, client):
+    chat_ids = []
+    cursor = None
+    while True:
+        params = {"q": "hello", "limit": 1}
+        if cursor is not None:
+            params["cursor"] = cursor
+        body = client.get("/search", params=params, headers=auth_headers(1)).json()
+        chat_ids += [result["chat"]["id"] for result in body["chats"]]
+        cursor = body["metadata"]["next_cursor"]
+        if cursor is None:
+            break
+    assert chat_ids == [2, 1]
+
+
+"""
+    Test that searching every chat requires authentication, and rejects a made-up cursor
+"""
+def test_search_chats_errors(chats, client):
+    response = client.get("/search", params={"q": "hello"})
+    assert response.status_code == 403
+
+    response = client.get("/search", params={"q": "hello", "cursor": "nope"}, headers=auth_headers(1))
+    assert response.status_code == 400
+    assert response.json()["error"] == "invalid_cursor"
+
+    response = client.get("/search", params={"q": "nowhere"}, headers=auth_headers(1))
+    assert response.json() == {"metadata": {"count": 0, "next_cursor": None}, "chats": []}
@@ -0,0 +1,156 @@
+"""Async versions of the database query functions, for the async routes.
+
+The queries themselves live in `backend.queries`; each one runs here on an AsyncSession through
+`run_sync`, which drives the same code over the async driver without a thread per request.
+Password hashing is the exception: it happens between the database steps, awaited on the
+hashing pool, so a slow bcrypt never holds up the event loop.
+"""
+
+import functools
+
+from sqlmodel.ext.asyncio.session import AsyncSession
+
+from backend import hashing
+from backend import queries
+from backend.database.schema import DBAccount
+from backend.exceptions import InvalidCredentials, ServiceOverloaded
+from backend.queries import (
+    ACCOUNTS_VERSION,
+    CHATS_VERSION,
+    MESSAGE_PAGE_SIZE,
+    MESSAGE_PAGE_SIZE_MAX,
+    SEARCH_CHATS_PAGE_SIZE,
+    SEARCH_CHATS_PAGE_SIZE_MAX,
+    SEARCH_HITS_PER_CHAT,
+    SEARCH_HITS_PER_CHAT_MAX,
+    SEARCH_PAGE_SIZE,
+    SEARCH_PAGE_SIZE_MAX,
+    SYNC_PAGE_SIZE,
+    SYNC_PAGE_SIZE_MAX,
+    chat_version_key,
+)
+
+
+"""
+    Turning a query function into one that takes an AsyncSession and is awaited
+"""
+def _run_sync(fn):
+    @functools.wraps(fn)
+    async def run(session: AsyncSession, *args, **kwargs):
+        return await session.run_sync(fn, *args, **kwargs)
+    return run
+
+# -------------------------------------- Assignment 2 --------------------------------------
+
+get_accounts = _run_sync(queries.get_accounts)
+get_account = _run_sync(queries.get_account)
+get_account_by_username = _run_sync(queries.get_account_by_username)
+get_chats = _run_sync(queries.get_chats)
+get_chat = _run_sync(queries.get_chat)
+get_messages = _run_sync(queries.get_messages)
+get_chat_id_accounts = _run_sync(queries.get_chat_id_accounts)
+
+# -------------------------------------- Assignment 3 --------------------------------------
+
+create_chat = _run_sync(queries.create_chat)
+update_chat = _run_sync(queries.update_chat)
+delete_chat = _run_sync(queries.delete_chat)
+create_message = _run_sync(queries.create_message)
+create_messages = _run_sync(queries.create_messages)
+update_message = _run_sync(queries.update_message)
+delete_message = _run_sync(queries.delete_message)
+add_account_as_chat_member = _run_sync(queries.add_account_as_chat_member)
+delete_chat_membership = _run_sync(queries.delete_chat_membership)
+account_in_chat_membership = _run_sync(queries.account_in_chat_membership)
+add_chat_members = _run_sync(queries.add_chat_members)
+delete_chat_members = _run_sync(queries.delete_chat_members)
+
+# -------------------------------------- Assignment 4 --------------------------------------
+
+"""
+    Adding a new authenticated account
+"""
+async def register_account(session: AsyncSession, username: str, email: str, password: str) -> DBAccount:
+    await session.run_sync(queries.check_account_available, username, email)
+    hashed_password = await hashing.hasher.hash_async(password)
+    return await session.run_sync(queries.add_account, username, email, hashed_password)
+
+
+"""
+    Getting an account by its username and password
+"""
+async def get_verified_user(session: AsyncSession, username: str, password: str) -> DBAccount:
+    account = await get_account_by_username(session, username)
+    if account is None or not await hashing.hasher.check_async(password, account.hashed_password):
+        raise InvalidCredentials()
+    await rehash_password_if_needed(session, account, password)
+    return account
+
+
+"""
+    Rehashing the password of an account that just logged in when its hash was made with another
+    cost factor than the configured one, skipped while the hashing pool is too busy
+"""
+async def rehash_password_if_needed(session: AsyncSession, account: DBAccount, password: str):
+    if not hashing.hasher.needs_rehash(account.hashed_password):
+        return
+    try:
+        hashed_password = await hashing.hasher.hash_async(password)
+    except ServiceOverloaded:
+        return
+    await session.run_sync(queries.set_password_hash, account, hashed_password)
+
+
+update_account = _run_sync(queries.update_account)
+
+
+"""
+    Updating the password of an account
+"""
+async def update_password(session: AsyncSession, id: int, old_pwd: str, new_pwd: str):
+    account = await session.run_sync(queries.account_exists, id)
+    if not await hashing.hasher.check_async(old_pwd, account.hashed_password):
+        raise InvalidCredentials()
+    hashed_password = await hashing.hasher.hash_async(new_pwd)
+    await session.run_sync(queries.set_password_hash, account, hashed_password)
+
+
+delete_account = _run_sync(queries.delete_account)
+
+# ---------------------------------- Version Counters & Sync ----------------------------------
+
+get_version = _run_sync(queries.get_version)
+get_chat_version = _run_sync(queries.get_chat_version)
+get_changes = _run_sync(queries.get_changes)
+get_change_log_head = _run_sync(queries.get_change_log_head)
+get_changed_entities = _run_sync(queries.get_changed_entities)
+
+# ------------------------------------- Message Search -------------------------------------
+
+search_messages = _run_sync(queries.search_messages)
+search_chats = _run_sync(queries.search_chats)
+
+# -------------------------------------- Chat Export --------------------------------------
+
+"""
+    Reading a chat's messages in id order, batch_size rows at a time, so the export never holds
+    more than one batch. Each batch is read in a transaction of its own, and the session is
+    closed before the batch is handed on, so a slow download doesn't keep a connection from the
+    pool or a read transaction open in between.
+"""
+async def export_messages(session: AsyncSession, chat_id: int, batch_size: int = queries.EXPORT_BATCH_SIZE):
+    after = 0
+    while True:
+        try:
+            rows = await session.run_sync(queries.export_messages, chat_id, after, batch_size)
+        finally:
+            await session.close()
+        if rows:
+            yield rows
+        if len(rows) < batch_size:
+            return
+        after = rows[-1].id
+
+# ------------------------------------- Background Jobs -------------------------------------
+
+get_job = _run_sync(queries.get_job)
@@ -1,11 +1,15 @@
 from jose import jwt
 from datetime import datetime, timezone
 from sqlmodel import Session
+from sqlmodel.ext.asyncio.session import AsyncSession
+from backend import cache
+from backend import async_queries as async_db
 from backend import queries as db
 from backend.models import Login, AccessToken, Claims
 from backend.database.schema import DBAccount
 from backend.exceptions import InvalidCredentials, AuthenticationRequiredError, ExpiredAccessTokenError, InvalidAccessTokenError
 import os
+import time
 
 JWT_SECRET_KEY = os.environ.get("JWT_SECRET_KEY", default="default")
 JWT_ALGORITHM = "HS256"
@@ -15,6 +19,12 @@ JWT_ISSUER = "http://127.0.0.1"
 def generate_token(session: Session, form: Login) -> str:
     account = db.get_account_by_username(session, form.username)
     account = validate_credentials(account, form.password)
+    db.rehash_password_if_needed(session, account, form.password)
+    claims = generate_claims(account)
+    return jwt.encode(claims.model_dump(), JWT_SECRET_KEY, algorithm=JWT_ALGORITHM,)
+
+async def generate_token_async(session: AsyncSession, form: Login) -> str:
+    account = await async_db.get_verified_user(session, form.username, form.password)
     claims = generate_claims(account)
     return jwt.encode(claims.model_dump(), JWT_SECRET_KEY, algorithm=JWT_ALGORITHM,)
 
@@ -30,12 +40,23 @@ def validate_credentials(account: DBAccount | None, password: str,) -> DBAccount
 
 def extract_account(session: Session, token: str) -> DBAccount:
     try:
-        payload = jwt.get_unverified_claims(token)
-        payload = jwt.decode(token, JWT_SECRET_KEY, algorithms=[JWT_ALGORITHM])
-        claims = Claims(**payload)
-        
-        return db.get_account(session, int(claims.sub))
+        claims = cache.token_cache.get(token)
+        if claims is None:
+            payload = jwt.decode(token, JWT_SECRET_KEY, algorithms=[JWT_ALGORITHM])
+            claims = Claims(**payload)
+            cache.token_cache.set(token, claims, ttl=claims.exp - time.time())
+
+        account_id = int(claims.sub)
+        account = cache.account_cache.get(account_id)
+        if account is None:
+            # Cache a copy that isn't attached to this request's session
+            account = DBAccount(**db.get_account(session, account_id).model_dump())
+            cache.account_cache.set(account_id, account)
+        return account
     except jwt.ExpiredSignatureError:
         raise ExpiredAccessTokenError()
     except Exception:
-        raise InvalidAccessTokenError()
\ No newline at end of file
+        raise InvalidAccessTokenError()
+
+async def extract_account_async(session: AsyncSession, token: str) -> DBAccount:
+    return await session.run_sync(extract_account, token)
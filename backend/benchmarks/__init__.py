@@ -0,0 +1,4 @@
+"""Benchmarks for the PonyExpress backend.
+
+Each module is a standalone script, run with `python -m backend.benchmarks.<module> --help`.
+"""
@@ -0,0 +1,188 @@
+"""Benchmark of the async routes against the threadpool model at increasing concurrency.
+
+Seeds a temporary SQLite database with a chat and its messages, then fetches pages of messages
+from N concurrent clients, once through the app's async route and session, and once through a
+copy of the route as a sync `def` on a blocking session, which FastAPI runs on its threadpool as
+every route used to be. Reports requests per second and latency percentiles for each model at
+each concurrency level.
+
+Requests go through httpx's ASGI transport in this process, so the numbers compare the two
+models rather than a deployment. Pass `--url` to load a running server over real connections
+instead.
+
+    python -m backend.benchmarks.concurrency --levels 50 500 5000 --requests 5000
+"""
+
+import argparse
+import asyncio
+import os
+import tempfile
+import time
+from datetime import datetime
+from typing import Annotated
+
+import httpx
+from fastapi import Depends, FastAPI, Query
+from sqlalchemy.ext.asyncio import create_async_engine
+from sqlmodel import Session, SQLModel, create_engine
+from sqlmodel.ext.asyncio.session import AsyncSession
+
+from backend import app as async_app
+from backend import queries
+from backend.benchmarks.stats import format_summary, summarize
+from backend.database.schema import DBAccount, DBChat, DBChatMembership, DBMessage
+from backend.dependencies import get_session
+from backend.models import Message, MessageList
+
+CHAT_ID = 1
+
+
+"""
+    Creating the tables and one chat with the given number of messages
+"""
+def seed(path: str, messages: int):
+    engine = create_engine(f"sqlite:///{path}")
+    SQLModel.metadata.create_all(engine)
+    with Session(engine) as session:
+        session.add(DBAccount(id=1, username="benchmark", email="benchmark", hashed_password="-"))
+        session.add(DBChat(id=CHAT_ID, name="benchmark", owner_id=1))
+        session.add(DBChatMembership(account_id=1, chat_id=CHAT_ID))
+        session.add_all(
+            DBMessage(text=f"message {n}", account_id=1, chat_id=CHAT_ID, created_at=datetime(2020, 5, 17))
+            for n in range(messages)
+        )
+        session.commit()
+    engine.dispose()
+
+
+"""
+    An app serving the messages route the way it was before the async data layer: a sync
+    route on a blocking session, run on the threadpool
+"""
+def threadpool_app(path: str, pool_size: int) -> FastAPI:
+    # A session's cleanup also needs a threadpool thread, so with fewer connections than threads
+    # the threads waiting for a connection can starve the ones that would return it. Let every
+    # thread have a connection of its own instead.
+    engine = create_engine(
+        f"sqlite:///{path}",
+        connect_args={"check_same_thread": False},
+        pool_size=pool_size,
+        max_overflow=-1,
+    )
+    app = FastAPI()
+
+    def get_sync_session():
+        with Session(engine) as session:
+            yield session
+
+    @app.get("/chats/{chat_id}/messages", response_model=MessageList)
+    def get_messages(
+        chat_id: int,
+        session: Annotated[Session, Depends(get_sync_session)],
+        limit: Annotated[int, Query(ge=1, le=queries.MESSAGE_PAGE_SIZE_MAX)] = queries.MESSAGE_PAGE_SIZE,
+    ) -> MessageList:
+        queries.get_version(session, queries.chat_version_key(chat_id))
+        messages, next_cursor = queries.get_messages(session, chat_id, limit=limit)
+        return MessageList(
+            metadata={"count": len(messages), "next_cursor": next_cursor},
+            messages=[Message(id=m.id, text=m.text, account_id=m.account_id, chat_id=m.chat_id, created_at=m.created_at) for m in messages],
+        )
+
+    return app
+
+
+"""
+    The application itself, with its sessions pointed at the benchmark database
+"""
+def async_app_for(path: str, pool_size: int) -> FastAPI:
+    engine = create_async_engine(
+        f"sqlite+aiosqlite:///{path}",
+        pool_size=pool_size,
+        max_overflow=0,
+        pool_timeout=300,
+    )
+
+    async def get_async_session():
+        async with AsyncSession(engine, expire_on_commit=False) as session:
+            yield session
+
+    async_app.dependency_overrides[get_session] = get_async_session
+    return async_app
+
+
+"""
+    Sending the requests from `concurrency` clients at once and timing each of them
+"""
+async def load(client: httpx.AsyncClient, concurrency: int, requests: int, limit: int) -> tuple[list[float], float, int]:
+    remaining = requests
+    latencies = []
+    errors = 0
+
+    async def worker():
+        nonlocal remaining, errors
+        while remaining > 0:
+            remaining -= 1
+            start = time.perf_counter()
+            response = await client.get(f"/chats/{CHAT_ID}/messages", params={"limit": limit})
+            latencies.append(time.perf_counter() - start)
+            if response.status_code != 200:
+                errors += 1
+
+    started = time.perf_counter()
+    await asyncio.gather(*(worker() for _ in range(concurrency)))
+    return latencies, time.perf_counter() - started, errors
+
+
+async def run_level(app_or_url, concurrency: int, requests: int, limit: int):
+    if isinstance(app_or_url, str):
+        limits = httpx.Limits(max_connections=concurrency, max_keepalive_connections=concurrency)
+        client = httpx.AsyncClient(base_url=app_or_url, limits=limits, timeout=300)
+    else:
+        client = httpx.AsyncClient(transport=httpx.ASGITransport(app=app_or_url), base_url="http://benchmark", timeout=300)
+    async with client:
+        return await load(client, concurrency, requests, limit)
+
+
+def report(label: str, concurrency: int, latencies: list[float], elapsed: float, errors: int):
+    print(
+        f"{label:<10} concurrency={concurrency:<5} {format_summary(summarize(latencies))} "
+        f"rate={len(latencies) / elapsed:,.0f} req/s errors={errors}"
+    )
+
+
+# One event loop for every level, since the async engine's connections belong to it
+async def run_all(models: dict, levels: list[int], requests: int, limit: int):
+    for concurrency in levels:
+        for label, app_or_url in models.items():
+            report(label, concurrency, *await run_level(app_or_url, concurrency, requests, limit))
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--levels", type=int, nargs="+", default=[50, 500, 5000], help="concurrent clients")
+    parser.add_argument("--requests", type=int, default=5000, help="requests per level and model")
+    parser.add_argument("--messages", type=int, default=1000, help="messages in the seeded chat")
+    parser.add_argument("--limit", type=int, default=50, help="messages per page")
+    parser.add_argument("--pool-size", type=int, default=20, help="database connections per model")
+    parser.add_argument("--url", help="load a running server at this URL instead, e.g. http://127.0.0.1:8000")
+    args = parser.parse_args()
+
+    if args.url:
+        asyncio.run(run_all({"server": args.url}, args.levels, args.requests, args.limit))
+        return
+
+    with tempfile.TemporaryDirectory() as directory:
+        path = os.path.join(directory, "benchmark.db")
+        seed(path, args.messages)
+        models = {
+            "threadpool": threadpool_app(path, args.pool_size),
+            "async": async_app_for(path, args.pool_size),
+        }
+        try:
+            asyncio.run(run_all(models, args.levels, args.requests, args.limit))
+        finally:
+            async_app.dependency_overrides.clear()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,136 @@
+"""Seeding the database the load tests run against.
+
+A dataset is a number of accounts, chats and messages, generated by `backend.datagen`. By
+default every chat has the same number of members and they all write about as much; the skew
+options make a few chats and authors much busier than the rest. Everything comes from a seeded
+random generator, so the same options always give the same database. Every account has the
+password `PASSWORD`, hashed once at the given bcrypt cost.
+
+A database that was seeded with the same options is reused, as recorded in a `.json` file next
+to it.
+
+    python -m backend.benchmarks.dataset --preset full backend/database/loadtest.db
+"""
+
+import argparse
+import json
+import os
+
+from sqlalchemy import text
+from sqlmodel import SQLModel, create_engine
+
+from backend import datagen
+from backend.settings import settings
+
+PASSWORD = "loadtest-password"
+
+# accounts, chats, messages, members per chat
+PRESETS = {
+    "tiny": {"accounts": 100, "chats": 10, "messages": 10_000, "members": 10},
+    "small": {"accounts": 1_000, "chats": 100, "messages": 100_000, "members": 20},
+    "full": {"accounts": 10_000, "chats": 1_000, "messages": 5_000_000, "members": 50},
+}
+
+
+"""
+    Getting the dataset options recorded next to a seeded database, if any
+"""
+def recorded_options(path: str) -> dict | None:
+    try:
+        with open(f"{path}.json") as file:
+            return json.load(file)
+    except (OSError, ValueError):
+        return None
+
+
+"""
+    Seeding a fresh database file, unless it was already seeded with the same options.
+    Returns the options, with the members of every chat.
+"""
+def seed(
+    path: str,
+    accounts: int,
+    chats: int,
+    messages: int,
+    members: int,
+    seed: int = 0,
+    rounds: int | None = None,
+    chat_size_skew: float = 0.0,
+    author_skew: float = 0.0,
+    progress=print,
+) -> dict:
+    rounds = rounds or settings.bcrypt_rounds
+    options = {
+        "accounts": accounts, "chats": chats, "messages": messages, "members": members, "seed": seed, "rounds": rounds,
+        "chat_size_skew": chat_size_skew, "author_skew": author_skew,
+    }
+    if os.path.exists(path) and recorded_options(path) == options:
+        return options
+
+    for leftover in (path, f"{path}-wal", f"{path}-shm", f"{path}.json"):
+        if os.path.exists(leftover):
+            os.remove(leftover)
+
+    engine = create_engine(f"sqlite:///{path}")
+    SQLModel.metadata.create_all(engine)
+    with engine.begin() as connection:
+        connection.execute(text("PRAGMA journal_mode = WAL"))
+        connection.execute(text("PRAGMA synchronous = OFF"))
+    datagen.generate(
+        engine, accounts, chats, messages, members, chat_size_skew=chat_size_skew, author_skew=author_skew,
+        password=PASSWORD, rounds=rounds, seed=seed, progress=lambda done: progress(f"seeded {done}"),
+    )
+    engine.dispose()
+
+    with open(f"{path}.json", "w") as file:
+        json.dump(options, file)
+    return options
+
+
+"""
+    Getting the (account id, chat id) of every membership of a seeded database
+"""
+def memberships(path: str) -> list[tuple[int, int]]:
+    engine = create_engine(f"sqlite:///{path}")
+    with engine.connect() as connection:
+        rows = connection.execute(text("SELECT account_id, chat_id FROM chat_memberships ORDER BY chat_id, account_id")).all()
+    engine.dispose()
+    return [tuple(row) for row in rows]
+
+
+def add_arguments(parser: argparse.ArgumentParser):
+    parser.add_argument("--preset", choices=PRESETS, default="small", help="dataset size")
+    parser.add_argument("--accounts", type=int, help="accounts, instead of the preset's")
+    parser.add_argument("--chats", type=int, help="chats, instead of the preset's")
+    parser.add_argument("--messages", type=int, help="messages, instead of the preset's")
+    parser.add_argument("--members", type=int, help="members per chat, instead of the preset's")
+    parser.add_argument("--seed", type=int, default=0, help="random seed")
+    parser.add_argument("--bcrypt-rounds", type=int, default=settings.bcrypt_rounds, help="cost of the accounts' password hash")
+    parser.add_argument("--chat-size-skew", type=float, default=0.0, help="Zipf exponent of chat sizes, 0 for uniform")
+    parser.add_argument("--author-skew", type=float, default=0.0, help="Zipf exponent of how much each account writes, 0 for uniform")
+
+
+"""
+    Getting the dataset options from the parsed arguments, the preset's where not given
+"""
+def options_from(args) -> dict:
+    options = dict(PRESETS[args.preset])
+    for name in options:
+        if getattr(args, name) is not None:
+            options[name] = getattr(args, name)
+    return {
+        **options, "seed": args.seed, "rounds": args.bcrypt_rounds,
+        "chat_size_skew": args.chat_size_skew, "author_skew": args.author_skew,
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("path", help="database file to seed")
+    add_arguments(parser)
+    args = parser.parse_args()
+    seed(args.path, **options_from(args))
+
+
+if __name__ == "__main__":
+    main()
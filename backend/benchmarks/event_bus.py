@@ -0,0 +1,146 @@
+"""Benchmark of realtime event delivery across worker processes.
+
+Starts N worker processes that each hold M subscribers to one chat on their own event hub, then
+publishes events from this process through the broker. Reports the end-to-end latency from
+publish to subscriber and the publish and delivery rates. With `--broker memory` everything runs
+in a single process, as the baseline for one worker.
+
+    python -m backend.benchmarks.event_bus --workers 4 --subscribers 50 --events 2000
+"""
+
+import argparse
+import asyncio
+import multiprocessing
+import os
+import tempfile
+import threading
+import time
+
+from backend.benchmarks.stats import format_summary, summarize
+from backend.broker import InProcessBroker, SQLiteBroker
+from backend.events import EventHub
+
+CHAT_ID = 1
+
+
+"""
+    Receiving every event on each subscription and recording its latency
+"""
+async def consume(hub: EventHub, subscribers: int, events: int, ready) -> list[float]:
+    subscriptions = [hub.subscribe(CHAT_ID) for _ in range(subscribers)]
+    ready()
+
+    async def receive(subscription):
+        latencies = []
+        for _ in range(events):
+            event = await subscription.get()
+            latencies.append(time.time() - event["sent_at"])
+        return latencies
+
+    results = await asyncio.gather(*(receive(subscription) for subscription in subscriptions))
+    return [latency for latencies in results for latency in latencies]
+
+
+"""
+    Publishing the events, optionally paced to a rate in events per second
+"""
+def publish(hub_or_broker, events: int, rate: float):
+    interval = 1 / rate if rate else 0
+    start = time.perf_counter()
+    for n in range(events):
+        if interval:
+            delay = start + n * interval - time.perf_counter()
+            if delay > 0:
+                time.sleep(delay)
+        hub_or_broker.publish(CHAT_ID, {"type": "benchmark", "n": n, "sent_at": time.time()})
+
+
+"""
+    A worker process subscribed through the SQLite broker
+"""
+def sqlite_worker(path: str, poll_interval: float, subscribers: int, events: int, ready, results):
+    async def run():
+        hub = EventHub(queue_size=events + 1)
+        hub.use_broker(SQLiteBroker(path, poll_interval=poll_interval))
+        try:
+            latencies = await consume(hub, subscribers, events, lambda: ready.put(os.getpid()))
+        finally:
+            hub.use_broker(InProcessBroker())
+        return latencies, time.time()
+
+    results.put(asyncio.run(run()))
+
+
+def run_sqlite(workers: int, subscribers: int, events: int, rate: float, poll_interval: float):
+    context = multiprocessing.get_context("spawn")
+    ready, results = context.Queue(), context.Queue()
+    with tempfile.TemporaryDirectory() as directory:
+        path = os.path.join(directory, "events.db")
+        publisher = SQLiteBroker(path, poll_interval=poll_interval)
+        publisher.start(lambda chat_id, event: None)
+
+        processes = [
+            context.Process(target=sqlite_worker, args=(path, poll_interval, subscribers, events, ready, results))
+            for _ in range(workers)
+        ]
+        for process in processes:
+            process.start()
+        for _ in processes:
+            ready.get(timeout=60)
+
+        started = time.time()
+        publish(publisher, events, rate)
+        published = time.time()
+        outcomes = [results.get(timeout=300) for _ in processes]
+        for process in processes:
+            process.join()
+        publisher.close()
+
+    latencies = [latency for worker_latencies, _ in outcomes for latency in worker_latencies]
+    finished = max(finished for _, finished in outcomes)
+    return latencies, started, published, finished
+
+
+def run_memory(subscribers: int, events: int, rate: float):
+    async def run():
+        hub = EventHub(queue_size=events + 1)
+        ready = threading.Event()
+        publisher = threading.Thread(target=lambda: (ready.wait(), publish(hub, events, rate)))
+        publisher.start()
+        started = time.time()
+        latencies = await consume(hub, subscribers, events, ready.set)
+        finished = time.time()
+        publisher.join()
+        return latencies, started, finished, finished
+
+    return asyncio.run(run())
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--broker", choices=["sqlite", "memory"], default="sqlite")
+    parser.add_argument("--workers", type=int, default=4, help="worker processes (sqlite broker only)")
+    parser.add_argument("--subscribers", type=int, default=50, help="subscribers per worker")
+    parser.add_argument("--events", type=int, default=2000, help="events to publish")
+    parser.add_argument("--rate", type=float, default=0, help="events per second to publish at, 0 for unpaced")
+    parser.add_argument("--poll-interval", type=float, default=0.005, help="seconds between data_version polls")
+    args = parser.parse_args()
+
+    if args.broker == "memory":
+        workers = 1
+        latencies, started, published, finished = run_memory(args.subscribers, args.events, args.rate)
+    else:
+        workers = args.workers
+        latencies, started, published, finished = run_sqlite(
+            args.workers, args.subscribers, args.events, args.rate, args.poll_interval
+        )
+
+    deliveries = args.events * workers * args.subscribers
+    print(f"broker={args.broker} workers={workers} subscribers/worker={args.subscribers} events={args.events}")
+    print(f"latency:    {format_summary(summarize(latencies))}")
+    print(f"published:  {args.events / max(published - started, 1e-9):,.0f} events/s")
+    print(f"delivered:  {deliveries / max(finished - started, 1e-9):,.0f} deliveries/s")
+
+
+if __name__ == "__main__":
+    main()
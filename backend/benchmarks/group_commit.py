@@ -0,0 +1,95 @@
+"""Throughput of posting messages with and without group commit.
+
+For each mode, seeds a fresh database (see `backend.benchmarks.dataset`), then has
+`--concurrency` clients post `--requests` messages between them, each to a random chat it is a
+member of, through the app in this process (httpx's ASGI transport) on an engine with the
+settings' pragmas and pool. "direct" commits every message in its own transaction, as the route
+does by default; "grouped" turns `message_group_commit` on, so one writer commits the messages
+in groups. Reports messages per second, latency percentiles and the size of the groups.
+
+    python -m backend.benchmarks.group_commit --concurrency 100 --requests 20000
+"""
+
+import argparse
+import asyncio
+import os
+import tempfile
+
+import httpx
+from sqlmodel.ext.asyncio.session import AsyncSession
+
+from backend import app, group_commit, hashing
+from backend import queries
+from backend.benchmarks import dataset, loadtest
+from backend.benchmarks.stats import format_summary, summarize
+from backend.database.engine import create_async_db_engine
+from backend.dependencies import get_session
+from backend.settings import Settings, settings
+
+
+"""
+    Posting the messages against a seeded database, returning the latencies, the time it took,
+    the errors and the size of every group committed
+"""
+async def run_mode(path: str, context: loadtest.Context, concurrency: int, requests: int, warmup: int) -> tuple:
+    engine = create_async_db_engine(Settings(database_url=f"sqlite:///{path}"))
+    groups = []
+    create_message_group = queries.create_message_group
+
+    def recording(session, messages):
+        groups.append(len(messages))
+        return create_message_group(session, messages)
+
+    async def get_benchmark_session():
+        async with AsyncSession(engine, expire_on_commit=False) as session:
+            yield session
+
+    app.dependency_overrides[get_session] = get_benchmark_session
+    queries.create_message_group = recording
+    transport = httpx.ASGITransport(app=app)
+    try:
+        async with httpx.AsyncClient(transport=transport, base_url="http://benchmark", timeout=300) as client:
+            if warmup:
+                await loadtest.load(client, loadtest.create_message, context, concurrency, warmup)
+            groups.clear()
+            return (*await loadtest.load(client, loadtest.create_message, context, concurrency, requests), groups)
+    finally:
+        await group_commit.close()
+        queries.create_message_group = create_message_group
+        app.dependency_overrides.clear()
+        await engine.dispose()
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--modes", nargs="+", choices=["direct", "grouped"], default=["direct", "grouped"])
+    parser.add_argument("--concurrency", type=int, default=100, help="clients posting at once")
+    parser.add_argument("--requests", type=int, default=20000, help="messages posted in each mode")
+    parser.add_argument("--warmup", type=int, default=1000, help="messages posted before timing")
+    parser.add_argument("--max-delay", type=float, default=settings.group_commit_max_delay, help="seconds the writer waits to fill a group")
+    parser.add_argument("--max-size", type=int, default=settings.group_commit_max_size, help="most messages in a group")
+    dataset.add_arguments(parser)
+    parser.set_defaults(preset="tiny", bcrypt_rounds=4)
+    args = parser.parse_args()
+    options = dataset.options_from(args)
+    settings.group_commit_max_delay = args.max_delay
+    settings.group_commit_max_size = args.max_size
+
+    for mode in args.modes:
+        settings.message_group_commit = mode == "grouped"
+        with tempfile.TemporaryDirectory() as directory:
+            path = os.path.join(directory, "benchmark.db")
+            dataset.seed(path, **options, progress=lambda line: None)
+            context = loadtest.Context(options, dataset.memberships(path), args.seed)
+            latencies, elapsed, errors, groups = asyncio.run(run_mode(path, context, args.concurrency, args.requests, args.warmup))
+        hashing.hasher.shutdown()
+
+        sizes = f" groups={len(groups):,} mean size={sum(groups) / len(groups):,.1f} max={max(groups)}" if groups else ""
+        print(
+            f"{mode:<8} concurrency={args.concurrency} {format_summary(summarize(latencies))} "
+            f"rate={len(latencies) / elapsed:,.0f} messages/s errors={errors}{sizes}"
+        )
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,286 @@
+"""Load test of the main API endpoints, with a JSON baseline to compare changes against.
+
+`run` seeds a dataset (see `backend.benchmarks.dataset`, reused when already seeded), then sends
+`--requests` requests to each endpoint from `--concurrency` concurrent clients, and reports
+throughput and latency percentiles per endpoint:
+
+    GET /chats/{chat_id}/messages    a page of a random chat's messages
+    POST /auth/token                 logging in as a random account
+    POST /chats/{chat_id}/messages   posting to a random chat as one of its members
+
+The requests go to the app in this process through httpx's ASGI transport (`--transport asgi`),
+or over real connections to `uvicorn` started on the seeded database (`--transport uvicorn`),
+or to a server already running on it (`--url`). `--output` writes the results as JSON, and
+`compare` flags the endpoints whose throughput or latency got worse than a baseline by more than
+`--threshold` percent, exiting with status 1 if any did.
+
+    python -m backend.benchmarks.loadtest run --preset small --output baseline.json
+    python -m backend.benchmarks.loadtest run --preset small --output current.json
+    python -m backend.benchmarks.loadtest compare baseline.json current.json
+"""
+
+import argparse
+import asyncio
+import json
+import os
+import platform
+import random
+import socket
+import subprocess
+import sys
+import time
+from datetime import datetime, timezone
+
+import httpx
+from jose import jwt
+from sqlalchemy.ext.asyncio import create_async_engine
+from sqlmodel.ext.asyncio.session import AsyncSession
+
+from backend import app, auth, hashing
+from backend.benchmarks import dataset
+from backend.benchmarks.stats import format_summary, summarize
+from backend.database.schema import DBAccount
+from backend.dependencies import get_session
+
+DEFAULT_PATH = "backend/database/loadtest.db"
+MESSAGE_PAGE = 50
+
+
+"""
+    What the requests need to know about the seeded data, and tokens for the accounts
+"""
+class Context:
+    def __init__(self, options: dict, memberships: list[tuple[int, int]], seed: int):
+        self.options = options
+        self.memberships = memberships
+        self.rng = random.Random(seed)
+        self.tokens: dict[int, str] = {}
+
+    def token(self, account_id: int) -> str:
+        if account_id not in self.tokens:
+            claims = auth.generate_claims(DBAccount(id=account_id))
+            self.tokens[account_id] = jwt.encode(claims.model_dump(), auth.JWT_SECRET_KEY, algorithm=auth.JWT_ALGORITHM)
+        return self.tokens[account_id]
+
+
+# Each endpoint makes the arguments of one request to it: method, url and httpx options
+def get_messages(context: Context) -> tuple:
+    chat_id = context.rng.randint(1, context.options["chats"])
+    return "GET", f"/chats/{chat_id}/messages", {"params": {"limit": MESSAGE_PAGE}}
+
+def login(context: Context) -> tuple:
+    account_id = context.rng.randint(1, context.options["accounts"])
+    return "POST", "/auth/token", {"data": {"username": f"user{account_id}", "password": dataset.PASSWORD}}
+
+def create_message(context: Context) -> tuple:
+    account_id, chat_id = context.rng.choice(context.memberships)
+    return "POST", f"/chats/{chat_id}/messages", {
+        "json": {"text": "load test message", "account_id": account_id},
+        "headers": {"Authorization": f"Bearer {context.token(account_id)}"},
+    }
+
+ENDPOINTS = {
+    "GET /chats/{chat_id}/messages": get_messages,
+    "POST /auth/token": login,
+    "POST /chats/{chat_id}/messages": create_message,
+}
+
+
+"""
+    Sending the requests to one endpoint from `concurrency` clients at once and timing each
+"""
+async def load(client: httpx.AsyncClient, endpoint, context: Context, concurrency: int, requests: int) -> tuple[list[float], float, int]:
+    remaining = requests
+    latencies = []
+    errors = 0
+
+    async def worker():
+        nonlocal remaining, errors
+        while remaining > 0:
+            remaining -= 1
+            method, url, options = endpoint(context)
+            start = time.perf_counter()
+            response = await client.request(method, url, **options)
+            latencies.append(time.perf_counter() - start)
+            if response.status_code >= 400:
+                errors += 1
+
+    started = time.perf_counter()
+    await asyncio.gather(*(worker() for _ in range(concurrency)))
+    return latencies, time.perf_counter() - started, errors
+
+
+async def run_endpoints(client: httpx.AsyncClient, context: Context, endpoints: list[str], concurrency: int, requests: int, warmup: int) -> dict:
+    results = {}
+    for name in endpoints:
+        if warmup:
+            await load(client, ENDPOINTS[name], context, concurrency, warmup)
+        latencies, elapsed, errors = await load(client, ENDPOINTS[name], context, concurrency, requests)
+        results[name] = {**summarize(latencies), "errors": errors, "rate_per_s": len(latencies) / elapsed}
+        print(f"{name:<32} {format_summary(results[name])} rate={results[name]['rate_per_s']:,.0f} req/s errors={errors}")
+    return results
+
+
+"""
+    Running against the app in this process, its sessions pointed at the seeded database
+"""
+async def run_asgi(path: str, context: Context, endpoints: list[str], concurrency: int, requests: int, warmup: int, pool_size: int) -> dict:
+    engine = create_async_engine(f"sqlite+aiosqlite:///{path}", pool_size=pool_size, max_overflow=0, pool_timeout=300)
+
+    async def get_loadtest_session():
+        async with AsyncSession(engine, expire_on_commit=False) as session:
+            yield session
+
+    app.dependency_overrides[get_session] = get_loadtest_session
+    hashing.hasher.rounds = context.options["rounds"]
+    transport = httpx.ASGITransport(app=app)
+    try:
+        async with httpx.AsyncClient(transport=transport, base_url="http://loadtest", timeout=300) as client:
+            return await run_endpoints(client, context, endpoints, concurrency, requests, warmup)
+    finally:
+        app.dependency_overrides.clear()
+        hashing.hasher.shutdown()
+        await engine.dispose()
+
+
+async def run_url(url: str, context: Context, endpoints: list[str], concurrency: int, requests: int, warmup: int) -> dict:
+    limits = httpx.Limits(max_connections=concurrency, max_keepalive_connections=concurrency)
+    async with httpx.AsyncClient(base_url=url, limits=limits, timeout=300) as client:
+        return await run_endpoints(client, context, endpoints, concurrency, requests, warmup)
+
+
+def _free_port() -> int:
+    with socket.socket() as sock:
+        sock.bind(("127.0.0.1", 0))
+        return sock.getsockname()[1]
+
+
+"""
+    Starting uvicorn on the seeded database and waiting until it answers
+"""
+def start_uvicorn(path: str, workers: int, rounds: int) -> tuple[subprocess.Popen, str]:
+    port = _free_port()
+    env = {**os.environ, "DATABASE_URL": f"sqlite:///{path}", "BCRYPT_ROUNDS": str(rounds)}
+    server = subprocess.Popen(
+        [sys.executable, "-m", "uvicorn", "backend:app", "--port", str(port), "--workers", str(workers), "--log-level", "warning"],
+        env=env,
+    )
+    url = f"http://127.0.0.1:{port}"
+    deadline = time.monotonic() + 60
+    while time.monotonic() < deadline:
+        try:
+            if httpx.get(f"{url}/status").status_code == 204:
+                return server, url
+        except httpx.TransportError:
+            pass
+        if server.poll() is not None:
+            raise RuntimeError("uvicorn exited before answering")
+        time.sleep(0.2)
+    server.terminate()
+    raise RuntimeError("uvicorn didn't answer within 60 seconds")
+
+
+def _git_commit() -> str | None:
+    try:
+        return subprocess.run(["git", "rev-parse", "HEAD"], capture_output=True, text=True, check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def run(args):
+    options = dataset.seed(args.path, **dataset.options_from(args))
+    context = Context(options, dataset.memberships(args.path), args.seed)
+    endpoints = args.endpoints or list(ENDPOINTS)
+    print(f"transport={args.url or args.transport} concurrency={args.concurrency} requests={args.requests} dataset={options}")
+
+    if args.url:
+        results = asyncio.run(run_url(args.url, context, endpoints, args.concurrency, args.requests, args.warmup))
+    elif args.transport == "uvicorn":
+        server, url = start_uvicorn(args.path, args.workers, options["rounds"])
+        try:
+            results = asyncio.run(run_url(url, context, endpoints, args.concurrency, args.requests, args.warmup))
+        finally:
+            server.terminate()
+            server.wait()
+    else:
+        results = asyncio.run(run_asgi(args.path, context, endpoints, args.concurrency, args.requests, args.warmup, args.pool_size))
+
+    if args.output:
+        report = {
+            "meta": {
+                "created_at": datetime.now(timezone.utc).isoformat(),
+                "commit": _git_commit(),
+                "python": platform.python_version(),
+                "transport": args.url or args.transport,
+                "workers": args.workers if args.transport == "uvicorn" else 1,
+                "concurrency": args.concurrency,
+                "requests": args.requests,
+                "dataset": options,
+            },
+            "endpoints": results,
+        }
+        with open(args.output, "w") as file:
+            json.dump(report, file, indent=2)
+
+
+"""
+    Comparing results against a baseline: an endpoint regressed when its throughput dropped or
+    one of its latency percentiles rose by more than threshold percent
+"""
+def compare(baseline: dict, current: dict, threshold: float) -> list[str]:
+    regressions = []
+    for name, before in baseline["endpoints"].items():
+        after = current["endpoints"].get(name)
+        if after is None:
+            continue
+        changes = {"rate_per_s": (after["rate_per_s"] / before["rate_per_s"] - 1) * 100}
+        for field in ("p50_ms", "p95_ms", "p99_ms"):
+            changes[field] = (after[field] / before[field] - 1) * 100
+        worse = [
+            field for field, change in changes.items()
+            if (change < -threshold if field == "rate_per_s" else change > threshold)
+        ]
+        print(f"{name:<32} " + " ".join(f"{field}={change:+.1f}%" for field, change in changes.items()) + ("  REGRESSED" if worse else ""))
+        regressions += [f"{name} {field}" for field in worse]
+    return regressions
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    commands = parser.add_subparsers(dest="command", required=True)
+
+    run_parser = commands.add_parser("run", help="seed the dataset and load the endpoints")
+    run_parser.add_argument("--path", default=DEFAULT_PATH, help="database file to seed and load")
+    dataset.add_arguments(run_parser)
+    run_parser.add_argument("--endpoints", nargs="+", choices=ENDPOINTS, help="endpoints to load, all by default")
+    run_parser.add_argument("--concurrency", type=int, default=50, help="concurrent clients")
+    run_parser.add_argument("--requests", type=int, default=2000, help="requests per endpoint")
+    run_parser.add_argument("--warmup", type=int, default=100, help="untimed requests per endpoint first")
+    run_parser.add_argument("--transport", choices=["asgi", "uvicorn"], default="asgi", help="in-process or over a socket")
+    run_parser.add_argument("--workers", type=int, default=1, help="uvicorn workers")
+    run_parser.add_argument("--pool-size", type=int, default=20, help="database connections, in process")
+    run_parser.add_argument("--url", help="load a server already running on the seeded database instead")
+    run_parser.add_argument("--output", help="write the results to this JSON file")
+
+    compare_parser = commands.add_parser("compare", help="compare results against a baseline")
+    compare_parser.add_argument("baseline", help="results to compare against")
+    compare_parser.add_argument("current", help="results of the change")
+    compare_parser.add_argument("--threshold", type=float, default=10.0, help="percent change that counts as a regression")
+    args = parser.parse_args()
+
+    if args.command == "run":
+        run(args)
+        return
+
+    with open(args.baseline) as file:
+        baseline = json.load(file)
+    with open(args.current) as file:
+        current = json.load(file)
+    regressions = compare(baseline, current, args.threshold)
+    if regressions:
+        print(f"{len(regressions)} regression(s) beyond {args.threshold}%: " + ", ".join(regressions))
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,72 @@
+"""Microbenchmark of login latency at each bcrypt cost factor.
+
+For every cost, seeds an in-memory database with one account hashed at that cost and logs in
+through `auth.generate_token` the given number of times, from `--concurrency` threads sharing a
+password hashing pool of `--workers` processes (0 hashes in the calling thread). Reports the
+login latency percentiles and throughput per cost.
+
+    python -m backend.benchmarks.login --costs 4 8 10 12 --logins 50 --concurrency 4
+"""
+
+import argparse
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+from sqlmodel import Session, SQLModel, StaticPool, create_engine
+
+from backend import auth, hashing
+from backend.benchmarks.stats import format_summary, summarize
+from backend.database.schema import DBAccount
+from backend.models import Login
+
+USERNAME = "benchmark"
+PASSWORD = "benchmark-password"
+
+
+"""
+    Timing the logins against one cost factor
+"""
+def run_cost(rounds: int, logins: int, concurrency: int, workers: int) -> tuple[list[float], float]:
+    engine = create_engine("sqlite://", connect_args={"check_same_thread": False}, poolclass=StaticPool)
+    SQLModel.metadata.create_all(engine)
+
+    hasher = hashing.PasswordHasher(workers, queue_size=concurrency, retry_after=1, rounds=rounds)
+    previous, hashing.hasher = hashing.hasher, hasher
+    try:
+        with Session(engine) as session:
+            session.add(DBAccount(username=USERNAME, email=USERNAME, hashed_password=hasher.hash(PASSWORD)))
+            session.commit()
+
+        def login(_) -> float:
+            start = time.perf_counter()
+            with Session(engine) as session:
+                auth.generate_token(session, Login(username=USERNAME, password=PASSWORD))
+            return time.perf_counter() - start
+
+        started = time.perf_counter()
+        with ThreadPoolExecutor(max_workers=concurrency) as pool:
+            latencies = list(pool.map(login, range(logins)))
+        elapsed = time.perf_counter() - started
+    finally:
+        hashing.hasher = previous
+        hasher.shutdown()
+        engine.dispose()
+    return latencies, elapsed
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--costs", type=int, nargs="+", default=[4, 8, 10, 12], help="bcrypt cost factors")
+    parser.add_argument("--logins", type=int, default=50, help="logins per cost")
+    parser.add_argument("--concurrency", type=int, default=1, help="threads logging in at once")
+    parser.add_argument("--workers", type=int, default=0, help="hashing processes, 0 for the calling thread")
+    args = parser.parse_args()
+
+    print(f"logins={args.logins} concurrency={args.concurrency} workers={args.workers}")
+    for rounds in args.costs:
+        latencies, elapsed = run_cost(rounds, args.logins, args.concurrency, args.workers)
+        print(f"cost={rounds:<2} {format_summary(summarize(latencies))} rate={args.logins / elapsed:,.1f} logins/s")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,114 @@
+"""Throughput of the default and tuned SQLite profiles.
+
+For each profile, seeds a fresh database file and runs a mixed workload from several threads for
+a fixed time: writers post messages through `queries.create_message` (with its change log and
+version counter) and readers fetch pages through `queries.get_messages`. The "default" profile
+leaves every pragma at SQLite's default (rollback journal, synchronous=FULL); "tuned" applies
+the pragmas from the settings. Reports operations per second, latency and the number of
+operations that failed, e.g. on "database is locked".
+
+    python -m backend.benchmarks.pragmas --writers 4 --readers 8 --seconds 10
+"""
+
+import argparse
+import os
+import tempfile
+import threading
+import time
+
+from sqlmodel import Session, SQLModel
+
+from backend import queries
+from backend.benchmarks.stats import format_summary, summarize
+from backend.database.engine import PRAGMAS, create_db_engine
+from backend.database.schema import DBAccount, DBChat, DBChatMembership
+from backend.settings import Settings
+
+CHAT_ID = 1
+
+
+"""
+    The settings of a profile, for a database file
+"""
+def profile_settings(profile: str, path: str, pool_size: int) -> Settings:
+    options = {"database_url": f"sqlite:///{path}", "database_pool_size": pool_size, "database_max_overflow": 0}
+    if profile == "default":
+        options.update({field: None for field in PRAGMAS.values()})
+    return Settings(**options)
+
+
+def seed(engine, messages: int):
+    SQLModel.metadata.create_all(engine)
+    with Session(engine) as session:
+        session.add(DBAccount(id=1, username="benchmark", email="benchmark", hashed_password="-"))
+        session.add(DBChat(id=CHAT_ID, name="benchmark", owner_id=1))
+        session.add(DBChatMembership(account_id=1, chat_id=CHAT_ID))
+        session.commit()
+        for n in range(messages):
+            queries.create_message(session, CHAT_ID, f"message {n}", 1)
+
+
+"""
+    Running writers and readers against the engine until the time is up
+"""
+def run_workload(engine, writers: int, readers: int, seconds: float, limit: int) -> dict:
+    deadline = time.perf_counter() + seconds
+    results = {"write": ([], [0]), "read": ([], [0])}
+
+    def write():
+        latencies, errors = results["write"]
+        while time.perf_counter() < deadline:
+            start = time.perf_counter()
+            try:
+                with Session(engine) as session:
+                    queries.create_message(session, CHAT_ID, "benchmark", 1)
+                latencies.append(time.perf_counter() - start)
+            except Exception:
+                errors[0] += 1
+
+    def read():
+        latencies, errors = results["read"]
+        while time.perf_counter() < deadline:
+            start = time.perf_counter()
+            try:
+                with Session(engine) as session:
+                    queries.get_messages(session, CHAT_ID, limit=limit)
+                latencies.append(time.perf_counter() - start)
+            except Exception:
+                errors[0] += 1
+
+    threads = [threading.Thread(target=write) for _ in range(writers)]
+    threads += [threading.Thread(target=read) for _ in range(readers)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    return results
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--profiles", nargs="+", choices=["default", "tuned"], default=["default", "tuned"])
+    parser.add_argument("--writers", type=int, default=4, help="threads posting messages")
+    parser.add_argument("--readers", type=int, default=8, help="threads reading pages of messages")
+    parser.add_argument("--seconds", type=float, default=10, help="duration of each profile's run")
+    parser.add_argument("--messages", type=int, default=1000, help="messages seeded before the run")
+    parser.add_argument("--limit", type=int, default=50, help="messages per page read")
+    args = parser.parse_args()
+
+    for profile in args.profiles:
+        with tempfile.TemporaryDirectory() as directory:
+            engine = create_db_engine(profile_settings(profile, os.path.join(directory, "benchmark.db"), args.writers + args.readers))
+            seed(engine, args.messages)
+            results = run_workload(engine, args.writers, args.readers, args.seconds, args.limit)
+            engine.dispose()
+
+        for operation, (latencies, errors) in results.items():
+            print(
+                f"{profile:<8} {operation:<6} {format_summary(summarize(latencies))} "
+                f"rate={len(latencies) / args.seconds:,.0f} ops/s errors={errors[0]}"
+            )
+
+
+if __name__ == "__main__":
+    main()
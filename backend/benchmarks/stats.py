@@ -0,0 +1,39 @@
+"""Summary statistics shared by the benchmarks."""
+
+import math
+
+
+"""
+    Getting the q-th percentile (0-100) of the values by the nearest-rank method
+"""
+def percentile(values: list[float], q: float) -> float:
+    if not values:
+        return math.nan
+    ordered = sorted(values)
+    rank = max(math.ceil(q / 100 * len(ordered)), 1)
+    return ordered[rank - 1]
+
+
+"""
+    Summarizing latencies given in seconds as milliseconds
+"""
+def summarize(latencies: list[float]) -> dict:
+    ms = [latency * 1000 for latency in latencies]
+    return {
+        "count": len(ms),
+        "mean_ms": sum(ms) / len(ms) if ms else math.nan,
+        "p50_ms": percentile(ms, 50),
+        "p95_ms": percentile(ms, 95),
+        "p99_ms": percentile(ms, 99),
+        "max_ms": max(ms) if ms else math.nan,
+    }
+
+
+"""
+    Formatting a latency summary on one line
+"""
+def format_summary(summary: dict) -> str:
+    return (
+        f"n={summary['count']} mean={summary['mean_ms']:.2f}ms p50={summary['p50_ms']:.2f}ms "
+        f"p95={summary['p95_ms']:.2f}ms p99={summary['p99_ms']:.2f}ms max={summary['max_ms']:.2f}ms"
+    )
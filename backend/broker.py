@@ -0,0 +1,175 @@
+"""Brokers that carry chat events between the worker processes serving the API.
+
+Every broker hands the events it receives to a deliver callback, which the event hub points
+at its local fan-out. The in-process broker delivers straight away; the SQLite broker also
+appends each event to a shared log that the other workers poll.
+"""
+
+import json
+import logging
+import os
+import queue
+import sqlite3
+import threading
+import time
+import uuid
+from abc import ABC, abstractmethod
+from typing import Callable
+
+from backend.settings import Settings
+
+logger = logging.getLogger(__name__)
+
+Deliver = Callable[[int, dict], None]
+
+
+"""
+    Interface of an event broker
+"""
+class Broker(ABC):
+    def start(self, deliver: Deliver):
+        self.deliver = deliver
+
+    @abstractmethod
+    def publish(self, chat_id: int, event: dict):
+        ...
+
+    def close(self):
+        pass
+
+
+"""
+    Broker for a single worker process, events never leave it
+"""
+class InProcessBroker(Broker):
+    def publish(self, chat_id: int, event: dict):
+        self.deliver(chat_id, event)
+
+
+"""
+    Broker for several worker processes on one machine, sharing an append-only log in a SQLite
+    database. Events are delivered locally right away and queued for the broker's thread, which
+    appends them to the log, so publishing never waits on the log's lock. The same thread watches
+    `PRAGMA data_version`, which changes whenever another connection commits, and only then
+    reads the new rows written by the other processes. Rows older than the retention window are
+    pruned by whichever worker gets there.
+"""
+class SQLiteBroker(Broker):
+    def __init__(self, path: str, poll_interval: float = 0.005, retention: float = 60.0):
+        self.path = path
+        self.poll_interval = poll_interval
+        self.retention = retention
+        self.origin = f"{os.getpid()}-{uuid.uuid4().hex}"
+        self._outbox: queue.SimpleQueue = queue.SimpleQueue()
+        self._stopped = threading.Event()
+        self._thread: threading.Thread | None = None
+
+    def _connect(self) -> sqlite3.Connection:
+        conn = sqlite3.connect(self.path, timeout=5, isolation_level=None, check_same_thread=False)
+        conn.execute("PRAGMA journal_mode=WAL")
+        conn.execute("PRAGMA synchronous=NORMAL")
+        return conn
+
+    def start(self, deliver: Deliver):
+        super().start(deliver)
+        self._writer = self._connect()
+        self._writer.execute(
+            "CREATE TABLE IF NOT EXISTS events ("
+            "id INTEGER PRIMARY KEY AUTOINCREMENT, "
+            "origin TEXT NOT NULL, "
+            "chat_id INTEGER NOT NULL, "
+            "payload TEXT NOT NULL, "
+            "created_at REAL NOT NULL)"
+        )
+        self._reader = self._connect()
+        self._last_id = self._reader.execute("SELECT coalesce(max(id), 0) FROM events").fetchone()[0]
+        self._thread = threading.Thread(target=self._poll, name="sqlite-event-broker", daemon=True)
+        self._thread.start()
+
+    def publish(self, chat_id: int, event: dict):
+        self.deliver(chat_id, event)
+        self._outbox.put((self.origin, chat_id, json.dumps(event), time.time()))
+
+    # A failed round is logged and the next one tries again, so the thread outlives a locked or
+    # briefly unavailable log
+    def _poll(self):
+        self._data_version = None
+        self._last_prune = time.monotonic()
+        while not self._stopped.wait(self.poll_interval):
+            try:
+                self._poll_round()
+            except Exception:
+                logger.exception("Event broker poll failed, retrying")
+        self._write_events()
+
+    def _poll_round(self):
+        self._write_events()
+        current = self._reader.execute("PRAGMA data_version").fetchone()[0]
+        if current != self._data_version:
+            self._read_new_events()
+            # Only once read, so a failed read is retried even if nothing else is written
+            self._data_version = current
+        if time.monotonic() - self._last_prune > self.retention:
+            self._last_prune = time.monotonic()
+            self._prune()
+
+    # Appending the events published since the last round in one transaction
+    def _write_events(self):
+        rows = []
+        while True:
+            try:
+                rows.append(self._outbox.get_nowait())
+            except queue.Empty:
+                break
+        if not rows:
+            return
+        try:
+            self._writer.execute("BEGIN IMMEDIATE")
+            self._writer.executemany(
+                "INSERT INTO events (origin, chat_id, payload, created_at) VALUES (?, ?, ?, ?)",
+                rows,
+            )
+            self._writer.execute("COMMIT")
+        except sqlite3.Error:
+            # The other workers miss these events, the local subscribers already have them
+            logger.exception("Couldn't append %d events to the log", len(rows))
+            try:
+                if self._writer.in_transaction:
+                    self._writer.execute("ROLLBACK")
+            except sqlite3.Error:
+                logger.exception("Couldn't roll back the failed append")
+
+    def _read_new_events(self):
+        rows = self._reader.execute(
+            "SELECT id, origin, chat_id, payload FROM events WHERE id > ? ORDER BY id",
+            (self._last_id,),
+        ).fetchall()
+        for id, origin, chat_id, payload in rows:
+            self._last_id = id
+            if origin != self.origin:
+                self.deliver(chat_id, json.loads(payload))
+
+    def _prune(self):
+        self._writer.execute("DELETE FROM events WHERE created_at < ?", (time.time() - self.retention,))
+
+    def close(self):
+        self._stopped.set()
+        if self._thread is not None:
+            self._thread.join()
+            self._reader.close()
+            self._writer.close()
+
+
+"""
+    Creating the broker selected in the settings
+"""
+def create_broker(settings: Settings) -> Broker:
+    if settings.event_broker == "memory":
+        return InProcessBroker()
+    if settings.event_broker == "sqlite":
+        return SQLiteBroker(
+            settings.event_broker_path,
+            poll_interval=settings.event_broker_poll_interval,
+            retention=settings.event_broker_retention,
+        )
+    raise ValueError(f"Unknown event broker: {settings.event_broker}")
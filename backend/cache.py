@@ -0,0 +1,73 @@
+"""Bounded in-process caches for the authentication path.
+
+Args:
+    token_cache (TTLCache): Access token to its verified claims, kept no longer than the token is valid
+    account_cache (TTLCache): Account id to a detached copy of the account
+
+Each worker process has its own caches. Account changes invalidate the entry in the worker that
+made them; the other workers catch up once the entry expires, so keep `account_cache_ttl` short.
+"""
+
+import threading
+import time
+from collections import OrderedDict
+
+from backend.settings import settings
+
+
+"""
+    A least-recently-used cache whose entries also expire after a time to live, with hit and
+    miss counters. Safe to use from the threadpool that sync routes run in. Times come from
+    clock, in seconds, so tests can move it on instead of waiting.
+"""
+class TTLCache:
+    def __init__(self, maxsize: int, ttl: float, clock=time.monotonic):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self.clock = clock
+        self._entries: OrderedDict = OrderedDict()
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, key):
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None:
+                value, expires_at = entry
+                if expires_at > self.clock():
+                    self._entries.move_to_end(key)
+                    self.hits += 1
+                    return value
+                del self._entries[key]
+            self.misses += 1
+            return None
+
+    # An entry lives for the cache's ttl, or less when the value itself expires sooner
+    def set(self, key, value, ttl: float | None = None):
+        ttl = self.ttl if ttl is None else min(ttl, self.ttl)
+        if ttl <= 0 or self.maxsize <= 0:
+            return
+        with self._lock:
+            self._entries[key] = (value, self.clock() + ttl)
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.maxsize:
+                self._entries.popitem(last=False)
+
+    def invalidate(self, key):
+        with self._lock:
+            self._entries.pop(key, None)
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+            self.hits = 0
+            self.misses = 0
+
+    def stats(self) -> dict:
+        with self._lock:
+            return {"size": len(self._entries), "maxsize": self.maxsize, "hits": self.hits, "misses": self.misses}
+
+
+token_cache = TTLCache(settings.token_cache_size, settings.token_cache_ttl)
+account_cache = TTLCache(settings.account_cache_size, settings.account_cache_ttl)
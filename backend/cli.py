@@ -0,0 +1,137 @@
+"""Maintenance commands for the PonyExpress backend.
+
+    python -m backend.cli rebuild-search-index --batch-size 5000
+    python -m backend.cli generate-data --accounts 100000 --chats 10000 --messages 10000000
+    python -m backend.cli import-history history.ndjson.gz --chat-id 12 --authors authors.csv
+    python -m backend.cli retry-jobs --kind purge_chat
+"""
+
+import argparse
+from datetime import datetime
+
+from sqlmodel import Session
+
+from backend import datagen, importer
+from backend import queries as db
+from backend.dependencies import create_db_tables, engine
+from backend.settings import settings
+
+
+"""
+    Creating the search index if needed and reindexing every message into it
+"""
+def rebuild_search_index(args: argparse.Namespace):
+    create_db_tables()
+    if args.queue:
+        with Session(engine) as session:
+            job = db.enqueue_job(session, db.REBUILD_SEARCH_INDEX)
+            session.commit()
+            print(f"queued as job {job.id}, follow it at /jobs/{job.id}")
+        return
+
+    def progress(indexed: int, through: int, head: int):
+        print(f"indexed {indexed} messages, through id {through} of {head}")
+
+    with Session(engine) as session:
+        indexed = db.rebuild_message_search(session, args.batch_size, progress)
+    print(f"done: {indexed} messages indexed")
+
+
+"""
+    Adding a synthetic dataset to the database, see backend.datagen
+"""
+def generate_data(args: argparse.Namespace):
+    create_db_tables()
+    counts = datagen.generate(
+        engine,
+        accounts=args.accounts,
+        chats=args.chats,
+        messages=args.messages,
+        members=args.members,
+        chat_size_skew=args.chat_size_skew,
+        author_skew=args.author_skew,
+        start=args.start,
+        end=args.end,
+        password=args.password,
+        rounds=args.bcrypt_rounds,
+        seed=args.seed,
+        batch_size=args.batch_size,
+    )
+    print("done: " + ", ".join(f"{count:,} {table}" for table, count in counts.items()))
+
+
+"""
+    Importing chat history from an NDJSON file, see backend.importer
+"""
+def import_history(args: argparse.Namespace):
+    create_db_tables()
+    authors = importer.AuthorLookup(importer.read_author_map(args.authors) if args.authors else None)
+    counts = importer.import_file(
+        engine,
+        args.path,
+        args.chat_id,
+        source=args.source,
+        authors=authors,
+        batch_size=args.batch_size,
+        restart=args.restart,
+    )
+    print("done: " + ", ".join(f"{count:,} {name.replace('_', ' ')}" for name, count in counts.items()))
+
+
+"""
+    Queueing failed background jobs again, see backend.jobs
+"""
+def retry_jobs(args: argparse.Namespace):
+    create_db_tables()
+    with Session(engine) as session:
+        ids = db.retry_jobs(session, args.job_ids or None, args.kind)
+    if not ids:
+        print("no failed jobs to retry")
+        return
+    print(f"queued {len(ids)} failed jobs again: " + ", ".join(str(id) for id in ids))
+
+
+def main(argv: list[str] | None = None):
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    commands = parser.add_subparsers(dest="command", required=True)
+
+    rebuild = commands.add_parser("rebuild-search-index", help="reindex every message for full-text search")
+    rebuild.add_argument("--batch-size", type=int, default=db.SEARCH_REBUILD_BATCH_SIZE, help="messages per transaction")
+    rebuild.add_argument("--queue", action="store_true", help="leave the rebuild to the server's job workers")
+    rebuild.set_defaults(run=rebuild_search_index)
+
+    generate = commands.add_parser("generate-data", help="add a large synthetic dataset")
+    generate.add_argument("--accounts", type=int, default=10_000, help="accounts to add")
+    generate.add_argument("--chats", type=int, default=1_000, help="chats to add")
+    generate.add_argument("--messages", type=int, default=1_000_000, help="messages to add")
+    generate.add_argument("--members", type=int, default=50, help="average members per chat")
+    generate.add_argument("--chat-size-skew", type=float, default=1.0, help="Zipf exponent of chat sizes, 0 for uniform")
+    generate.add_argument("--author-skew", type=float, default=1.0, help="Zipf exponent of how much each account writes, 0 for uniform")
+    generate.add_argument("--start", type=datetime.fromisoformat, default=datetime(2024, 1, 1), help="timestamp of the first message")
+    generate.add_argument("--end", type=datetime.fromisoformat, default=datetime(2025, 1, 1), help="timestamp after the last message")
+    generate.add_argument("--password", default="password", help="password of every account")
+    generate.add_argument("--bcrypt-rounds", type=int, default=settings.bcrypt_rounds, help="cost of the password hash")
+    generate.add_argument("--seed", type=int, default=0, help="random seed")
+    generate.add_argument("--batch-size", type=int, default=datagen.BATCH_SIZE, help="rows per transaction")
+    generate.set_defaults(run=generate_data)
+
+    history = commands.add_parser("import-history", help="import a chat's history from an NDJSON file")
+    history.add_argument("path", help="NDJSON file, gzip or not")
+    history.add_argument("--chat-id", type=int, required=True, help="chat to import the messages into")
+    history.add_argument("--authors", help="CSV file mapping the file's author ids to usernames")
+    history.add_argument("--source", help="name of the import's checkpoint, the file's path by default")
+    history.add_argument("--batch-size", type=int, default=db.IMPORT_BATCH_SIZE, help="messages per transaction")
+    history.add_argument("--restart", action="store_true", help="import from the start, ignoring a checkpoint that has no messages in")
+    history.set_defaults(run=import_history)
+
+    retry = commands.add_parser("retry-jobs", help="queue failed background jobs again")
+    retry.add_argument("job_ids", nargs="*", type=int, help="jobs to retry, every failed job by default")
+    retry.add_argument("--kind", help="only retry the failed jobs of this kind, e.g. purge_chat")
+    retry.set_defaults(run=retry_jobs)
+
+    args = parser.parse_args(argv)
+    args.run(args)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,48 @@
+"""Conditional GETs for the list routes.
+
+Each list is covered by a version counter that the mutation functions in queries.py bump, so
+its ETag can be computed, and an unchanged poll answered with 304 Not Modified, without
+running the list query.
+"""
+
+import hashlib
+
+from fastapi.requests import Request
+from fastapi.responses import Response
+
+
+"""
+    Building a strong ETag from a version counter and the query string of the request, since
+    the query parameters select which page of the list is returned
+"""
+def make_etag(request: Request, key: str, version: int) -> str:
+    etag = f"{key}.{version}"
+    if request.query_params:
+        query = "&".join(sorted(f"{name}={value}" for name, value in request.query_params.multi_items()))
+        etag += "." + hashlib.blake2s(query.encode("utf-8"), digest_size=8).hexdigest()
+    return f'"{etag}"'
+
+
+"""
+    Checking whether the client already holds the representation tagged with etag
+"""
+def is_not_modified(request: Request, etag: str) -> bool:
+    header = request.headers.get("if-none-match")
+    if header is None:
+        return False
+    # If-None-Match uses the weak comparison, so a W/ prefix doesn't matter
+    return any(candidate.strip().removeprefix("W/") == etag for candidate in header.split(","))
+
+
+"""
+    Tagging a full response so that the client can revalidate it on its next request
+"""
+def set_etag(response: Response, etag: str):
+    response.headers["ETag"] = etag
+    response.headers["Cache-Control"] = "no-cache"
+
+
+def not_modified(etag: str) -> Response:
+    response = Response(status_code=304)
+    set_etag(response, etag)
+    return response
@@ -0,0 +1,105 @@
+"""Creating the database engines from the settings.
+
+SQLite keeps most of its tuning per connection, so the configured pragmas are applied to every
+new connection through the engine's `connect` event, on the sync and the async engine alike.
+"""
+
+from sqlalchemy import Engine, event
+from sqlalchemy.engine import make_url
+from sqlalchemy.ext.asyncio import AsyncEngine, create_async_engine
+from sqlmodel import create_engine
+
+from backend.settings import Settings
+
+# Applied in this order: journal_mode first, since the others may depend on the journal
+PRAGMAS = {
+    "journal_mode": "sqlite_journal_mode",
+    "synchronous": "sqlite_synchronous",
+    "mmap_size": "sqlite_mmap_size",
+    "cache_size": "sqlite_cache_size",
+    "busy_timeout": "sqlite_busy_timeout",
+    "temp_store": "sqlite_temp_store",
+    "foreign_keys": "sqlite_foreign_keys",
+}
+
+
+"""
+    Getting the pragmas the settings ask for, leaving out the ones left at SQLite's default
+"""
+def sqlite_pragmas(settings: Settings) -> dict[str, str | int]:
+    pragmas = {}
+    for pragma, field in PRAGMAS.items():
+        value = getattr(settings, field)
+        if value is None or value == "":
+            continue
+        if isinstance(value, bool):
+            value = "ON" if value else "OFF"
+        pragmas[pragma] = value
+    return pragmas
+
+
+"""
+    Running the pragmas on every connection the engine opens
+"""
+def apply_pragmas(engine: Engine, pragmas: dict[str, str | int]):
+    if not pragmas:
+        return
+
+    @event.listens_for(engine, "connect")
+    def _set_pragmas(dbapi_connection, connection_record):
+        cursor = dbapi_connection.cursor()
+        try:
+            for pragma, value in pragmas.items():
+                cursor.execute(f"PRAGMA {pragma} = {value}")
+        finally:
+            cursor.close()
+
+
+"""
+    Getting the keyword arguments for the connection pool; an in-memory database lives in a
+    single connection, so it keeps SQLAlchemy's pool for it
+"""
+def _pool_options(url: str, settings: Settings) -> dict:
+    database = make_url(url).database
+    if database in (None, "", ":memory:"):
+        return {}
+    return {"pool_size": settings.database_pool_size, "max_overflow": settings.database_max_overflow}
+
+
+"""
+    Getting the URL of the same database for the async driver
+"""
+def async_database_url(url: str) -> str:
+    url = make_url(url)
+    if url.get_backend_name() == "sqlite":
+        url = url.set(drivername="sqlite+aiosqlite")
+    return url.render_as_string(hide_password=False)
+
+
+"""
+    Creating the sync engine, used outside of requests
+"""
+def create_db_engine(settings: Settings) -> Engine:
+    engine = create_engine(
+        settings.database_url,
+        echo=settings.database_echo,
+        **_pool_options(settings.database_url, settings),
+    )
+    if engine.dialect.name == "sqlite":
+        apply_pragmas(engine, sqlite_pragmas(settings))
+    return engine
+
+
+"""
+    Creating the async engine the routes use
+"""
+def create_async_db_engine(settings: Settings) -> AsyncEngine:
+    url = async_database_url(settings.database_url)
+    engine = create_async_engine(
+        url,
+        echo=settings.database_echo,
+        **_pool_options(url, settings),
+    )
+    if engine.dialect.name == "sqlite":
+        apply_pragmas(engine.sync_engine, sqlite_pragmas(settings))
+    return engine
@@ -2,6 +2,7 @@
 
 from datetime import datetime
 
+from sqlalchemy import DDL, Index, event
 from sqlmodel import Field, Relationship, SQLModel
 
 
@@ -14,12 +15,14 @@ class DBAccount(SQLModel, table=True):
     email: str = Field(unique=True)
     hashed_password: str
 
-    # relationships
-    owned_chats: list["DBChat"] = Relationship(back_populates="owner")
-    messages: list["DBMessage"] = Relationship(back_populates="account")
+    # relationships; deletes are left to the foreign keys' ON DELETE, so the ORM never loads
+    # the rows they cascade to
+    owned_chats: list["DBChat"] = Relationship(back_populates="owner", passive_deletes="all")
+    messages: list["DBMessage"] = Relationship(back_populates="account", passive_deletes=True)
     memberships: list["DBChatMembership"] = Relationship(
         back_populates="account",
         cascade_delete=True,
+        passive_deletes=True,
     )
 
 
@@ -28,23 +31,31 @@ class DBChat(SQLModel, table=True):
 
     # fields
     id: int | None = Field(default=None, primary_key=True)
-    name: str
-    owner_id: int = Field(foreign_key="accounts.id", ondelete="RESTRICT")
+    name: str = Field(index=True)
+    owner_id: int = Field(foreign_key="accounts.id", ondelete="RESTRICT", index=True)
 
     # relationships
     owner: DBAccount = Relationship(back_populates="owned_chats")
     messages: list["DBMessage"] = Relationship(
         back_populates="chat",
         cascade_delete=True,
+        passive_deletes=True,
     )
     memberships: list["DBChatMembership"] = Relationship(
         back_populates="chat",
         cascade_delete=True,
+        passive_deletes=True,
     )
 
 
 class DBMessage(SQLModel, table=True):
     __tablename__ = "messages"  # type: ignore
+    __table_args__ = (
+        # keyset pagination over a chat's messages
+        Index("ix_messages_chat_id_id", "chat_id", "id"),
+        # clearing an account's messages when it leaves a chat
+        Index("ix_messages_chat_id_account_id", "chat_id", "account_id"),
+    )
 
     # fields
     id: int | None = Field(default=None, primary_key=True)
@@ -53,6 +64,7 @@ class DBMessage(SQLModel, table=True):
         default=None,
         foreign_key="accounts.id",
         ondelete="SET NULL",
+        index=True,
     )
     chat_id: int = Field(
         foreign_key="chats.id",
@@ -67,6 +79,10 @@ class DBMessage(SQLModel, table=True):
 
 class DBChatMembership(SQLModel, table=True):
     __tablename__ = "chat_memberships"  # type: ignore
+    __table_args__ = (
+        # the primary key leads with account_id, this serves lookups by chat
+        Index("ix_chat_memberships_chat_id_account_id", "chat_id", "account_id"),
+    )
 
     # fields
     account_id: int = Field(
@@ -82,4 +98,104 @@ class DBChatMembership(SQLModel, table=True):
 
     # relationships
     account: DBAccount = Relationship(back_populates="memberships")
-    chat: DBChat = Relationship(back_populates="memberships")
\ No newline at end of file
+    chat: DBChat = Relationship(back_populates="memberships")
+
+
+class DBVersion(SQLModel, table=True):
+    __tablename__ = "versions"  # type: ignore
+
+    # fields
+    key: str = Field(primary_key=True)
+    version: int = 0
+
+
+
+class DBChange(SQLModel, table=True):
+    __tablename__ = "changes"  # type: ignore
+    __table_args__ = (
+        # delta sync reads a chat's changes after a token
+        Index("ix_changes_chat_id_id", "chat_id", "id"),
+        # removed members still see their own membership tombstone
+        Index("ix_changes_account_id_id", "account_id", "id"),
+        # ids are sync tokens, so they must not be reused after compaction
+        {"sqlite_autoincrement": True},
+    )
+
+    # fields
+    id: int | None = Field(default=None, primary_key=True)
+    chat_id: int
+    entity: str
+    entity_id: int
+    op: str
+    account_id: int | None = None
+    created_at: datetime = Field(default_factory=datetime.now, index=True)
+
+
+class DBJob(SQLModel, table=True):
+    __tablename__ = "jobs"  # type: ignore
+    __table_args__ = (
+        # finding the unfinished job of a kind for a row, e.g. the purge hiding a chat
+        Index("ix_jobs_kind_target_id", "kind", "target_id"),
+        # workers leasing the next due job
+        Index("ix_jobs_status_run_at", "status", "run_at"),
+        Index("ix_jobs_status_leased_until", "status", "leased_until"),
+    )
+
+    # fields
+    id: int | None = Field(default=None, primary_key=True)
+    kind: str
+    target_id: int | None = None
+    # the account the job was started for, which alone can follow it; None for the server's own
+    account_id: int | None = None
+    status: str = "pending"
+    attempts: int = 0
+    max_attempts: int = 5
+    # when a pending job is due, later than created_at while it waits to be retried
+    run_at: datetime = Field(default_factory=datetime.now)
+    # the worker running the job, and when another may take it over if it hasn't finished
+    leased_by: str | None = None
+    leased_until: datetime | None = None
+    # rows processed so far, out of total when known
+    done: int = 0
+    total: int | None = None
+    error: str | None = None
+    created_at: datetime = Field(default_factory=datetime.now)
+    updated_at: datetime = Field(default_factory=datetime.now)
+
+
+class DBImportCheckpoint(SQLModel, table=True):
+    __tablename__ = "import_checkpoints"  # type: ignore
+
+    # fields
+    source: str = Field(primary_key=True)
+    chat_id: int
+    # bytes of the (decompressed) source read through the last committed batch, and its lines
+    offset: int = 0
+    lines: int = 0
+    imported: int = 0
+    updated_at: datetime = Field(default_factory=datetime.now)
+
+
+# ------------------------------------- Message Search -------------------------------------
+
+# Full-text index of messages.text, keyed by the message id. The index keeps its own copy of the
+# text, so a row can always be removed by id, even when the index missed a change.
+MESSAGE_SEARCH_DDL = [
+    """CREATE VIRTUAL TABLE IF NOT EXISTS messages_fts USING fts5(
+        text, tokenize = 'unicode61 remove_diacritics 2'
+    )""",
+    """CREATE TRIGGER IF NOT EXISTS messages_fts_insert AFTER INSERT ON messages BEGIN
+        INSERT INTO messages_fts(rowid, text) VALUES (new.id, new.text);
+    END""",
+    """CREATE TRIGGER IF NOT EXISTS messages_fts_delete AFTER DELETE ON messages BEGIN
+        DELETE FROM messages_fts WHERE rowid = old.id;
+    END""",
+    """CREATE TRIGGER IF NOT EXISTS messages_fts_update AFTER UPDATE OF text ON messages BEGIN
+        DELETE FROM messages_fts WHERE rowid = old.id;
+        INSERT INTO messages_fts(rowid, text) VALUES (new.id, new.text);
+    END""",
+]
+
+for statement in MESSAGE_SEARCH_DDL:
+    event.listen(DBMessage.__table__, "after_create", DDL(statement).execute_if(dialect="sqlite"))
+event.listen(DBMessage.__table__, "after_drop", DDL("DROP TABLE IF EXISTS messages_fts").execute_if(dialect="sqlite"))
@@ -0,0 +1,179 @@
+"""Generating large synthetic datasets straight into the database tables.
+
+Accounts, chats, memberships and messages are written with executemany in large transactions,
+as tuples straight to the SQLite driver rather than through the query functions. Every account
+gets the same password, hashed once, and messages skip the per-row search index trigger, the
+index being filled in with one statement at the end. Generated rows get no change log entries.
+
+The shape of the data is controlled by two skews, each the exponent of a Zipf distribution
+(0 for uniform):
+
+- chat size skew: the k-th largest chat has about 1/k^s as many members as the largest, and
+  chats get messages in proportion to their size
+- author skew: accounts are ranked at random, and the k-th ranked account writes about 1/k^s
+  as many messages as the first in every chat they share
+
+Message timestamps increase with their ids, evenly from `start` to `end`.
+"""
+
+import random
+import time
+from collections import Counter
+from datetime import datetime
+from itertools import accumulate
+
+import bcrypt
+from sqlalchemy import Engine, func, select
+from sqlmodel import Session
+
+from backend import queries
+from backend.database.schema import MESSAGE_SEARCH_DDL, DBAccount, DBChat, DBChatMembership, DBMessage
+
+BATCH_SIZE = 100_000
+SEARCH_INSERT_TRIGGER = "messages_fts_insert"
+WORDS = (
+    "hello hi hey thanks sure maybe tomorrow today tonight meeting lunch coffee deploy release "
+    "bug fix review merge branch test build server database query index cache login token chat "
+    "message team project plan idea question answer soon later great good nice cool okay yes no"
+).split()
+
+
+"""
+    Weights of ranks 1 to n in a Zipf distribution with the given exponent
+"""
+def zipf_weights(n: int, skew: float) -> list[float]:
+    return [1 / rank ** skew for rank in range(1, n + 1)]
+
+
+"""
+    The number of members of every chat, averaging `members` and at most every account, in a
+    random order
+"""
+def chat_sizes(rng: random.Random, chats: int, accounts: int, members: int, skew: float) -> list[int]:
+    weights = zipf_weights(chats, skew)
+    scale = chats * members / sum(weights)
+    sizes = [min(accounts, max(1, round(weight * scale))) for weight in weights]
+    rng.shuffle(sizes)
+    return sizes
+
+
+def _next_id(connection, column) -> int:
+    return (connection.execute(select(func.max(column))).scalar() or 0) + 1
+
+
+# Rows as tuples straight to the driver, about twice as fast as dicts through SQLAlchemy
+def _insert(connection, table: str, columns: tuple[str, ...], rows: list[tuple]):
+    if rows:
+        placeholders = ", ".join("?" * len(columns))
+        connection.exec_driver_sql(f"INSERT INTO {table} ({', '.join(columns)}) VALUES ({placeholders})", rows)
+
+
+# The format SQLAlchemy stores datetimes in on SQLite
+def _timestamp(value: datetime) -> str:
+    return value.isoformat(sep=" ", timespec="microseconds")
+
+
+"""
+    Generating the dataset after the rows already in the database. Returns the number of rows
+    of each table, and reports progress as it goes.
+"""
+def generate(
+    engine: Engine,
+    accounts: int,
+    chats: int,
+    messages: int,
+    members: int,
+    chat_size_skew: float = 1.0,
+    author_skew: float = 1.0,
+    start: datetime = datetime(2024, 1, 1),
+    end: datetime = datetime(2025, 1, 1),
+    password: str = "password",
+    rounds: int = 12,
+    seed: int = 0,
+    batch_size: int = BATCH_SIZE,
+    progress=print,
+) -> dict[str, int]:
+    rng = random.Random(seed)
+    started = time.perf_counter()
+
+    def report(done: str):
+        elapsed = time.perf_counter() - started
+        progress(f"{done} ({elapsed:.1f}s)")
+
+    with engine.begin() as connection:
+        first_account = _next_id(connection, DBAccount.id)
+        first_chat = _next_id(connection, DBChat.id)
+        first_message = _next_id(connection, DBMessage.id)
+    account_ids = range(first_account, first_account + accounts)
+    chat_ids = range(first_chat, first_chat + chats)
+
+    # Accounts, with one password hash for all of them
+    hashed_password = bcrypt.hashpw(password.encode("utf-8"), bcrypt.gensalt(rounds)).decode("utf-8")
+    for batch_start in range(0, accounts, batch_size):
+        with engine.begin() as connection:
+            _insert(connection, DBAccount.__tablename__, ("id", "username", "email", "hashed_password"), [
+                (id, f"user{id}", f"user{id}@example.com", hashed_password)
+                for id in account_ids[batch_start:batch_start + batch_size]
+            ])
+    report(f"{accounts:,} accounts")
+
+    # Chats and their members, the owner first
+    sizes = chat_sizes(rng, chats, accounts, members, chat_size_skew)
+    chat_members = {chat_id: rng.sample(account_ids, size) for chat_id, size in zip(chat_ids, sizes)}
+    with engine.begin() as connection:
+        _insert(connection, DBChat.__tablename__, ("id", "name", "owner_id"), [
+            (chat_id, f"chat{chat_id}", member_ids[0]) for chat_id, member_ids in chat_members.items()
+        ])
+        _insert(connection, DBChatMembership.__tablename__, ("chat_id", "account_id"), [
+            (chat_id, account_id) for chat_id, member_ids in chat_members.items() for account_id in member_ids
+        ])
+    report(f"{chats:,} chats with {sum(sizes):,} memberships")
+
+    # Who writes in every chat: the members' weights by their global rank
+    ranks = list(range(1, accounts + 1))
+    rng.shuffle(ranks)
+    author_weights = dict(zip(account_ids, (1 / rank ** author_skew for rank in ranks)))
+    author_cum_weights = {
+        chat_id: list(accumulate(author_weights[account_id] for account_id in member_ids))
+        for chat_id, member_ids in chat_members.items()
+    }
+    chat_cum_weights = list(accumulate(sizes))
+    sentences = [" ".join(rng.choices(WORDS, k=rng.randint(2, 12))) for _ in range(10_000)]
+    step = (end - start) / max(messages, 1)
+
+    search_index = engine.dialect.name == "sqlite"
+    if search_index:
+        with engine.begin() as connection:
+            connection.exec_driver_sql(f"DROP TRIGGER IF EXISTS {SEARCH_INSERT_TRIGGER}")
+
+    try:
+        for batch_start in range(0, messages, batch_size):
+            count = min(batch_size, messages - batch_start)
+            batch_chats = rng.choices(chat_ids, cum_weights=chat_cum_weights, k=count)
+            authors = {
+                chat_id: iter(rng.choices(chat_members[chat_id], cum_weights=author_cum_weights[chat_id], k=chat_count))
+                for chat_id, chat_count in Counter(batch_chats).items()
+            }
+            rows = [
+                (first_message + n, rng.choice(sentences), next(authors[chat_id]), chat_id, _timestamp(start + step * n))
+                for n, chat_id in enumerate(batch_chats, start=batch_start)
+            ]
+            with engine.begin() as connection:
+                _insert(connection, DBMessage.__tablename__, ("id", "text", "account_id", "chat_id", "created_at"), rows)
+            report(f"{batch_start + count:,} of {messages:,} messages")
+    finally:
+        if search_index:
+            # Indexing what was inserted, then putting the trigger back for everything after
+            with engine.begin() as connection:
+                connection.exec_driver_sql(
+                    "INSERT INTO messages_fts(rowid, text) SELECT id, text FROM messages WHERE id >= ?",
+                    (first_message,),
+                )
+                for statement in MESSAGE_SEARCH_DDL:
+                    connection.exec_driver_sql(statement)
+            report("search index")
+
+    with Session(engine) as session:
+        queries.bump_versions(session, queries.ACCOUNTS_VERSION, queries.CHATS_VERSION)
+        session.commit()
+    return {"accounts": accounts, "chats": chats, "memberships": sum(sizes), "messages": messages}
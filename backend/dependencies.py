@@ -1,21 +1,27 @@
 """Dependencies for the backend API.
 
 Args:
-    engine (sqlachemy.engine.Engine): The database engine
+    engine (sqlachemy.engine.Engine): The database engine, for work outside of requests
+    async_engine (sqlalchemy.ext.asyncio.AsyncEngine): The database engine the routes use
 """
 
-from sqlmodel import SQLModel, create_engine, Session
+from sqlmodel import SQLModel
+from sqlmodel.ext.asyncio.session import AsyncSession
 from typing import Annotated
-from fastapi import Depends
+from fastapi import Depends, WebSocket
 from fastapi.security import APIKeyCookie, HTTPBearer, HTTPAuthorizationCredentials
 from backend.exceptions import AuthenticationRequiredError
 
+from backend.database.engine import create_async_db_engine, create_db_engine
 from backend.database.schema import *
-from backend import auth
+from backend.settings import settings
+from backend import auth, instrumentation, metrics
 
-_db_filename = "backend/database/development.db"
-_db_url = f"sqlite:///{_db_filename}"
-engine = create_engine(_db_url, echo=True)
+engine = create_db_engine(settings)
+async_engine = create_async_db_engine(settings)
+metrics.watch_pool("sync", engine.pool)
+metrics.watch_pool("async", async_engine.pool)
+metrics.time_checkouts("async", async_engine.pool)
 
 bearer_scheme = HTTPBearer(auto_error=False)
 cookie_scheme = APIKeyCookie(name="pony_express_token", auto_error=False)
@@ -23,27 +29,50 @@ cookie_scheme = APIKeyCookie(name="pony_express_token", auto_error=False)
 def create_db_tables():
     SQLModel.metadata.create_all(engine)
 
+    # create_all skips tables that already exist, so add any indexes they are missing
+    for table in SQLModel.metadata.sorted_tables:
+        for index in table.indexes:
+            index.create(engine, checkfirst=True)
 
-def get_session():
-    with Session(engine) as session:
+    # Likewise the search index; `python -m backend.cli rebuild-search-index` fills it in for
+    # the messages that predate it
+    if engine.dialect.name == "sqlite":
+        with engine.begin() as conn:
+            for statement in MESSAGE_SEARCH_DDL:
+                conn.exec_driver_sql(statement)
+
+
+async def get_session():
+    # Query results are read after the commit, which mustn't trigger lazy loads on an async session
+    async with AsyncSession(async_engine, expire_on_commit=False) as session:
         yield session
 
+def select_token(bearer_token: str | None, cookie_token: str | None) -> str:
+    if bearer_token:
+        return bearer_token
+    if cookie_token:
+        return cookie_token
+    raise AuthenticationRequiredError()
+
 def get_token(
     credentials: HTTPAuthorizationCredentials | None = Depends(bearer_scheme),
     cookie_token: str | None = Depends(cookie_scheme),
 ):
-    if credentials:
-        return credentials.credentials
-    if cookie_token:
-        return cookie_token
-    raise AuthenticationRequiredError()
+    return select_token(credentials.credentials if credentials else None, cookie_token)
+
+def get_websocket_token(websocket: WebSocket) -> str:
+    # The security schemes above only read HTTP requests, so mirror them for websockets
+    scheme, _, credentials = websocket.headers.get("authorization", "").partition(" ")
+    bearer_token = credentials if scheme.lower() == "bearer" else None
+    return select_token(bearer_token, websocket.cookies.get(cookie_scheme.model.name))
     
-def get_current_account(
-    session: Session = Depends(get_session),
+async def get_current_account(
+    session: AsyncSession = Depends(get_session),
     token: str = Depends(get_token)
 ):
-    return auth.extract_account(session, token)
+    with instrumentation.timed("auth"):
+        return await auth.extract_account_async(session, token)
 
-DBSession = Annotated[Session, Depends(get_session)]
+DBSession = Annotated[AsyncSession, Depends(get_session)]
 
 CurrentAccount = Annotated[DBAccount, Depends(get_current_account)]
\ No newline at end of file
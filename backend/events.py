@@ -0,0 +1,212 @@
+"""In-process fan-out of chat events to realtime subscribers.
+
+Args:
+    hub (EventHub): The hub the query functions publish to
+"""
+
+import asyncio
+import json
+import threading
+from collections import defaultdict
+from typing import AsyncIterator, Awaitable, Callable
+
+from fastapi import WebSocket
+from starlette.status import WS_1013_TRY_AGAIN_LATER
+
+from backend.broker import Broker, InProcessBroker
+from backend.models import Message
+
+SUBSCRIBER_QUEUE_SIZE = 256
+SSE_KEEPALIVE_SECONDS = 15
+
+
+"""
+    Raised to a subscriber that fell too far behind and lost events
+"""
+class SubscriberOverflow(Exception):
+    pass
+
+
+"""
+    A single subscriber to the events of a chat, with its own bounded queue. A subscriber that
+    lets its queue fill up is cut off instead of blocking the publisher or the other subscribers.
+"""
+class Subscription:
+    def __init__(self, chat_id: int, maxsize: int):
+        self.chat_id = chat_id
+        self.loop = asyncio.get_running_loop()
+        self.queue: asyncio.Queue[dict | None] = asyncio.Queue(maxsize)
+        self.overflowed = False
+
+    # Runs on the subscriber's event loop
+    def _deliver(self, event: dict):
+        if self.overflowed:
+            return
+        try:
+            self.queue.put_nowait(event)
+        except asyncio.QueueFull:
+            self.overflowed = True
+            # Dropping the backlog leaves room for the sentinel that wakes the consumer up
+            while not self.queue.empty():
+                self.queue.get_nowait()
+            self.queue.put_nowait(None)
+
+    async def get(self) -> dict:
+        event = await self.queue.get()
+        if event is None:
+            raise SubscriberOverflow()
+        return event
+
+
+"""
+    Registry of subscriptions per chat. Published events go through the broker, which brings
+    them back to dispatch in every worker process, including this one. Publishing is safe from
+    any thread, including the threadpool that sync routes run in; dispatch hands each event to
+    the subscriber's own loop.
+"""
+class EventHub:
+    def __init__(self, queue_size: int = SUBSCRIBER_QUEUE_SIZE):
+        self.queue_size = queue_size
+        self._lock = threading.Lock()
+        self._subscriptions: dict[int, set[Subscription]] = defaultdict(set)
+        self.broker: Broker = InProcessBroker()
+        self.broker.start(self.dispatch)
+
+    def use_broker(self, broker: Broker):
+        previous = self.broker
+        broker.start(self.dispatch)
+        self.broker = broker
+        previous.close()
+
+    def subscribe(self, chat_id: int) -> Subscription:
+        subscription = Subscription(chat_id, self.queue_size)
+        with self._lock:
+            self._subscriptions[chat_id].add(subscription)
+        return subscription
+
+    def unsubscribe(self, subscription: Subscription):
+        with self._lock:
+            subscriptions = self._subscriptions.get(subscription.chat_id)
+            if subscriptions is not None:
+                subscriptions.discard(subscription)
+                if not subscriptions:
+                    del self._subscriptions[subscription.chat_id]
+
+    def subscriber_count(self, chat_id: int) -> int:
+        with self._lock:
+            return len(self._subscriptions.get(chat_id, ()))
+
+    def publish(self, chat_id: int, event: dict):
+        self.broker.publish(chat_id, event)
+
+    def dispatch(self, chat_id: int, event: dict):
+        with self._lock:
+            subscriptions = list(self._subscriptions.get(chat_id, ()))
+        for subscription in subscriptions:
+            try:
+                subscription.loop.call_soon_threadsafe(subscription._deliver, event)
+            except RuntimeError:
+                # The subscriber's loop has already shut down
+                self.unsubscribe(subscription)
+
+
+hub = EventHub()
+
+
+"""
+    Building the event payload for a message that was created, updated or deleted
+"""
+def message_event(event_type: str, message) -> dict:
+    if event_type == "message.deleted":
+        payload = {"id": message.id}
+    else:
+        payload = Message(
+            id=message.id,
+            text=message.text,
+            account_id=message.account_id,
+            chat_id=message.chat_id,
+            created_at=message.created_at,
+        ).model_dump(mode="json")
+    return {"type": event_type, "chat_id": message.chat_id, "message": payload}
+
+
+"""
+    Forwarding the events of a subscription to an accepted websocket until either side goes away
+"""
+async def relay_to_websocket(websocket: WebSocket, subscription: Subscription):
+    async def forward():
+        while True:
+            event = await subscription.get()
+            await websocket.send_json(event)
+
+    async def wait_for_disconnect():
+        while True:
+            message = await websocket.receive()
+            if message["type"] == "websocket.disconnect":
+                return
+
+    tasks = [asyncio.create_task(forward()), asyncio.create_task(wait_for_disconnect())]
+    try:
+        await asyncio.wait(tasks, return_when=asyncio.FIRST_COMPLETED)
+    finally:
+        for task in tasks:
+            task.cancel()
+        results = await asyncio.gather(*tasks, return_exceptions=True)
+
+    if any(isinstance(result, SubscriberOverflow) for result in results):
+        await websocket.close(code=WS_1013_TRY_AGAIN_LATER, reason="Subscriber fell behind")
+
+
+"""
+    Formatting an event for a text/event-stream response. Only message creations carry an id:
+    they are the events a reconnecting client can replay from the database.
+"""
+def format_sse(event: dict) -> str:
+    lines = []
+    if event["type"] == "message.created":
+        lines.append(f"id: {event['message']['id']}")
+    lines.append(f"event: {event['type']}")
+    lines.append(f"data: {json.dumps(event)}")
+    return "\n".join(lines) + "\n\n"
+
+
+"""
+    Streaming the message events of a chat as server-sent events. When the client resumes from
+    last_event_id, the messages created since then are replayed page by page through fetch_page
+    before switching to live delivery. The subscription is taken before the replay, so live
+    events raised during it are kept and the duplicates are skipped.
+"""
+async def sse_stream(
+    chat_id: int,
+    last_event_id: int | None,
+    fetch_page: Callable[[int], Awaitable[tuple[list, int | None]]],
+    keepalive: float = SSE_KEEPALIVE_SECONDS,
+) -> AsyncIterator[str]:
+    subscription = hub.subscribe(chat_id)
+    try:
+        replayed_through = last_event_id
+        cursor = last_event_id
+        while cursor is not None:
+            messages, cursor = await fetch_page(cursor)
+            for message in messages:
+                yield format_sse(message_event("message.created", message))
+                replayed_through = message.id
+
+        while True:
+            try:
+                event = await asyncio.wait_for(subscription.get(), keepalive)
+            except asyncio.TimeoutError:
+                yield ": keep-alive\n\n"
+                continue
+            if (
+                event["type"] == "message.created"
+                and replayed_through is not None
+                and event["message"]["id"] <= replayed_through
+            ):
+                continue
+            yield format_sse(event)
+    except SubscriberOverflow:
+        # Ending the stream makes the client reconnect and replay from its Last-Event-ID
+        return
+    finally:
+        hub.unsubscribe(subscription)
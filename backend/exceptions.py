@@ -1,3 +1,4 @@
+from datetime import timedelta
 from fastapi.responses import JSONResponse
 
 """
@@ -153,4 +154,83 @@ class AccessDeniedError(Exception):
                 "error": "access_denied",
                 "message": self.message
             }
-        )
\ No newline at end of file
+        )
+
+
+"""
+    Exception for when a sync token is older than the retained change log
+"""
+class SyncTokenExpired(Exception):
+    def __init__(self):
+        self.message = "Sync token expired: fetch the chats again to get a new token"
+
+    def response(self) -> JSONResponse:
+        return JSONResponse(
+            status_code=410,
+            content={
+                "error": "sync_token_expired",
+                "message": self.message
+            }
+        )
+
+
+"""
+    Exception for when a request is shed because the server is at capacity
+"""
+class ServiceOverloaded(Exception):
+    def __init__(self, retry_after: int):
+        self.message = "Server is busy, try again later"
+        self.retry_after = retry_after
+
+    def response(self) -> JSONResponse:
+        return JSONResponse(
+            status_code=503,
+            headers={"Retry-After": str(self.retry_after)},
+            content={
+                "error": "service_overloaded",
+                "message": self.message
+            }
+        )
+
+"""
+    Exception for a background job that has to wait for something else before it can run: it
+    goes back on the queue for delay, without using up an attempt
+"""
+class JobDeferred(Exception):
+    def __init__(self, delay: timedelta, reason: str):
+        super().__init__(reason)
+        self.delay = delay
+        self.message = reason
+
+
+"""
+    Exception for a pagination cursor that wasn't handed out by the server
+"""
+class InvalidCursor(Exception):
+    def __init__(self, cursor: str):
+        self.message = f"Invalid cursor: {cursor}"
+
+    def response(self) -> JSONResponse:
+        return JSONResponse(
+            status_code=400,
+            content={
+                "error": "invalid_cursor",
+                "message": self.message
+            }
+        )
+
+"""
+    Exception for an export compression that this server can't produce
+"""
+class CompressionUnavailable(Exception):
+    def __init__(self, compression: str):
+        self.message = f"Compression {compression} is not available on this server"
+
+    def response(self) -> JSONResponse:
+        return JSONResponse(
+            status_code=422,
+            content={
+                "error": "compression_unavailable",
+                "message": self.message
+            }
+        )
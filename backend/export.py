@@ -0,0 +1,91 @@
+"""Streaming a chat's messages out as NDJSON, compressed on the fly.
+
+Messages come in a batch at a time, each read in a short transaction of its own (see
+`async_queries.export_messages`), are written one JSON object per line, and go through a
+streaming compressor, so only one batch and the compressor's window are ever held in memory,
+however big the chat. gzip uses zlib from the standard library; zstd needs the optional
+`zstandard` package.
+
+Args:
+    COMPRESSIONS (dict[str, tuple[str, str]]): The media type and file extension of each compression
+"""
+
+import json
+import logging
+import time
+import zlib
+from typing import AsyncIterator, Sequence
+
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+from backend.exceptions import CompressionUnavailable
+
+logger = logging.getLogger(__name__)
+
+COMPRESSIONS = {
+    "gzip": ("application/gzip", ".ndjson.gz"),
+    "zstd": ("application/zstd", ".ndjson.zst"),
+    "none": ("application/x-ndjson", ".ndjson"),
+}
+
+# One encoder for every line; json.dumps with options makes a new one each call
+_encode = json.JSONEncoder(ensure_ascii=False).encode
+
+
+"""
+    A compressor taking chunks of the output as they come, with compress() and flush()
+"""
+def compressor(compression: str):
+    if compression == "gzip":
+        # wbits 16 + 15: a gzip header and trailer around a full-size deflate window
+        return zlib.compressobj(6, zlib.DEFLATED, 16 + zlib.MAX_WBITS)
+    if compression == "zstd":
+        if zstandard is None:
+            raise CompressionUnavailable(compression)
+        return zstandard.ZstdCompressor(level=3).compressobj()
+    return None
+
+
+"""
+    Writing a batch of (id, chat_id, account_id, text, created_at) rows as NDJSON lines
+"""
+def ndjson_lines(rows: Sequence) -> bytes:
+    lines = [
+        _encode({
+            "id": id,
+            "chat_id": chat_id,
+            "account_id": account_id,
+            "text": text,
+            "created_at": created_at.isoformat() if created_at is not None else None,
+        })
+        for id, chat_id, account_id, text, created_at in rows
+    ]
+    return ("\n".join(lines) + "\n").encode("utf-8")
+
+
+"""
+    The body of an export: the batches as compressed NDJSON, logging the export's throughput in
+    messages per second once it is done
+"""
+async def stream_export(chat_id: int, batches: AsyncIterator[Sequence], compression: str) -> AsyncIterator[bytes]:
+    compress = compressor(compression)
+    start = time.perf_counter()
+    exported = 0
+    async for rows in batches:
+        exported += len(rows)
+        chunk = ndjson_lines(rows)
+        if compress is not None:
+            chunk = compress.compress(chunk)
+        if chunk:
+            yield chunk
+    if compress is not None:
+        yield compress.flush()
+
+    elapsed = time.perf_counter() - start
+    logger.info(
+        "Exported %d messages of chat %d in %.2fs (%.0f messages/s)",
+        exported, chat_id, elapsed, exported / elapsed if elapsed else 0,
+    )
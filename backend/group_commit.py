@@ -0,0 +1,120 @@
+"""Group commit for new messages: one writer per process commits the posts of many requests in
+a single transaction.
+
+SQLite takes one writer at a time, and with synchronous=normal every commit still writes to the
+WAL, so posters mostly wait for each other's commits. With `message_group_commit` on, the route
+hands its post to the writer instead and waits. The writer takes the first post in its queue,
+waits `group_commit_max_delay` seconds for more (unless `group_commit_max_size` are already
+waiting), and commits up to `group_commit_max_size` of them with
+`queries.create_message_group`, then answers every poster with its message or its error. Posts
+that arrive while a group commits make up the next group, so the busier the route, the bigger
+the groups.
+
+A post is committed even when its request went away while it waited.
+"""
+
+import asyncio
+import logging
+
+from sqlalchemy.ext.asyncio import AsyncEngine
+from sqlmodel.ext.asyncio.session import AsyncSession
+
+from backend import queries as db
+from backend.database.schema import DBMessage
+from backend.settings import settings
+
+logger = logging.getLogger(__name__)
+
+
+"""
+    The writer of one engine on one event loop: a queue of posts and the task committing them
+"""
+class GroupCommitWriter:
+    def __init__(self, bind: AsyncEngine, max_delay: float, max_size: int):
+        self.bind = bind
+        self.max_delay = max_delay
+        self.max_size = max_size
+        self.loop = asyncio.get_running_loop()
+        self.queue: asyncio.Queue = asyncio.Queue()
+        self.task = self.loop.create_task(self.run())
+
+    # Queueing a message and waiting for the group it goes out with to be committed
+    async def submit(self, chat_id: int, text: str, account_id: int) -> DBMessage:
+        future = self.loop.create_future()
+        self.queue.put_nowait((chat_id, text, account_id, future))
+        return await future
+
+    # A None in the queue stops the writer once the posts before it are committed
+    async def run(self):
+        while True:
+            group = [await self.queue.get()]
+            if self.queue.qsize() < self.max_size - 1:
+                await asyncio.sleep(self.max_delay)
+            while len(group) < self.max_size and not self.queue.empty():
+                group.append(self.queue.get_nowait())
+            posts = [post for post in group if post is not None]
+            if posts:
+                await self.commit(posts)
+            if len(posts) < len(group):
+                return
+
+    # Every post of a group gets the same error when the transaction itself fails
+    async def commit(self, group: list):
+        try:
+            async with AsyncSession(self.bind, expire_on_commit=False) as session:
+                results = await session.run_sync(db.create_message_group, [post[:3] for post in group])
+        except Exception as exc:
+            logger.exception("Group commit of %d messages failed", len(group))
+            results = [exc] * len(group)
+        for (*_, future), result in zip(group, results):
+            if future.done():
+                continue
+            if isinstance(result, Exception):
+                future.set_exception(result)
+            else:
+                future.set_result(result)
+
+    # Committing what is queued, then stopping
+    async def close(self):
+        self.queue.put_nowait(None)
+        await self.task
+        # Posts that came in behind the None
+        group = []
+        while not self.queue.empty():
+            group.append(self.queue.get_nowait())
+        for start in range(0, len(group), self.max_size):
+            await self.commit(group[start:start + self.max_size])
+
+
+_writers: dict[AsyncEngine, GroupCommitWriter] = {}
+
+
+"""
+    The writer of an engine, started on the running event loop the first time it is needed, and
+    again if the task of the last one has stopped, taking over the posts it left waiting
+"""
+def writer(bind: AsyncEngine) -> GroupCommitWriter:
+    current = _writers.get(bind)
+    loop = asyncio.get_running_loop()
+    if current is not None and current.loop is loop and not current.task.done():
+        return current
+    replacement = _writers[bind] = GroupCommitWriter(bind, settings.group_commit_max_delay, settings.group_commit_max_size)
+    if current is not None and current.loop is loop:
+        if not current.task.cancelled() and current.task.exception() is not None:
+            logger.error("Group commit writer stopped, restarting it", exc_info=current.task.exception())
+        while not current.queue.empty():
+            post = current.queue.get_nowait()
+            if post is not None:
+                replacement.queue.put_nowait(post)
+    return replacement
+
+
+"""
+    Stopping the writers of the running event loop, once their queues are committed
+"""
+async def close():
+    loop = asyncio.get_running_loop()
+    for bind, current in list(_writers.items()):
+        if current.loop is loop:
+            del _writers[bind]
+            await current.close()
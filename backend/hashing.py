@@ -0,0 +1,169 @@
+"""Password hashing on a dedicated process pool.
+
+bcrypt spends a few hundred milliseconds of CPU on every hash and check. Running it in a
+process pool keeps that CPU off the API workers, and bounding the number of hashes in flight
+keeps a burst of logins from tying up the threadpool the other routes run on: once the pool
+and its queue are full, further requests are shed with 503 instead of waiting.
+
+Args:
+    hasher (PasswordHasher): The hasher used by the query functions
+"""
+
+import asyncio
+import threading
+import time
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+
+import bcrypt
+
+from backend.exceptions import ServiceOverloaded
+from backend.settings import settings
+
+LATENCY_BUCKETS = (0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0)
+
+
+# Run in the pool's processes, so they have to be importable module-level functions
+def _hashpw(password: bytes, rounds: int) -> bytes:
+    return bcrypt.hashpw(password, bcrypt.gensalt(rounds))
+
+def _checkpw(password: bytes, hashed_password: bytes) -> bool:
+    return bcrypt.checkpw(password, hashed_password)
+
+
+class PasswordHasher:
+    def __init__(self, workers: int, queue_size: int, retry_after: int, rounds: int = 12):
+        # workers=0 hashes in the calling thread, with the same bound on concurrency
+        self.workers = workers
+        self.rounds = rounds
+        self.capacity = max(workers, 1) + queue_size
+        self.retry_after = retry_after
+        self._slots = threading.BoundedSemaphore(self.capacity)
+        self._executor: ProcessPoolExecutor | None = None
+        self._lock = threading.Lock()
+
+        self.in_flight = 0
+        self.rejected = 0
+        self.latency_count = 0
+        self.latency_sum = 0.0
+        self.latency_buckets = [0] * len(LATENCY_BUCKETS)
+
+    def _get_executor(self) -> ProcessPoolExecutor:
+        with self._lock:
+            if self._executor is None:
+                self._executor = ProcessPoolExecutor(max_workers=self.workers)
+            return self._executor
+
+    def _acquire(self) -> float:
+        if not self._slots.acquire(blocking=False):
+            with self._lock:
+                self.rejected += 1
+            raise ServiceOverloaded(self.retry_after)
+        with self._lock:
+            self.in_flight += 1
+        return time.perf_counter()
+
+    def _release(self, start: float):
+        self._observe(time.perf_counter() - start)
+        self._slots.release()
+
+    def _broken(self, executor: ProcessPoolExecutor):
+        # A hashing process died, start a fresh pool for the next request. Another request may
+        # have replaced the broken one already.
+        with self._lock:
+            if self._executor is executor:
+                self._executor = None
+        executor.shutdown(wait=False, cancel_futures=True)
+        raise ServiceOverloaded(self.retry_after)
+
+    def _run(self, fn, *args):
+        start = self._acquire()
+        try:
+            if self.workers == 0:
+                return fn(*args)
+            executor = self._get_executor()
+            try:
+                return executor.submit(fn, *args).result()
+            except BrokenProcessPool:
+                self._broken(executor)
+        finally:
+            self._release(start)
+
+    # Awaits the pool instead of blocking, for the event loop; workers=0 hashes on a thread.
+    # A hash keeps its slot until it is done, even when the request awaiting it is cancelled:
+    # the pool carries on with it regardless.
+    async def _run_async(self, fn, *args):
+        if self.workers == 0:
+            return await asyncio.to_thread(self._run, fn, *args)
+        start = self._acquire()
+        executor = self._get_executor()
+        try:
+            try:
+                future = executor.submit(fn, *args)
+            except BaseException:
+                self._release(start)
+                raise
+            future.add_done_callback(lambda _: self._release(start))
+            return await asyncio.wrap_future(future)
+        except BrokenProcessPool:
+            self._broken(executor)
+
+    def _observe(self, seconds: float):
+        with self._lock:
+            self.in_flight -= 1
+            self.latency_count += 1
+            self.latency_sum += seconds
+            for i, bound in enumerate(LATENCY_BUCKETS):
+                if seconds <= bound:
+                    self.latency_buckets[i] += 1
+                    break
+
+    def hash(self, password: str) -> str:
+        return self._run(_hashpw, password.encode("utf-8"), self.rounds).decode("utf-8")
+
+    def check(self, password: str, hashed_password: str) -> bool:
+        return self._run(_checkpw, password.encode("utf-8"), hashed_password.encode("utf-8"))
+
+    async def hash_async(self, password: str) -> str:
+        return (await self._run_async(_hashpw, password.encode("utf-8"), self.rounds)).decode("utf-8")
+
+    async def check_async(self, password: str, hashed_password: str) -> bool:
+        return await self._run_async(_checkpw, password.encode("utf-8"), hashed_password.encode("utf-8"))
+
+    # A hash made with a lower cost than the configured one, read from its "$2b$<cost>$" prefix.
+    # Lowering the cost, say for a load test, mustn't weaken the hashes already stored.
+    def needs_rehash(self, hashed_password: str) -> bool:
+        try:
+            return int(hashed_password.split("$")[2]) < self.rounds
+        except (IndexError, ValueError):
+            return False
+
+    def metrics(self) -> dict:
+        with self._lock:
+            return {
+                "workers": self.workers,
+                "capacity": self.capacity,
+                "in_flight": self.in_flight,
+                "queue_depth": max(self.in_flight - max(self.workers, 1), 0),
+                "rejected_total": self.rejected,
+                "latency_seconds_count": self.latency_count,
+                "latency_seconds_sum": self.latency_sum,
+                # cumulative counts per upper bound, as in a Prometheus histogram
+                "latency_seconds_buckets": {
+                    str(bound): sum(self.latency_buckets[: i + 1]) for i, bound in enumerate(LATENCY_BUCKETS)
+                },
+            }
+
+    def shutdown(self):
+        with self._lock:
+            executor, self._executor = self._executor, None
+        if executor is not None:
+            executor.shutdown(cancel_futures=True)
+
+
+hasher = PasswordHasher(
+    settings.password_hash_workers,
+    settings.password_hash_queue_size,
+    settings.password_hash_retry_after,
+    settings.bcrypt_rounds,
+)
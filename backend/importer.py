@@ -0,0 +1,180 @@
+"""Importing chat history from another system, from an NDJSON file into one chat.
+
+Every line of the file is a message:
+
+    {"author": "u-1042", "text": "hello", "created_at": "2019-03-02T10:15:00Z"}
+
+`author` is the author's id in the other system, mapped to an account by username, or through
+a CSV file of `external id,username` rows when the ids differ. Only members post in a chat, so
+messages whose author has no account, or whose account isn't a member of the chat, are
+imported without one; add the authors to the chat first to keep their names on their messages. `created_at` is kept as it is, converted to local time when
+it has an offset. Lines that aren't a message are skipped and reported.
+
+The file is read a line at a time, gzip or not, and imported in batches, each one a single
+transaction that also moves the source's checkpoint past it. Memory stays at one batch and the
+authors seen so far, however big the file. Running the import of a source again picks up after
+the last committed batch, so an import that failed half way resumes where it stopped. Messages
+don't record the source they came from, so a source can only be imported from the start again
+while none of its messages were committed: starting over would import them twice.
+
+    python -m backend.cli import-history history.ndjson.gz --chat-id 12 --authors authors.csv
+"""
+
+import csv
+import gzip
+import json
+import os
+import time
+from datetime import datetime
+from typing import Iterator
+
+from sqlalchemy import Engine
+from sqlmodel import Session
+
+from backend import queries as db
+
+GZIP_MAGIC = b"\x1f\x8b"
+
+
+"""
+    Opening a file for reading, decompressing it when it is gzip
+"""
+def open_source(path: str):
+    with open(path, "rb") as file:
+        magic = file.read(2)
+    return gzip.open(path, "rb") if magic == GZIP_MAGIC else open(path, "rb")
+
+
+"""
+    Reading the lines of a file from an offset in its (decompressed) content, each with the
+    offset just after it
+"""
+def read_lines(path: str, offset: int = 0) -> Iterator[tuple[bytes, int]]:
+    with open_source(path) as file:
+        # gzip files seek forwards by decompressing up to the offset
+        file.seek(offset)
+        for line in file:
+            offset += len(line)
+            yield line, offset
+
+
+"""
+    Reading a line as (author, text, created_at), or raising ValueError when it isn't a message
+"""
+def parse_line(line: bytes) -> tuple[str | None, str, datetime]:
+    record = json.loads(line)
+    if not isinstance(record, dict) or not isinstance(record.get("text"), str):
+        raise ValueError("a message needs a text")
+    created_at = datetime.fromisoformat(record["created_at"])
+    if created_at.tzinfo is not None:
+        created_at = created_at.astimezone().replace(tzinfo=None)
+    author = record.get("author")
+    return (str(author) if author is not None else None), record["text"], created_at
+
+
+"""
+    Reading a CSV file of `external id,username` rows
+"""
+def read_author_map(path: str) -> dict[str, str]:
+    with open(path, newline="") as file:
+        return {row[0]: row[1] for row in csv.reader(file) if len(row) >= 2}
+
+
+"""
+    Mapping external author ids to the accounts of a chat's members, looking up the ids it hasn't
+    seen before in two queries per batch and remembering them, found or not. Authors with an
+    account that isn't a member map to no account, and are kept in non_members.
+"""
+class AuthorLookup:
+    def __init__(self, usernames: dict[str, str] | None = None):
+        self.usernames = usernames
+        self.account_ids: dict[str, int | None] = {}
+        self.non_members: set[str] = set()
+
+    def resolve(self, session: Session, chat_id: int, authors: set[str]):
+        unseen = [author for author in authors if author not in self.account_ids]
+        if not unseen:
+            return
+        usernames = {author: self.usernames.get(author) if self.usernames is not None else author for author in unseen}
+        found = db.get_account_ids_by_username(session, [name for name in usernames.values() if name is not None])
+        members = db.get_chat_member_ids(session, chat_id, list(found.values())) if found else set()
+        for author, username in usernames.items():
+            account_id = found.get(username)
+            if account_id is not None and account_id not in members:
+                self.non_members.add(author)
+                account_id = None
+            self.account_ids[author] = account_id
+
+    def __getitem__(self, author: str | None) -> int | None:
+        return None if author is None else self.account_ids[author]
+
+
+"""
+    Importing a file into a chat, from the source's checkpoint unless restarting. Returns what
+    was done: lines read, messages imported, messages whose author has no account or isn't a
+    member, and lines skipped. Restarting a source that already has messages in is refused.
+"""
+def import_file(
+    engine: Engine,
+    path: str,
+    chat_id: int,
+    source: str | None = None,
+    authors: AuthorLookup | None = None,
+    batch_size: int = db.IMPORT_BATCH_SIZE,
+    restart: bool = False,
+    progress=print,
+) -> dict[str, int]:
+    source = source or os.path.abspath(path)
+    authors = authors or AuthorLookup()
+    counts = {"lines": 0, "imported": 0, "unknown_authors": 0, "non_members": 0, "skipped": 0}
+    started = time.perf_counter()
+
+    with Session(engine) as session:
+        db.chat_exists(session, chat_id)
+        checkpoint = db.get_import_checkpoint(session, source)
+        if restart and checkpoint is not None and checkpoint.imported:
+            raise ValueError(f"{checkpoint.imported:,} messages of {source} are already in chat {checkpoint.chat_id}, restarting would import them again")
+        if restart:
+            checkpoint = None
+        if checkpoint is not None and checkpoint.chat_id != chat_id:
+            raise ValueError(f"{source} is being imported into chat {checkpoint.chat_id}, not {chat_id}")
+        offset = flushed = checkpoint.offset if checkpoint is not None else 0
+        line_number = checkpoint.lines if checkpoint is not None else 0
+        if offset:
+            progress(f"resuming {source} after line {line_number:,}")
+
+        def flush(batch: list, offset: int):
+            nonlocal flushed
+            authors.resolve(session, chat_id, {author for author, _, _ in batch if author is not None})
+            messages = []
+            for author, text, created_at in batch:
+                account_id = authors[author]
+                if author in authors.non_members:
+                    counts["non_members"] += 1
+                elif author is not None and account_id is None:
+                    counts["unknown_authors"] += 1
+                messages.append((text, account_id, created_at))
+            counts["imported"] += len(db.import_messages(session, chat_id, messages, source, offset, line_number))
+            flushed = offset
+            elapsed = time.perf_counter() - started
+            progress(f"imported {counts['imported']:,} messages through line {line_number:,} ({counts['imported'] / elapsed:,.0f} messages/s)")
+
+        batch = []
+        for line, offset in read_lines(path, offset):
+            line_number += 1
+            counts["lines"] += 1
+            if not line.strip():
+                continue
+            try:
+                batch.append(parse_line(line))
+            except (ValueError, KeyError, TypeError) as exc:
+                counts["skipped"] += 1
+                progress(f"skipped line {line_number:,}: {exc}")
+                continue
+            if len(batch) == batch_size:
+                flush(batch, offset)
+                batch = []
+        # The rest, or just the checkpoint when the last lines were skipped
+        if offset != flushed:
+            flush(batch, offset)
+    return counts
@@ -0,0 +1,134 @@
+"""Per-request instrumentation: SQL statements, database time, and time spent in auth and rendering.
+
+Every HTTP request gets a `RequestTimings` in a context variable. SQLAlchemy cursor events on
+every engine count the statements the request runs and the time they take, and `timed()` adds
+up the time spent in other phases. The totals go out as a `Server-Timing` header, which browser
+dev tools show next to the request, and as one JSON log line per request on the
+`backend.requests` logger at INFO level. The request counters and latency histograms of
+`backend.metrics` are fed from here too.
+
+Args:
+    PHASES (tuple[str, ...]): The phases timed for every request, besides the total
+"""
+
+import json
+import logging
+import time
+from contextlib import contextmanager
+from contextvars import ContextVar
+
+from fastapi.responses import JSONResponse
+from sqlalchemy import Engine, event
+
+from backend import metrics
+
+logger = logging.getLogger("backend.requests")
+
+PHASES = ("db", "auth", "render")
+
+
+class RequestTimings:
+    def __init__(self):
+        self.queries = 0
+        self.seconds = {phase: 0.0 for phase in PHASES}
+
+    def add(self, phase: str, seconds: float):
+        self.seconds[phase] += seconds
+
+    # Server-Timing durations are in milliseconds
+    def server_timing(self, total: float) -> str:
+        metrics = [f'db;dur={self.seconds["db"] * 1000:.2f};desc="{self.queries} queries"']
+        metrics += [f"{phase};dur={self.seconds[phase] * 1000:.2f}" for phase in PHASES if phase != "db"]
+        metrics.append(f"total;dur={total * 1000:.2f}")
+        return ", ".join(metrics)
+
+    def log_record(self, method: str, path: str, status: int, total: float) -> dict:
+        record = {"method": method, "path": path, "status": status, "queries": self.queries}
+        record.update({f"{phase}_ms": round(self.seconds[phase] * 1000, 2) for phase in PHASES})
+        record["total_ms"] = round(total * 1000, 2)
+        return record
+
+
+_timings: ContextVar[RequestTimings | None] = ContextVar("request_timings", default=None)
+
+
+"""
+    Getting the timings of the request being handled, if any
+"""
+def current() -> RequestTimings | None:
+    return _timings.get()
+
+
+"""
+    Adding the time spent in the block to a phase of the current request
+"""
+@contextmanager
+def timed(phase: str):
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        timings = _timings.get()
+        if timings is not None:
+            timings.add(phase, time.perf_counter() - start)
+
+
+# Listening on the Engine class covers every engine, including the sync engine under the async one
+@event.listens_for(Engine, "before_cursor_execute")
+def _before_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+    context._instrumentation_start = time.perf_counter()
+
+@event.listens_for(Engine, "after_cursor_execute")
+def _after_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+    timings = _timings.get()
+    if timings is not None:
+        timings.queries += 1
+        timings.add("db", time.perf_counter() - context._instrumentation_start)
+
+
+"""
+    The default response class, timing the rendering of the response body
+"""
+class TimedJSONResponse(JSONResponse):
+    def render(self, content) -> bytes:
+        with timed("render"):
+            return super().render(content)
+
+
+"""
+    ASGI middleware giving every HTTP request its timings, reporting them in a Server-Timing
+    header and a log line
+"""
+class InstrumentationMiddleware:
+    def __init__(self, app):
+        self.app = app
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http":
+            await self.app(scope, receive, send)
+            return
+
+        timings = RequestTimings()
+        token = _timings.set(timings)
+        start = time.perf_counter()
+        status = 500
+        metrics.request_started(scope["method"])
+
+        async def send_with_timings(message):
+            nonlocal status
+            if message["type"] == "http.response.start":
+                status = message["status"]
+                header = timings.server_timing(time.perf_counter() - start)
+                message["headers"] = [*message.get("headers", []), (b"server-timing", header.encode("latin-1"))]
+            await send(message)
+
+        try:
+            await self.app(scope, receive, send_with_timings)
+        finally:
+            _timings.reset(token)
+            total = time.perf_counter() - start
+            # The router leaves the matched route in the scope; label by its path template
+            route = scope.get("route")
+            metrics.request_finished(scope["method"], getattr(route, "path", "unmatched"), status, total)
+            if logger.isEnabledFor(logging.INFO):
+                logger.info(json.dumps(timings.log_record(scope["method"], scope["path"], status, total)))
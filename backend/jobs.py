@@ -0,0 +1,150 @@
+"""Background jobs, queued in the jobs table and run by workers in every API process.
+
+A job is a row with a kind, naming the handler that runs it, and the id of what it works on.
+Workers lease the next due job with a single UPDATE, which SQLite serializes, so every job is
+run by one worker at a time, whichever process the workers are in. A worker keeps extending its
+lease while the job runs; when a worker dies with a job, its lease runs out after
+`job_lease_seconds` and another worker takes the job over. A job that raises is retried after
+`job_retry_backoff` seconds, doubled for every attempt, until it has used up its attempts and
+is marked failed.
+
+Handlers take a session and the job id, and may be run again for the same job, so they must
+pick up where a previous attempt stopped. A handler that has to wait for other jobs raises
+`JobDeferred`, which puts its job back on the queue for a while without using up an attempt.
+
+Args:
+    HANDLERS (dict[str, Callable]): The handler of each kind of job
+"""
+
+import asyncio
+import logging
+import os
+import socket
+from datetime import datetime, timedelta
+
+from sqlalchemy.ext.asyncio import AsyncEngine
+from sqlmodel import Session
+from sqlmodel.ext.asyncio.session import AsyncSession
+
+from backend import queries as db
+from backend.dependencies import async_engine
+from backend.exceptions import JobDeferred
+from backend.settings import settings
+
+logger = logging.getLogger(__name__)
+
+
+"""
+    Reindexing every message for search, reporting the ids done so far as the job's progress
+"""
+def rebuild_search_index(session: Session, job_id: int):
+    job = db.get_job(session, job_id)
+
+    def progress(indexed: int, through: int, head: int):
+        job.done, job.total = through, head
+
+    db.rebuild_message_search(session, progress=progress)
+    session.commit()
+
+
+"""
+    Deleting the change log entries older than the retention window, then scheduling the next
+    compaction change_log_compaction_interval seconds from now
+"""
+def compact_change_log(session: Session, job_id: int):
+    deleted = db.compact_changes(session, timedelta(seconds=settings.change_log_retention))
+    if deleted:
+        logger.info("Compacted %d change log entries", deleted)
+    db.schedule_job(session, db.COMPACT_CHANGE_LOG, datetime.now() + timedelta(seconds=settings.change_log_compaction_interval))
+
+
+HANDLERS = {
+    db.PURGE_CHAT: db.purge_chat,
+    db.DELETE_ACCOUNT: db.finish_account_deletion,
+    db.COMPACT_CHANGE_LOG: compact_change_log,
+    db.REBUILD_SEARCH_INDEX: rebuild_search_index,
+}
+
+def _lease() -> timedelta:
+    return timedelta(seconds=settings.job_lease_seconds)
+
+
+async def _keep_leased(bind: AsyncEngine, job_id: int, worker_id: str):
+    while True:
+        await asyncio.sleep(settings.job_lease_seconds / 3)
+        async with AsyncSession(bind) as session:
+            if not await session.run_sync(db.extend_lease, job_id, worker_id, _lease()):
+                logger.warning("Worker %s lost the lease of job %d", worker_id, job_id)
+                return
+
+
+"""
+    Running a leased job with its handler, then marking it done or recording the failure
+"""
+async def run_job(bind: AsyncEngine, worker_id: str, job):
+    keep_leased = asyncio.create_task(_keep_leased(bind, job.id, worker_id))
+    async with AsyncSession(bind, expire_on_commit=False) as session:
+        try:
+            if job.kind not in HANDLERS:
+                raise ValueError(f"No handler for jobs of kind {job.kind!r}")
+            # Its last attempt took its worker down with it, as far as the lease tells
+            if job.attempts > job.max_attempts:
+                raise RuntimeError(f"Lease expired on the last of {job.max_attempts} attempts")
+            await session.run_sync(HANDLERS[job.kind], job.id)
+        except JobDeferred as exc:
+            logger.info("Job %d (%s) deferred: %s", job.id, job.kind, exc.message)
+            await session.rollback()
+            await session.run_sync(db.defer_job, job.id, worker_id, exc.delay, exc.message)
+        except Exception as exc:
+            logger.exception("Job %d (%s) failed on attempt %d", job.id, job.kind, job.attempts)
+            await session.rollback()
+            await session.run_sync(db.fail_job, job.id, worker_id, str(exc), timedelta(seconds=settings.job_retry_backoff))
+        else:
+            await session.run_sync(db.complete_job, job.id, worker_id)
+        finally:
+            keep_leased.cancel()
+
+
+"""
+    Leasing and running the next due job, or the given one if it is due. Returns whether there
+    was a job to run.
+"""
+async def run_next(bind: AsyncEngine = async_engine, worker_id: str | None = None, job_id: int | None = None) -> bool:
+    worker_id = worker_id or f"{socket.gethostname()}:{os.getpid()}"
+    async with AsyncSession(bind, expire_on_commit=False) as session:
+        job = await session.run_sync(db.lease_job, worker_id, _lease(), job_id)
+    if job is None:
+        return False
+    await run_job(bind, worker_id, job)
+    return True
+
+
+"""
+    Running jobs as they come due until cancelled, polling every job_poll_interval seconds
+    while the queue is empty
+"""
+async def work(worker_id: str, bind: AsyncEngine = async_engine):
+    while True:
+        try:
+            if await run_next(bind, worker_id):
+                continue
+        except Exception:
+            logger.exception("Worker %s couldn't lease a job", worker_id)
+        await asyncio.sleep(settings.job_poll_interval)
+
+
+"""
+    Scheduling a compaction of the change log right away, unless one is already waiting. Every
+    compaction schedules the next one, so this only restarts the cycle when the app starts.
+"""
+async def schedule_compaction(bind: AsyncEngine = async_engine):
+    async with AsyncSession(bind) as session:
+        await session.run_sync(db.schedule_job, db.COMPACT_CHANGE_LOG, datetime.now())
+
+
+"""
+    Running job_workers workers in this process until cancelled
+"""
+async def run_workers(count: int, bind: AsyncEngine = async_engine):
+    prefix = f"{socket.gethostname()}:{os.getpid()}"
+    await asyncio.gather(*(work(f"{prefix}:{n}", bind) for n in range(count)))
@@ -4,37 +4,54 @@ Args:
     app (FastAPI): The FastAPI application
 """
 
+import asyncio
+import json
 from contextlib import asynccontextmanager
 
-from fastapi import FastAPI, Form, Depends
-from fastapi.responses import Response, JSONResponse
+from fastapi import BackgroundTasks, FastAPI, Form, Depends, Header, Query, WebSocket
+from fastapi.responses import Response, JSONResponse, PlainTextResponse, StreamingResponse
 from fastapi.requests import Request
 from fastapi.security import OAuth2PasswordRequestForm
 from fastapi.middleware.cors import CORSMiddleware
+from starlette.status import WS_1008_POLICY_VIOLATION
 
-from typing import Annotated
+from typing import Annotated, Literal
 
-from backend.dependencies import create_db_tables, DBSession, CurrentAccount
-from backend.models import Account, AccountList, Chat, ChatList, Message, MessageList, CreateChat, UpdateChat, CreateMessage, UpdateMessage, ChatMembership, Registration, AccessToken, Login, UpdateAccount
+from backend.dependencies import create_db_tables, get_websocket_token, DBSession, CurrentAccount
+from backend.models import Account, AccountList, Chat, ChatList, Message, MessageList, CreateChat, UpdateChat, CreateMessage, UpdateMessage, ChatMembership, Registration, AccessToken, Login, UpdateAccount, SyncChange, SyncResult, CreateMessageBatch, BatchError, MessageBatchResult, ChatMembershipBatch, ChatMembershipBatchResult, ChatMembershipRemovalResult, MessageSearchHit, MessageSearchResult, ChatSearchResult, SearchResult, Job
 from backend.exceptions import *
-from backend import auth
+from backend import auth, conditional, events, export, hashing, group_commit, instrumentation, jobs, metrics
+from backend.broker import InProcessBroker, create_broker
+from backend.settings import settings
 
 from backend.database.schema import DBAccount
 
-import backend.queries as db
+import backend.async_queries as db
 
 
 
 @asynccontextmanager
 async def lifespan(app: FastAPI):
     create_db_tables()
+    events.hub.use_broker(create_broker(settings))
+    await jobs.schedule_compaction()
+    workers = asyncio.create_task(jobs.run_workers(settings.job_workers))
+    if settings.metrics_dir is not None:
+        snapshots = asyncio.create_task(metrics.write_snapshots_periodically(settings.metrics_dir))
     yield
+    workers.cancel()
+    await group_commit.close()
+    if settings.metrics_dir is not None:
+        snapshots.cancel()
+    events.hub.use_broker(InProcessBroker())
+    hashing.hasher.shutdown()
 
 
 app = FastAPI(
     title = "<Chat API>",
     summary = "<This is a chat application>",
     lifespan=lifespan,
+    default_response_class=instrumentation.TimedJSONResponse,
 )
 
 
@@ -43,9 +60,12 @@ app.add_middleware(
     allow_origins=["http://localhost:5173"],
     allow_methods=["*"],
     allow_headers=["*"],
+    expose_headers=["ETag", "Server-Timing"],
     allow_credentials=True,
 )
 
+app.add_middleware(instrumentation.InstrumentationMiddleware)
+
 
 @app.exception_handler(ModelDNE)
 def handle_modeldne(request: Request, exc: ModelDNE):
@@ -83,19 +103,48 @@ def handle_invalid_token(request: Request, exc: InvalidAccessTokenError):
 def handle_invalid_token(request: Request, exc: AccessDeniedError):
     return exc.response()
 
+@app.exception_handler(SyncTokenExpired)
+def handle_sync_token_expired(request: Request, exc: SyncTokenExpired):
+    return exc.response()
+
+@app.exception_handler(ServiceOverloaded)
+def handle_service_overloaded(request: Request, exc: ServiceOverloaded):
+    return exc.response()
+
+@app.exception_handler(InvalidCursor)
+def handle_invalid_cursor(request: Request, exc: InvalidCursor):
+    return exc.response()
+
+@app.exception_handler(CompressionUnavailable)
+def handle_compression_unavailable(request: Request, exc: CompressionUnavailable):
+    return exc.response()
+
 
 @app.get("/status", response_model=None, status_code=204)
-def status():
+async def status():
     pass
 
+
+"""
+    Route to get the metrics of the server in the Prometheus text format
+"""
+@app.get("/metrics", response_class=PlainTextResponse)
+async def get_metrics():
+    return PlainTextResponse(await metrics.exposition(), media_type="text/plain; version=0.0.4; charset=utf-8")
+
 # -------------------------------------- Assignment 2 --------------------------------------
 
 """
     Route to get all the accounts in the database and the number of accounts
 """
 @app.get("/accounts", response_model = AccountList)
-def get_accounts(session: DBSession) -> AccountList:
-    accounts = db.get_accounts(session)
+async def get_accounts(request: Request, response: Response, session: DBSession) -> AccountList:
+    etag = conditional.make_etag(request, db.ACCOUNTS_VERSION, await db.get_version(session, db.ACCOUNTS_VERSION))
+    if conditional.is_not_modified(request, etag):
+        return conditional.not_modified(etag)
+    conditional.set_etag(response, etag)
+
+    accounts = await db.get_accounts(session)
     return AccountList(
         metadata = {"count": len(accounts)},
         accounts = [Account(id=acc.id, username=acc.username) for acc in accounts]
@@ -106,7 +155,7 @@ def get_accounts(session: DBSession) -> AccountList:
     Route to get current account
 """
 @app.get("/accounts/me", response_model=Registration, status_code=200)
-def get_current_account(account: CurrentAccount) -> Registration:
+async def get_current_account(account: CurrentAccount) -> Registration:
     # return account
     return Registration(id=account.id, username=account.username, email=account.email)
 
@@ -115,16 +164,21 @@ def get_current_account(account: CurrentAccount) -> Registration:
     Route to get the account with the specified account_id 
 """
 @app.get("/accounts/{account_id}", response_model=Account)
-def get_account(account_id: int, session: DBSession) -> Account:
-    return db.get_account(session, account_id)
+async def get_account(account_id: int, session: DBSession) -> Account:
+    return await db.get_account(session, account_id)
 
 
 """
     Route to get all the chats in the database and the number of chats
 """
 @app.get("/chats", response_model = ChatList)
-def get_chats(session: DBSession) -> ChatList:
-    chats = db.get_chats(session)
+async def get_chats(request: Request, response: Response, session: DBSession) -> ChatList:
+    etag = conditional.make_etag(request, db.CHATS_VERSION, await db.get_version(session, db.CHATS_VERSION))
+    if conditional.is_not_modified(request, etag):
+        return conditional.not_modified(etag)
+    conditional.set_etag(response, etag)
+
+    chats = await db.get_chats(session)
     return ChatList(
         metadata={"count": len(chats)},
         chats=[Chat(id = chat.id, name = chat.name, owner_id = chat.owner_id) for chat in chats]
@@ -135,18 +189,32 @@ def get_chats(session: DBSession) -> ChatList:
     Route to get the chat with the specified chat_id 
 """
 @app.get("/chats/{chat_id}", response_model = Chat)
-def get_chat(chat_id: int, session: DBSession) -> Chat:
-    return db.get_chat(session, chat_id)
+async def get_chat(chat_id: int, session: DBSession) -> Chat:
+    return await db.get_chat(session, chat_id)
 
 
 """
-    Route to get all messages associated with the specified chat_id and the number of messages
+    Route to get a page of messages associated with the specified chat_id and the number of messages
 """
 @app.get("/chats/{chat_id}/messages", response_model = MessageList)
-def get_messages(chat_id: int, session: DBSession) -> MessageList:
-    messages = db.get_messages(session, chat_id)
+async def get_messages(
+    chat_id: int,
+    request: Request,
+    response: Response,
+    session: DBSession,
+    before: int | None = None,
+    after: int | None = None,
+    limit: Annotated[int, Query(ge=1, le=db.MESSAGE_PAGE_SIZE_MAX)] = db.MESSAGE_PAGE_SIZE,
+) -> MessageList:
+    key = db.chat_version_key(chat_id)
+    etag = conditional.make_etag(request, key, await db.get_chat_version(session, chat_id))
+    if conditional.is_not_modified(request, etag):
+        return conditional.not_modified(etag)
+    conditional.set_etag(response, etag)
+
+    messages, next_cursor = await db.get_messages(session, chat_id, before, after, limit)
     return MessageList(
-        metadata={"count": len(messages)},
+        metadata={"count": len(messages), "next_cursor": next_cursor},
         messages = [Message(id = message.id, text = message.text, account_id = message.account_id, chat_id = message.chat_id, created_at = message.created_at) for message in messages]
     )
 
@@ -155,8 +223,15 @@ def get_messages(chat_id: int, session: DBSession) -> MessageList:
     Route to get all accounts associated with the specified chat_id and the number of accounts
 """
 @app.get("/chats/{chat_id}/accounts", response_model = AccountList)
-def get_chat_id_accounts(chat_id: int, session: DBSession):
-    accounts = db.get_chat_id_accounts(session, chat_id)
+async def get_chat_id_accounts(chat_id: int, request: Request, response: Response, session: DBSession):
+    # The chat's version also covers the usernames of its members, not just the memberships
+    key = db.chat_version_key(chat_id)
+    etag = conditional.make_etag(request, f"{key}.accounts", await db.get_chat_version(session, chat_id))
+    if conditional.is_not_modified(request, etag):
+        return conditional.not_modified(etag)
+    conditional.set_etag(response, etag)
+
+    accounts = await db.get_chat_id_accounts(session, chat_id)
     return AccountList(
         metadata = {"count": len(accounts)},
         accounts = [Account(id = acc.id, username = acc.username) for acc in accounts]
@@ -168,60 +243,118 @@ def get_chat_id_accounts(chat_id: int, session: DBSession):
     Route to post chats
 """
 @app.post("/chats", response_model = Chat, status_code = 201)
-def create_chat(chat: CreateChat, current_account: CurrentAccount, session: DBSession) -> Chat:
+async def create_chat(chat: CreateChat, current_account: CurrentAccount, session: DBSession) -> Chat:
     if chat.owner_id != current_account.id:
         raise AccessDeniedError("chat")
-    return db.create_chat(session, chat.name, chat.owner_id, current_account.id)
+    return await db.create_chat(session, chat.name, chat.owner_id, current_account.id)
 
 
 """
     Route to put a chat
 """
 @app.put("/chats/{chat_id}", response_model = Chat, status_code = 200)
-def update_chat(chat_id: int, chat: UpdateChat, session: DBSession) -> Chat:
-    return db.update_chat(session, chat_id, chat.name, chat.owner_id)
+async def update_chat(chat_id: int, chat: UpdateChat, session: DBSession) -> Chat:
+    return await db.update_chat(session, chat_id, chat.name, chat.owner_id)
 
 
 """
-    Route to delete a chat
+    Route to delete a chat. A chat with many messages is gone right away but its messages are
+    purged in the background: the answer is then 202 with the job, which /jobs/{job_id} follows.
 """
-@app.delete("/chats/{chat_id}", status_code = 204)
-def delete_chat(chat_id: int, session: DBSession):
-    db.delete_chat(session, chat_id)
+@app.delete("/chats/{chat_id}", status_code = 204, responses={202: {"model": Job}})
+async def delete_chat(chat_id: int, session: DBSession, background_tasks: BackgroundTasks):
+    job = await db.delete_chat(session, chat_id, settings.chat_purge_threshold)
+    if job is None:
+        return Response(status_code=204)
+    return job_accepted(job, session, background_tasks)
 
 
 """
-    Route to create a message
+    Answering 202 with a job queued by the request, and starting it right after the response;
+    the job workers take it over if this one fails
+"""
+def job_accepted(job, session: DBSession, background_tasks: BackgroundTasks) -> JSONResponse:
+    background_tasks.add_task(jobs.run_next, session.bind, job_id=job.id)
+    return JSONResponse(
+        status_code=202,
+        content=Job.model_validate(job, from_attributes=True).model_dump(mode="json"),
+        headers={"Location": f"/jobs/{job.id}"},
+    )
+
+
+"""
+    Route to get the status and progress of a background job started for the current account
+"""
+@app.get("/jobs/{job_id}", response_model=Job)
+async def get_job(job_id: int, current_account: CurrentAccount, session: DBSession) -> Job:
+    return await db.get_job(session, job_id, current_account.id)
+
+
+"""
+    Route to create a message, through the group commit writer when message_group_commit is on
 """
 @app.post("/chats/{chat_id}/messages", response_model=Message, status_code = 201)
-def create_message(chat_id: int, message: CreateMessage, current_account: CurrentAccount, session: DBSession) -> Message:
+async def create_message(chat_id: int, message: CreateMessage, current_account: CurrentAccount, session: DBSession) -> Message:
     if message.account_id != current_account.id:
         raise AccessDeniedError("message")
-    return db.create_message(session, chat_id, message.text, message.account_id)
+    if settings.message_group_commit:
+        # Not holding a connection while the writer, which needs one, gets to the message
+        await session.close()
+        return await group_commit.writer(session.bind).submit(chat_id, message.text, message.account_id)
+    return await db.create_message(session, chat_id, message.text, message.account_id)
+
+
+"""
+    Route to create many messages at once, in a single transaction. Ids come back in the order
+    of the messages; with partial set, the messages that can't be created are listed in errors
+    and get a null id instead of failing the batch.
+"""
+@app.post("/chats/{chat_id}/messages/batch", response_model=MessageBatchResult, status_code = 201)
+async def create_messages(chat_id: int, batch: CreateMessageBatch, current_account: CurrentAccount, session: DBSession) -> MessageBatchResult:
+    # Messages can only be posted on behalf of the current account
+    results = [
+        None if message.account_id == current_account.id else AccessDeniedError("message")
+        for message in batch.messages
+    ]
+    denied = [result for result in results if result is not None]
+    if denied and not batch.partial:
+        raise denied[0]
+
+    allowed = [(message.text, message.account_id) for message, result in zip(batch.messages, results) if result is None]
+    created = iter(await db.create_messages(session, chat_id, allowed, batch.partial))
+    results = [next(created) if result is None else result for result in results]
+
+    ids = [None if isinstance(result, Exception) else result.id for result in results]
+    errors = [
+        BatchError(index=index, **json.loads(result.response().body))
+        for index, result in enumerate(results)
+        if isinstance(result, Exception)
+    ]
+    return MessageBatchResult(metadata={"count": len(ids), "failed": len(errors)}, ids=ids, errors=errors)
 
 
 """
     Route to update a message
 """
 @app.put("/chats/{chat_id}/messages/{message_id}", response_model=Message)
-def update_message(chat_id: int, message_id: int, message: UpdateMessage, session: DBSession) -> Message:
-    return db.update_message(session, chat_id, message_id, message.text)
+async def update_message(chat_id: int, message_id: int, message: UpdateMessage, session: DBSession) -> Message:
+    return await db.update_message(session, chat_id, message_id, message.text)
 
 
 """
     Route to delete a message
 """
 @app.delete("/chats/{chat_id}/messages/{message_id}", status_code = 204)
-def delete_message(chat_id: int, message_id: int, session: DBSession):
-    db.delete_message(session, chat_id, message_id)
+async def delete_message(chat_id: int, message_id: int, session: DBSession):
+    await db.delete_message(session, chat_id, message_id)
 
 
 """
     Route to make an account a member of the specified chat
 """
 @app.post("/chats/{chat_id}/accounts")
-def add_account_as_chat_member(chat_id: int, membership: ChatMembership, response: Response, session: DBSession):
-    chat_membership_object, new_membership_created = db.add_account_as_chat_member(session, chat_id, membership.account_id)
+async def add_account_as_chat_member(chat_id: int, membership: ChatMembership, response: Response, session: DBSession):
+    chat_membership_object, new_membership_created = await db.add_account_as_chat_member(session, chat_id, membership.account_id)
 
     # Setting the appropriate status code
     if new_membership_created:
@@ -235,12 +368,32 @@ def add_account_as_chat_member(chat_id: int, membership: ChatMembership, respons
     }
 
 
+"""
+    Route to add many accounts to a chat at once; accounts that are already members are counted
+    as existing
+"""
+@app.post("/chats/{chat_id}/accounts/batch", response_model=ChatMembershipBatchResult)
+async def add_chat_members(chat_id: int, batch: ChatMembershipBatch, session: DBSession) -> ChatMembershipBatchResult:
+    created, existing = await db.add_chat_members(session, chat_id, batch.account_ids)
+    return ChatMembershipBatchResult(chat_id=chat_id, created=created, existing=existing)
+
+
+"""
+    Route to remove many accounts from a chat at once, keeping their messages without an author;
+    accounts that aren't members are counted as not_members
+"""
+@app.delete("/chats/{chat_id}/accounts/batch", response_model=ChatMembershipRemovalResult)
+async def delete_chat_members(chat_id: int, batch: ChatMembershipBatch, session: DBSession) -> ChatMembershipRemovalResult:
+    removed, not_members = await db.delete_chat_members(session, chat_id, batch.account_ids)
+    return ChatMembershipRemovalResult(chat_id=chat_id, removed=removed, not_members=not_members)
+
+
 """
     Route to delete a chat membership and all corresponding messages
 """
 @app.delete("/chats/{chat_id}/accounts/{account_id}", status_code=204)
-def delete_chat_membership(chat_id: int, account_id: int, session: DBSession):
-    db.delete_chat_membership(session, chat_id, account_id)
+async def delete_chat_membership(chat_id: int, account_id: int, session: DBSession):
+    await db.delete_chat_membership(session, chat_id, account_id)
 
 # -------------------------------------- Assignment 4 --------------------------------------
 
@@ -248,8 +401,8 @@ def delete_chat_membership(chat_id: int, account_id: int, session: DBSession):
     Route to add an authenticated account to the database
 """
 @app.post("/auth/registration", response_model=Registration, status_code=201)
-def register(username: Annotated[str, Form()], email: Annotated[str, Form()], password: Annotated[str, Form()], session: DBSession):
-    account = db.register_account(session, username, email, password)
+async def register(username: Annotated[str, Form()], email: Annotated[str, Form()], password: Annotated[str, Form()], session: DBSession):
+    account = await db.register_account(session, username, email, password)
     return Registration(id=account.id, username=account.username, email=account.email)
 
 
@@ -257,8 +410,9 @@ def register(username: Annotated[str, Form()], email: Annotated[str, Form()], pa
     Route to get the token
 """
 @app.post("/auth/token", response_model=AccessToken, status_code=200)
-def get_token(form: Annotated[Login, Form()], session: DBSession):
-    access_token = auth.generate_token(session, form)
+async def get_token(form: Annotated[Login, Form()], session: DBSession):
+    with instrumentation.timed("auth"):
+        access_token = await auth.generate_token_async(session, form)
     return AccessToken(access_token=access_token, token_type="bearer")
 
 
@@ -266,10 +420,11 @@ def get_token(form: Annotated[Login, Form()], session: DBSession):
     Route to login
 """
 @app.post("/auth/web/login", status_code=204)
-def login(response: Response, username: Annotated[str, Form()], password: Annotated[str, Form()], session: DBSession):
+async def login(response: Response, username: Annotated[str, Form()], password: Annotated[str, Form()], session: DBSession):
     form = Login(username=username, password=password)
     try:
-        access_token = auth.generate_token(session, form)
+        with instrumentation.timed("auth"):
+            access_token = await auth.generate_token_async(session, form)
         response.set_cookie(key="pony_express_token", value=access_token, httponly=True)
     except InvalidCredentials:
         raise
@@ -279,7 +434,7 @@ def login(response: Response, username: Annotated[str, Form()], password: Annota
     Route to logout
 """
 @app.post("/auth/web/logout", status_code=204)
-def logout(response: Response, current_account: CurrentAccount):
+async def logout(response: Response, current_account: CurrentAccount):
     response.delete_cookie(key="pony_express_token")
 
 
@@ -287,8 +442,8 @@ def logout(response: Response, current_account: CurrentAccount):
     Route to update an existing account
 """
 @app.put("/accounts/me", response_model=Registration, status_code=200)
-def update_account(current_account: CurrentAccount, data: UpdateAccount, session: DBSession):
-    updated_account = db.update_account(session, current_account.id, data.username, data.email)
+async def update_account(current_account: CurrentAccount, data: UpdateAccount, session: DBSession):
+    updated_account = await db.update_account(session, current_account.id, data.username, data.email)
     return Registration(id=updated_account.id, username=updated_account.username, email=updated_account.email)
 
 
@@ -296,18 +451,212 @@ def update_account(current_account: CurrentAccount, data: UpdateAccount, session
     Route to update a password
 """
 @app.put("/accounts/me/password", status_code=204)
-def update_password(
+async def update_password(
     old_password: Annotated[str, Form()],
     new_password: Annotated[str, Form()],
     current_account: CurrentAccount, 
     session: DBSession
 ):
-    db.update_password(session, current_account.id, old_password, new_password)
+    await db.update_password(session, current_account.id, old_password, new_password)
+
+
+"""
+    Route to delete the current account. An account that owns chats still being purged is
+    deleted by a job once they are gone: the answer is then 202 with the job.
+"""
+@app.delete("/accounts/me", status_code=204, responses={202: {"model": Job}})
+async def delete_account(session: DBSession, current_account: CurrentAccount, background_tasks: BackgroundTasks):
+    job = await db.delete_account(session, current_account.id)
+    if job is None:
+        return Response(status_code=204)
+    return job_accepted(job, session, background_tasks)
 
+# -------------------------------------- Realtime --------------------------------------
 
 """
-    Route to delete the current account
+    Websocket that pushes the message events of a chat to one of its members
+"""
+@app.websocket("/chats/{chat_id}/ws")
+async def chat_websocket(websocket: WebSocket, chat_id: int, session: DBSession):
+    # Authenticating and checking the membership once, up front
+    try:
+        token = get_websocket_token(websocket)
+        account = await auth.extract_account_async(session, token)
+        await db.account_in_chat_membership(session, chat_id, account.id)
+    except (AuthenticationRequiredError, ExpiredAccessTokenError, InvalidAccessTokenError, ChatMembershipError) as exc:
+        await websocket.close(code=WS_1008_POLICY_VIOLATION, reason=exc.message)
+        return
+    finally:
+        # Don't hold on to a database connection for the lifetime of the socket
+        await session.close()
+
+    # Subscribing before accepting, so no event after the handshake is missed
+    subscription = events.hub.subscribe(chat_id)
+    try:
+        await websocket.accept()
+        await events.relay_to_websocket(websocket, subscription)
+    finally:
+        events.hub.unsubscribe(subscription)
+
+
 """
-@app.delete("/accounts/me", status_code=204)
-def delete_account(session: DBSession, current_account: CurrentAccount):
-    db.delete_account(session, current_account.id)
\ No newline at end of file
+    Route to stream the message events of a chat to one of its members as server-sent events,
+    resuming after the Last-Event-ID header when the client reconnects
+"""
+@app.get("/chats/{chat_id}/events", response_class=StreamingResponse)
+async def chat_events(
+    chat_id: int,
+    current_account: CurrentAccount,
+    session: DBSession,
+    last_event_id: Annotated[int | None, Header(alias="Last-Event-ID")] = None,
+):
+    await db.account_in_chat_membership(session, chat_id, current_account.id)
+
+    # The replay runs while streaming, so each page releases its connection when it is done
+    async def fetch_page(cursor: int):
+        try:
+            return await db.get_messages(session, chat_id, after=cursor, limit=db.MESSAGE_PAGE_SIZE_MAX)
+        finally:
+            await session.close()
+
+    return StreamingResponse(
+        events.sse_stream(chat_id, last_event_id, fetch_page),
+        media_type="text/event-stream",
+        headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"},
+    )
+
+
+"""
+    Route to download all of a chat's messages, in id order, as NDJSON compressed with gzip
+    (the default), zstd or not at all. The body is streamed, so it starts right away and takes
+    the same memory however big the chat is.
+"""
+@app.get("/chats/{chat_id}/export", response_class=StreamingResponse)
+async def export_chat(
+    chat_id: int,
+    current_account: CurrentAccount,
+    session: DBSession,
+    compression: Literal["gzip", "zstd", "none"] = "gzip",
+):
+    await db.get_chat(session, chat_id)
+    await db.account_in_chat_membership(session, chat_id, current_account.id)
+    # Failing here rather than once the response has started
+    export.compressor(compression)
+
+    # The body is read after the session's dependency is done with it, so it closes the session
+    async def body():
+        try:
+            async for chunk in export.stream_export(chat_id, db.export_messages(session, chat_id), compression):
+                yield chunk
+        finally:
+            await session.close()
+
+    media_type, extension = export.COMPRESSIONS[compression]
+    return StreamingResponse(
+        body(),
+        media_type=media_type,
+        headers={"Content-Disposition": f'attachment; filename="chat-{chat_id}{extension}"'},
+    )
+
+
+# -------------------------------------- Delta Sync --------------------------------------
+
+"""
+    Route to get the changes to the current account's chats since a sync token. Without a
+    token, no changes are returned, only the token to sync from after fetching the chats.
+"""
+@app.get("/sync", response_model=SyncResult)
+async def sync(
+    current_account: CurrentAccount,
+    session: DBSession,
+    since: Annotated[int | None, Query(ge=0)] = None,
+    limit: Annotated[int, Query(ge=1, le=db.SYNC_PAGE_SIZE_MAX)] = db.SYNC_PAGE_SIZE,
+) -> SyncResult:
+    if since is None:
+        head = await db.get_change_log_head(session)
+        return SyncResult(metadata={"count": 0, "next_token": str(head), "has_more": False}, changes=[])
+
+    changes, has_more = await db.get_changes(session, current_account.id, since, limit)
+    chats, messages, accounts = await db.get_changed_entities(session, changes)
+
+    results = []
+    for change in changes:
+        result = SyncChange(id=change.id, chat_id=change.chat_id, entity=change.entity, entity_id=change.entity_id, op=change.op)
+        if change.entity == "chat" and change.entity_id in chats:
+            chat = chats[change.entity_id]
+            result.chat = Chat(id=chat.id, name=chat.name, owner_id=chat.owner_id)
+        elif change.entity == "message" and change.entity_id in messages:
+            message = messages[change.entity_id]
+            result.message = Message(id=message.id, text=message.text, account_id=message.account_id, chat_id=message.chat_id, created_at=message.created_at)
+        elif change.entity == "membership" and change.entity_id in accounts:
+            account = accounts[change.entity_id]
+            result.account = Account(id=account.id, username=account.username)
+        results.append(result)
+
+    next_token = str(changes[-1].id if changes else since)
+    return SyncResult(
+        metadata={"count": len(results), "next_token": next_token, "has_more": has_more},
+        changes=results,
+    )
+
+
+# ------------------------------------- Message Search -------------------------------------
+
+"""
+    Route for a member to search the messages of a chat, best match first, with a snippet of each match
+"""
+@app.get("/chats/{chat_id}/messages/search", response_model=MessageSearchResult)
+async def search_messages(
+    chat_id: int,
+    current_account: CurrentAccount,
+    session: DBSession,
+    q: Annotated[str, Query(min_length=1)],
+    cursor: str | None = None,
+    limit: Annotated[int, Query(ge=1, le=db.SEARCH_PAGE_SIZE_MAX)] = db.SEARCH_PAGE_SIZE,
+) -> MessageSearchResult:
+    await db.get_chat(session, chat_id)
+    await db.account_in_chat_membership(session, chat_id, current_account.id)
+    hits, next_cursor = await db.search_messages(session, chat_id, q, cursor, limit)
+    return MessageSearchResult(
+        metadata={"count": len(hits), "next_cursor": next_cursor},
+        hits=[search_hit(*hit) for hit in hits],
+    )
+
+
+"""
+    A search hit as returned by the routes
+"""
+def search_hit(message, rank: float, snippet: str) -> MessageSearchHit:
+    return MessageSearchHit(
+        message=Message(id=message.id, text=message.text, account_id=message.account_id, chat_id=message.chat_id, created_at=message.created_at),
+        # bm25 scores better matches lower, report them higher
+        score=-rank,
+        snippet=snippet,
+    )
+
+
+"""
+    Route to search every chat the current account is a member of, grouped by chat with the
+    number of hits in each, best match first
+"""
+@app.get("/search", response_model=SearchResult)
+async def search(
+    session: DBSession,
+    account: CurrentAccount,
+    q: Annotated[str, Query(min_length=1)],
+    cursor: str | None = None,
+    limit: Annotated[int, Query(ge=1, le=db.SEARCH_CHATS_PAGE_SIZE_MAX)] = db.SEARCH_CHATS_PAGE_SIZE,
+    hits: Annotated[int, Query(ge=1, le=db.SEARCH_HITS_PER_CHAT_MAX)] = db.SEARCH_HITS_PER_CHAT,
+) -> SearchResult:
+    chats, next_cursor = await db.search_chats(session, account.id, q, cursor, limit, hits)
+    return SearchResult(
+        metadata={"count": len(chats), "next_cursor": next_cursor},
+        chats=[
+            ChatSearchResult(
+                chat=Chat(id=chat.id, name=chat.name, owner_id=chat.owner_id),
+                count=count,
+                hits=[search_hit(*hit) for hit in chat_hits],
+            )
+            for chat, count, chat_hits in chats
+        ],
+    )
@@ -0,0 +1,308 @@
+"""Prometheus metrics for the API, served in the text exposition format at /metrics.
+
+Each worker keeps its own request counters and histograms. They are only updated from the
+worker's event loop, so they need no locks. The other metrics (threadpool, database pool,
+password hashing, caches) are read from their owners when a snapshot is taken.
+
+With several workers, set `metrics_dir` to a directory they all share. Every worker writes a
+snapshot of its metrics there every `metrics_write_interval` seconds and before answering a
+scrape, and the scrape adds up every worker's snapshot, so whichever worker Prometheus reaches
+reports the whole server. Snapshots of workers that have exited keep counting towards the
+counters and histograms, so totals never go backwards, but their gauges are left out. Empty the
+directory when the server (not a worker) starts.
+
+Args:
+    REQUEST_BUCKETS (tuple[float, ...]): Upper bounds of the request latency histogram, in seconds
+    POOL_WAIT_BUCKETS (tuple[float, ...]): Upper bounds of the connection checkout wait histogram
+"""
+
+import asyncio
+import contextvars
+import glob
+import json
+import logging
+import os
+import time
+
+import anyio.to_thread
+from sqlalchemy import event
+from sqlalchemy.orm import Session
+from starlette.concurrency import run_in_threadpool
+
+from backend import cache, hashing
+from backend.settings import settings
+
+logger = logging.getLogger(__name__)
+
+REQUEST_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+POOL_WAIT_BUCKETS = (0.001, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 5.0)
+
+# name: (type, help)
+FAMILIES = {
+    "http_requests_total": ("counter", "HTTP requests handled, by route and status"),
+    "http_request_duration_seconds": ("histogram", "Time to handle an HTTP request, by route"),
+    "http_requests_in_flight": ("gauge", "HTTP requests being handled"),
+    "threadpool_threads_max": ("gauge", "Threads the threadpool may run at once"),
+    "threadpool_threads_busy": ("gauge", "Threadpool threads running a task"),
+    "threadpool_tasks_waiting": ("gauge", "Tasks waiting for a threadpool thread"),
+    "db_pool_size": ("gauge", "Connections the database pool keeps open"),
+    "db_pool_checked_out": ("gauge", "Database connections in use"),
+    "db_pool_overflow": ("gauge", "Database connections open beyond the pool size"),
+    "db_pool_checkout_wait_seconds": ("histogram", "Time a request waited for a database connection"),
+    "password_hash_in_flight": ("gauge", "Password hashes and checks running or queued"),
+    "password_hash_queue_depth": ("gauge", "Password hashes and checks waiting for a hashing process"),
+    "password_hash_capacity": ("gauge", "Password hashes and checks accepted at once before shedding"),
+    "password_hash_rejected_total": ("counter", "Password hashes and checks shed with 503"),
+    "password_hash_duration_seconds": ("histogram", "Time to hash or check a password, queueing included"),
+    "cache_hits_total": ("counter", "Authentication cache hits"),
+    "cache_misses_total": ("counter", "Authentication cache misses"),
+    "cache_entries": ("gauge", "Entries in the authentication cache"),
+    "cache_hit_ratio": ("gauge", "Share of authentication cache lookups that were hits"),
+}
+
+
+"""
+    A histogram with fixed buckets and one series per set of labels
+"""
+class Histogram:
+    def __init__(self, buckets: tuple[float, ...]):
+        self.buckets = buckets
+        # labels -> [count per bucket..., count above the last bucket, sum]
+        self.series: dict[tuple, list] = {}
+
+    def observe(self, labels: tuple, value: float):
+        series = self.series.get(labels)
+        if series is None:
+            series = self.series[labels] = [0] * (len(self.buckets) + 1) + [0.0]
+        for i, bound in enumerate(self.buckets):
+            if value <= bound:
+                series[i] += 1
+                break
+        else:
+            series[len(self.buckets)] += 1
+        series[-1] += value
+
+    def samples(self, name: str, label_names: tuple[str, ...]) -> list:
+        samples = []
+        for labels, series in self.series.items():
+            labels = dict(zip(label_names, labels))
+            cumulative = 0
+            for bound, count in zip((*self.buckets, "+Inf"), series):
+                cumulative += count
+                samples.append([f"{name}_bucket", {**labels, "le": str(bound)}, cumulative])
+            samples.append([f"{name}_sum", labels, series[-1]])
+            samples.append([f"{name}_count", labels, cumulative])
+        return samples
+
+
+# Updated from the event loop only
+requests_total: dict[tuple[str, str, int], int] = {}
+requests_in_flight: dict[str, int] = {}
+request_duration = Histogram(REQUEST_BUCKETS)
+pool_wait = Histogram(POOL_WAIT_BUCKETS)
+pools: dict = {}
+
+
+def request_started(method: str):
+    requests_in_flight[method] = requests_in_flight.get(method, 0) + 1
+
+def request_finished(method: str, route: str, status: int, seconds: float):
+    requests_in_flight[method] -= 1
+    key = (method, route, status)
+    requests_total[key] = requests_total.get(key, 0) + 1
+    request_duration.observe((method, route), seconds)
+
+
+# When the current session began the transaction it is checking a connection out for
+_checkout_started: contextvars.ContextVar[float | None] = contextvars.ContextVar("checkout_started", default=None)
+
+
+@event.listens_for(Session, "after_transaction_create")
+def _start_checkout(session, transaction):
+    if transaction.parent is None:
+        _checkout_started.set(time.perf_counter())
+
+
+# A transaction that ended without a checkout mustn't be timed by the next one from elsewhere
+@event.listens_for(Session, "after_transaction_end")
+def _end_checkout(session, transaction):
+    if transaction.parent is None:
+        _checkout_started.set(None)
+
+
+"""
+    Timing how long every checkout from a queue pool waits for a connection, under the pool's
+    name. Pools have no event before a checkout, so the wait starts when a session begins the
+    transaction it needs the connection for, and ends at the pool's checkout event: requests that
+    never query the database aren't made to check a connection out, and the ones that do are
+    timed when they first need it.
+"""
+def time_checkouts(name: str, pool):
+    if not hasattr(pool, "checkedout"):
+        return
+
+    @event.listens_for(pool, "checkout")
+    def checkout(dbapi_connection, connection_record, connection_proxy):
+        started = _checkout_started.get()
+        if started is not None:
+            _checkout_started.set(None)
+            pool_wait.observe((name,), time.perf_counter() - started)
+
+
+"""
+    Reporting the size and use of a database pool under a name
+"""
+def watch_pool(name: str, pool):
+    pools[name] = pool
+
+
+"""
+    Taking a snapshot of this worker's metrics, as a list of [sample name, labels, value]
+    per metric family. Called on the event loop, which the threadpool statistics belong to.
+"""
+def snapshot() -> dict:
+    metrics = {name: [] for name in FAMILIES}
+
+    for (method, route, status), count in requests_total.items():
+        metrics["http_requests_total"].append(["http_requests_total", {"method": method, "route": route, "status": str(status)}, count])
+    metrics["http_request_duration_seconds"] = request_duration.samples("http_request_duration_seconds", ("method", "route"))
+    for method, count in requests_in_flight.items():
+        metrics["http_requests_in_flight"].append(["http_requests_in_flight", {"method": method}, count])
+
+    limiter = anyio.to_thread.current_default_thread_limiter()
+    metrics["threadpool_threads_max"].append(["threadpool_threads_max", {}, limiter.total_tokens])
+    metrics["threadpool_threads_busy"].append(["threadpool_threads_busy", {}, limiter.borrowed_tokens])
+    metrics["threadpool_tasks_waiting"].append(["threadpool_tasks_waiting", {}, limiter.statistics().tasks_waiting])
+
+    for name, pool in pools.items():
+        # Only queue pools keep connections around; the others have nothing to report
+        if hasattr(pool, "checkedout"):
+            metrics["db_pool_size"].append(["db_pool_size", {"pool": name}, pool.size()])
+            metrics["db_pool_checked_out"].append(["db_pool_checked_out", {"pool": name}, pool.checkedout()])
+            metrics["db_pool_overflow"].append(["db_pool_overflow", {"pool": name}, max(pool.overflow(), 0)])
+    metrics["db_pool_checkout_wait_seconds"] = pool_wait.samples("db_pool_checkout_wait_seconds", ("pool",))
+
+    hasher = hashing.hasher.metrics()
+    for field in ("in_flight", "queue_depth", "capacity", "rejected_total"):
+        metrics[f"password_hash_{field}"].append([f"password_hash_{field}", {}, hasher[field]])
+    duration = metrics["password_hash_duration_seconds"]
+    for bound, count in hasher["latency_seconds_buckets"].items():
+        duration.append(["password_hash_duration_seconds_bucket", {"le": bound}, count])
+    duration.append(["password_hash_duration_seconds_bucket", {"le": "+Inf"}, hasher["latency_seconds_count"]])
+    duration.append(["password_hash_duration_seconds_sum", {}, hasher["latency_seconds_sum"]])
+    duration.append(["password_hash_duration_seconds_count", {}, hasher["latency_seconds_count"]])
+
+    for name, ttl_cache in (("tokens", cache.token_cache), ("accounts", cache.account_cache)):
+        stats = ttl_cache.stats()
+        metrics["cache_hits_total"].append(["cache_hits_total", {"cache": name}, stats["hits"]])
+        metrics["cache_misses_total"].append(["cache_misses_total", {"cache": name}, stats["misses"]])
+        metrics["cache_entries"].append(["cache_entries", {"cache": name}, stats["size"]])
+
+    return {"pid": os.getpid(), "metrics": metrics}
+
+
+"""
+    Writing a snapshot of this worker to the shared metrics directory, replacing the previous
+    one. Blocks on the file, so the event loop runs it in the threadpool.
+"""
+def write_snapshot(directory: str, current: dict):
+    os.makedirs(directory, exist_ok=True)
+    path = os.path.join(directory, f"metrics-{os.getpid()}.json")
+    with open(f"{path}.tmp", "w") as file:
+        json.dump(current, file)
+    os.replace(f"{path}.tmp", path)
+
+
+"""
+    Reading the snapshots of every worker from the shared metrics directory
+"""
+def read_snapshots(directory: str) -> list[dict]:
+    snapshots = []
+    for path in glob.glob(os.path.join(directory, "metrics-*.json")):
+        try:
+            with open(path) as file:
+                snapshots.append(json.load(file))
+        except (OSError, ValueError):
+            # removed or being replaced in the meantime
+            continue
+    return snapshots
+
+
+def _is_running(pid: int) -> bool:
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        pass
+    return True
+
+
+"""
+    Adding up the samples of several snapshots. Gauges only count for the workers still running.
+"""
+def merge(snapshots: list[dict]) -> dict[str, dict[tuple, float]]:
+    merged = {name: {} for name in FAMILIES}
+    for snapshot in snapshots:
+        running = snapshot["pid"] == os.getpid() or _is_running(snapshot["pid"])
+        for name, samples in snapshot["metrics"].items():
+            if name not in FAMILIES or (FAMILIES[name][0] == "gauge" and not running):
+                continue
+            for sample_name, labels, value in samples:
+                key = (sample_name, tuple(sorted(labels.items())))
+                merged[name][key] = merged[name].get(key, 0) + value
+
+    # A ratio of the totals, which is what adding up each worker's ratio wouldn't give
+    for (_, labels), hits in merged["cache_hits_total"].items():
+        misses = merged["cache_misses_total"].get(("cache_misses_total", labels), 0)
+        merged["cache_hit_ratio"][("cache_hit_ratio", labels)] = hits / (hits + misses) if hits + misses else 0.0
+    return merged
+
+
+def _escape(value) -> str:
+    return str(value).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+
+def _format_labels(labels: tuple) -> str:
+    if not labels:
+        return ""
+    return "{" + ",".join(f'{key}="{_escape(value)}"' for key, value in labels) + "}"
+
+def _format_value(value: float) -> str:
+    return str(int(value)) if float(value).is_integer() else repr(float(value))
+
+
+"""
+    Rendering merged samples in the Prometheus text exposition format
+"""
+def render(merged: dict[str, dict[tuple, float]]) -> str:
+    lines = []
+    for name, (metric_type, help) in FAMILIES.items():
+        lines.append(f"# HELP {name} {help}")
+        lines.append(f"# TYPE {name} {metric_type}")
+        for (sample_name, labels), value in merged[name].items():
+            lines.append(f"{sample_name}{_format_labels(labels)} {_format_value(value)}")
+    return "\n".join(lines) + "\n"
+
+
+"""
+    The metrics of the whole server: every worker's when they share a metrics directory,
+    otherwise this worker's
+"""
+async def exposition() -> str:
+    if settings.metrics_dir is None:
+        return render(merge([snapshot()]))
+    # Snapshots are taken on the event loop, files are written and read in the threadpool
+    await run_in_threadpool(write_snapshot, settings.metrics_dir, snapshot())
+    return render(merge(await run_in_threadpool(read_snapshots, settings.metrics_dir)))
+
+
+"""
+    Writing this worker's snapshot every metrics_write_interval seconds until cancelled
+"""
+async def write_snapshots_periodically(directory: str):
+    while True:
+        try:
+            await run_in_threadpool(write_snapshot, directory, snapshot())
+        except Exception:
+            logger.exception("Writing the metrics snapshot failed")
+        await asyncio.sleep(settings.metrics_write_interval)
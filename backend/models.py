@@ -1,7 +1,8 @@
 # For response models
 
 from datetime import datetime
-from pydantic import BaseModel
+from pydantic import BaseModel, Field
+from backend.settings import settings
 
 # -------------------------------------- Assignment 2 --------------------------------------
 
@@ -32,8 +33,11 @@ class ChatList(BaseModel):
     metadata: Metadata
     chats: list[Chat]
 
+class MessageMetadata(Metadata):
+    next_cursor: int | None = None
+
 class MessageList(BaseModel):
-    metadata: Metadata
+    metadata: MessageMetadata
     messages: list[Message]
 
 # -------------------------------------- Assignment 3 --------------------------------------
@@ -79,4 +83,97 @@ class Claims(BaseModel):
 
 class UpdateAccount(BaseModel):
     username: str | None = None
-    email: str | None = None
\ No newline at end of file
+    email: str | None = None
+
+# -------------------------------------- Delta Sync --------------------------------------
+
+class SyncChange(BaseModel):
+    id: int
+    chat_id: int
+    entity: str
+    entity_id: int
+    op: str
+    chat: Chat | None = None
+    message: Message | None = None
+    account: Account | None = None
+
+class SyncMetadata(BaseModel):
+    count: int
+    next_token: str
+    has_more: bool
+
+class SyncResult(BaseModel):
+    metadata: SyncMetadata
+    changes: list[SyncChange]
+
+# ------------------------------------- Message Search -------------------------------------
+
+class MessageSearchHit(BaseModel):
+    message: Message
+    score: float
+    snippet: str
+
+class SearchMetadata(Metadata):
+    next_cursor: str | None = None
+
+class MessageSearchResult(BaseModel):
+    metadata: SearchMetadata
+    hits: list[MessageSearchHit]
+
+class ChatSearchResult(BaseModel):
+    chat: Chat
+    count: int
+    hits: list[MessageSearchHit]
+
+class SearchResult(BaseModel):
+    metadata: SearchMetadata
+    chats: list[ChatSearchResult]
+
+# ------------------------------------- Batch Ingestion -------------------------------------
+
+class CreateMessageBatch(BaseModel):
+    messages: list[CreateMessage] = Field(min_length=1, max_length=settings.message_batch_size_max)
+    # report the messages that can't be created instead of failing the whole batch
+    partial: bool = False
+
+class BatchError(BaseModel):
+    index: int
+    error: str
+    message: str
+
+class BatchMetadata(Metadata):
+    failed: int
+
+class MessageBatchResult(BaseModel):
+    metadata: BatchMetadata
+    ids: list[int | None]
+    errors: list[BatchError]
+
+class ChatMembershipBatch(BaseModel):
+    account_ids: list[int] = Field(min_length=1, max_length=settings.membership_batch_size_max)
+
+class ChatMembershipBatchResult(BaseModel):
+    chat_id: int
+    created: int
+    existing: int
+
+class ChatMembershipRemovalResult(BaseModel):
+    chat_id: int
+    removed: int
+    not_members: int
+
+# ------------------------------------- Background Jobs -------------------------------------
+
+class Job(BaseModel):
+    id: int
+    kind: str
+    target_id: int | None
+    status: str
+    attempts: int
+    max_attempts: int
+    run_at: datetime
+    done: int
+    total: int | None
+    error: str | None
+    created_at: datetime
+    updated_at: datetime
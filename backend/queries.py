@@ -1,11 +1,30 @@
 # For database query functions
 
 from backend.exceptions import *
+from datetime import datetime, timedelta
+from sqlalchemy import DateTime, and_, column, delete, func, literal, literal_column, or_, table, update
+from sqlalchemy.dialects.sqlite import insert
 from sqlmodel import Session, select
-from backend.database.schema import DBAccount, DBChat, DBMessage, DBChatMembership
+from backend.database.schema import DBAccount, DBChat, DBMessage, DBChatMembership, DBVersion, DBChange, DBJob, DBImportCheckpoint
 from backend.models import Account, AccountList, Chat, Message, MessageList
+from backend import cache, events, hashing
 # from backend.dependencies import engine
-import bcrypt
+
+MESSAGE_PAGE_SIZE = 100
+MESSAGE_PAGE_SIZE_MAX = 1000
+SYNC_PAGE_SIZE = 500
+SYNC_PAGE_SIZE_MAX = 5000
+COMPACTION_BATCH_SIZE = 10000
+SEARCH_PAGE_SIZE = 20
+SEARCH_PAGE_SIZE_MAX = 100
+SEARCH_REBUILD_BATCH_SIZE = 5000
+SEARCH_CHATS_PAGE_SIZE = 20
+SEARCH_CHATS_PAGE_SIZE_MAX = 100
+SEARCH_HITS_PER_CHAT = 3
+SEARCH_HITS_PER_CHAT_MAX = 20
+CHAT_PURGE_BATCH_SIZE = 5000
+EXPORT_BATCH_SIZE = 1000
+IMPORT_BATCH_SIZE = 10000
 
 # -------------------------------------- Assignment 2 --------------------------------------
 
@@ -39,7 +58,7 @@ def get_account_by_username(session: Session, username: str) -> DBAccount | None
     Getting all chats in the database
 """
 def get_chats(session: Session) -> list[Chat]:
-    stmt = select(DBChat).order_by(DBChat.id)
+    stmt = select(DBChat).where(~_being_purged(DBChat.id)).order_by(DBChat.id)
     results = session.exec(stmt)
     return list(results)
 
@@ -53,13 +72,41 @@ def get_chat(session: Session, chat_id: int) -> Chat:
 
 
 """
-    Getting all messages associated with chat_id
+    Getting a page of messages associated with chat_id, keyed on the message id.
+    With `after` the page walks forwards from the cursor, otherwise backwards from `before`, or
+    from the newest message when there is no cursor; next_cursor continues in the same direction
+    and is None on the last page
 """
-def get_messages(session: Session, chat_id: int) -> list[Message]:
+def get_messages(
+    session: Session,
+    chat_id: int,
+    before: int | None = None,
+    after: int | None = None,
+    limit: int = MESSAGE_PAGE_SIZE,
+) -> tuple[list[DBMessage], int | None]:
     chat = chat_exists(session, chat_id)
-    stmt = select(DBMessage).where(DBMessage.chat_id == chat_id).order_by(DBMessage.id)
-    results = session.exec(stmt)
-    return list(results)
+    stmt = select(DBMessage).where(DBMessage.chat_id == chat_id)
+    if after is not None:
+        stmt = stmt.where(DBMessage.id > after)
+    if before is not None:
+        stmt = stmt.where(DBMessage.id < before)
+
+    # Fetching one extra row tells us whether there is another page
+    backwards = before is not None or after is None
+    if backwards:
+        stmt = stmt.order_by(DBMessage.id.desc()).limit(limit + 1)
+    else:
+        stmt = stmt.order_by(DBMessage.id).limit(limit + 1)
+    messages = list(session.exec(stmt))
+
+    has_more = len(messages) > limit
+    messages = messages[:limit]
+    if backwards:
+        messages.reverse()
+        next_cursor = messages[0].id if has_more else None
+    else:
+        next_cursor = messages[-1].id if has_more else None
+    return messages, next_cursor
 
 
 """
@@ -88,15 +135,17 @@ def create_chat(session: Session, chat_name: str, chat_owner_id: int, current_ac
     # Is the name taken?
     check_duplicate_chat_name(session, chat_name)
     
-    # Add chat to the database
+    # Add chat to the database, flushing to get its id
     new_chat = DBChat(name=chat_name, owner_id=chat_owner_id)
     session.add(new_chat)
-    session.commit()
-    session.refresh(new_chat)
+    session.flush()
 
     # Add chat membership to database
     chat_membership = DBChatMembership(account_id=chat_owner_id, chat_id=new_chat.id)
     session.add(chat_membership)
+    record_change(session, new_chat.id, "chat", new_chat.id, "insert")
+    record_change(session, new_chat.id, "membership", chat_owner_id, "insert", account_id=chat_owner_id)
+    bump_versions(session, CHATS_VERSION, chat_version_key(new_chat.id))
     session.commit()
 
     return new_chat
@@ -120,20 +169,34 @@ def update_chat(session: Session, chat_id: int, chat_name: str | None = None, ch
         chat.owner_id = chat_owner_id
 
     session.add(chat)
+    record_change(session, chat_id, "chat", chat_id, "update")
+    bump_versions(session, CHATS_VERSION, chat_version_key(chat_id))
     session.commit()
     session.refresh(chat)
     return chat
 
 
 """
-    Deleting an existing chat
+    Deleting an existing chat, its messages and memberships going with it through the foreign
+    keys. A chat with more than purge_threshold messages is only hidden, and its members removed;
+    the job returned purges its messages in the background (see purge_chat).
 """
-def delete_chat(session: Session, chat_id: int):
+def delete_chat(session: Session, chat_id: int, purge_threshold: int | None = None) -> DBJob | None:
     # Does chat_id correspond to a chat in the database?
     chat = chat_exists(session, chat_id)
     
-    session.delete(chat)
+    # Members lose access to the chat's changes with it, so each gets its own tombstone
+    record_change(session, chat_id, "chat", chat_id, "delete")
+    record_membership_changes(session, "delete", DBChatMembership.chat_id == chat_id)
+    if purge_threshold is not None and has_more_messages(session, chat_id, purge_threshold):
+        session.exec(delete(DBChatMembership).where(DBChatMembership.chat_id == chat_id))
+        job = enqueue_job(session, PURGE_CHAT, chat_id, account_id=chat.owner_id)
+    else:
+        session.delete(chat)
+        job = None
+    bump_versions(session, CHATS_VERSION, chat_version_key(chat_id))
     session.commit()
+    return job
 
 
 """
@@ -144,12 +207,102 @@ def create_message(session: Session, chat_id: int, message_text: str, message_ac
     chat = chat_exists(session, chat_id)
     
     account_in_chat_membership(session, chat_id, message_account_id)
-    
-    message = DBMessage(text=message_text, account_id=message_account_id, chat_id=chat_id)
-    session.add(message)
+
+    return insert_messages(session, [(chat_id, message_text, message_account_id)], [None])[0]
+
+
+"""
+    Creating many messages in a chat in a single transaction. Membership is checked once per
+    distinct author, and the messages go in with one multi-row insert. Returns, in input order,
+    each created message or the error that kept it out: any error fails the whole batch unless
+    partial is set, in which case the other messages are still created.
+"""
+def create_messages(
+    session: Session,
+    chat_id: int,
+    messages: list[tuple[str, int]],
+    partial: bool = False,
+) -> list[DBMessage | Exception]:
+    chat = chat_exists(session, chat_id)
+
+    authors = {account_id for _, account_id in messages}
+    stmt = (
+        select(DBChatMembership.account_id)
+        .where(DBChatMembership.chat_id == chat_id)
+        .where(DBChatMembership.account_id.in_(authors))
+    )
+    members = set(session.exec(stmt))
+    results = [
+        None if account_id in members else ChatMembershipError(account_id=account_id, chat_id=chat_id)
+        for _, account_id in messages
+    ]
+    errors = [result for result in results if result is not None]
+    if errors and not partial:
+        raise errors[0]
+
+    return insert_messages(session, [(chat_id, text, account_id) for text, account_id in messages], results)
+
+
+"""
+    Creating the messages of a group of (chat_id, text, account_id) posts, from any chats, in a
+    single transaction, each checked as create_message would. Chats and memberships are looked
+    up with one query each for the whole group. Returns, in input order, each created message
+    or the error create_message would have raised for it.
+"""
+def create_message_group(session: Session, messages: list[tuple[int, str, int]]) -> list[DBMessage | Exception]:
+    chat_ids = {chat_id for chat_id, _, _ in messages}
+    stmt = select(DBChat.id).where(DBChat.id.in_(chat_ids)).where(~_being_purged(DBChat.id))
+    chats = set(session.exec(stmt))
+    pairs = {(chat_id, account_id) for chat_id, _, account_id in messages if chat_id in chats}
+    stmt = (
+        select(DBChatMembership.chat_id, DBChatMembership.account_id)
+        .where(DBChatMembership.chat_id.in_({chat_id for chat_id, _ in pairs}))
+        .where(DBChatMembership.account_id.in_({account_id for _, account_id in pairs}))
+    )
+    members = {tuple(row) for row in session.exec(stmt)} & pairs
+    results = [
+        ModelDNE(model_name="chat", model_id=chat_id) if chat_id not in chats
+        else None if (chat_id, account_id) in members
+        else ChatMembershipError(account_id=account_id, chat_id=chat_id)
+        for chat_id, _, account_id in messages
+    ]
+    return insert_messages(session, messages, results)
+
+
+"""
+    Inserting the (chat_id, text, account_id) messages that passed their checks, shared by
+    create_message, create_messages and create_message_group. results holds None for every
+    message to insert and the error of every other. The messages go in with one multi-row insert,
+    with their change log entries and the versions of their chats, in one commit, and are
+    published once it is done. Returns results with the created messages in place of the Nones.
+"""
+def insert_messages(session: Session, messages: list[tuple[int, str, int]], results: list[Exception | None]) -> list[DBMessage | Exception]:
+    created_at = datetime.now()
+    rows = [
+        {"text": text, "account_id": account_id, "chat_id": chat_id, "created_at": created_at}
+        for (chat_id, text, account_id), result in zip(messages, results)
+        if result is None
+    ]
+    if not rows:
+        return results
+
+    # RETURNING gives no order, but SQLite inserts the rows in order, each getting the next rowid
+    # (messages has no AUTOINCREMENT, and the write lock keeps other writers out until commit),
+    # so the sorted ids follow the rows. sort_by_parameter_order=True would keep the order too,
+    # but SQLAlchemy has no sentinel for it on SQLite and falls back to one row per statement.
+    ids = sorted(session.exec(insert(DBMessage).returning(DBMessage.id), params=rows).scalars())
+    created = [DBMessage(id=id, **row) for id, row in zip(ids, rows)]
+    session.exec(insert(DBChange), params=[
+        {"chat_id": message.chat_id, "entity": "message", "entity_id": message.id, "op": "insert", "created_at": created_at}
+        for message in created
+    ])
+    bump_versions(session, *sorted({chat_version_key(message.chat_id) for message in created}))
     session.commit()
-    session.refresh(message)
-    return message
+
+    for message in created:
+        events.hub.publish(message.chat_id, events.message_event("message.created", message))
+    created = iter(created)
+    return [next(created) if result is None else result for result in results]
 
 
 """
@@ -163,8 +316,12 @@ def update_message(session: Session, chat_id: int, message_id: int, message_text
     message = verify_message(session, chat_id, message_id)
     
     message.text = message_text
+    record_change(session, chat_id, "message", message_id, "update")
+    bump_versions(session, chat_version_key(chat_id))
     session.commit()
     session.refresh(message)
+
+    events.hub.publish(chat_id, events.message_event("message.updated", message))
     return message
 
 
@@ -177,10 +334,15 @@ def delete_message(session: Session, chat_id: int, message_id: int):
     
     # Does message_id correspond to a message in the database or to a different chat_id?
     message = verify_message(session, chat_id, message_id)
+    event = events.message_event("message.deleted", message)
     
     session.delete(message)
+    record_change(session, chat_id, "message", message_id, "delete")
+    bump_versions(session, chat_version_key(chat_id))
     session.commit()
 
+    events.hub.publish(chat_id, event)
+
 
 """
     Adding an account as a chat member
@@ -201,6 +363,8 @@ def add_account_as_chat_member(session: Session, chat_id: int, account_id):
         # Create new membership if it doesn't already exist
         membership = DBChatMembership(account_id = account_id, chat_id = chat_id)
         session.add(membership)
+        record_change(session, chat_id, "membership", account_id, "insert", account_id=account_id)
+        bump_versions(session, chat_version_key(chat_id))
         session.commit()
         session.refresh(membership)
         return membership, True
@@ -224,7 +388,62 @@ def delete_chat_membership(session: Session, chat_id: int, account_id: int):
     
     # Deleting the chat membership
     session.delete(membership)
+    record_change(session, chat_id, "membership", account_id, "delete", account_id=account_id)
+    bump_versions(session, chat_version_key(chat_id))
+    session.commit()
+
+
+"""
+    Adding many accounts as members of a chat at once. Every account is checked to exist in one
+    query, and the memberships go in with one insert that skips the ones that already exist.
+    Returns the number of memberships created and the number that already existed.
+"""
+def add_chat_members(session: Session, chat_id: int, account_ids: list[int]) -> tuple[int, int]:
+    chat = chat_exists(session, chat_id)
+
+    account_ids = sorted(set(account_ids))
+    found = set(session.exec(select(DBAccount.id).where(DBAccount.id.in_(account_ids))))
+    for account_id in account_ids:
+        if account_id not in found:
+            raise ModelDNE(model_name="account", model_id=account_id)
+
+    stmt = insert(DBChatMembership).on_conflict_do_nothing().returning(DBChatMembership.account_id)
+    created = session.exec(stmt, params=[{"chat_id": chat_id, "account_id": account_id} for account_id in account_ids]).scalars().all()
+    if created:
+        record_membership_changes(
+            session, "insert", (DBChatMembership.chat_id == chat_id) & DBChatMembership.account_id.in_(created)
+        )
+        bump_versions(session, chat_version_key(chat_id))
+    session.commit()
+    return len(created), len(account_ids) - len(created)
+
+
+"""
+    Removing many members from a chat at once, clearing the author of their messages with one
+    update. The owner can't be removed, and accounts that aren't members are skipped. Returns
+    the number of members removed and the number skipped.
+"""
+def delete_chat_members(session: Session, chat_id: int, account_ids: list[int]) -> tuple[int, int]:
+    chat = chat_exists(session, chat_id)
+
+    account_ids = sorted(set(account_ids))
+    if chat.owner_id in account_ids:
+        raise ChatOwnerRemovalError()
+
+    stmt = (
+        select(DBChatMembership.account_id)
+        .where(DBChatMembership.chat_id == chat_id)
+        .where(DBChatMembership.account_id.in_(account_ids))
+    )
+    members = list(session.exec(stmt))
+    if members:
+        condition = (DBChatMembership.chat_id == chat_id) & DBChatMembership.account_id.in_(members)
+        delete_all_messages(session, chat_id, *members)
+        record_membership_changes(session, "delete", condition)
+        session.exec(delete(DBChatMembership).where(condition))
+        bump_versions(session, chat_version_key(chat_id))
     session.commit()
+    return len(members), len(account_ids) - len(members)
 
 # -------------------------------------- Assignment 4 --------------------------------------
 
@@ -232,6 +451,14 @@ def delete_chat_membership(session: Session, chat_id: int, account_id: int):
     Adding a new authenticated account
 """
 def register_account(session: Session, username: str, email: str, password: str):
+    check_account_available(session, username, email)
+    return add_account(session, username, email, hash_password(password))
+
+
+"""
+    Checking that neither the username nor the email belongs to an account yet
+"""
+def check_account_available(session: Session, username: str, email: str):
     # Check if the account with username already exists
     stmt = select(DBAccount).where(DBAccount.username == username)
     existing_account = session.exec(stmt).first()
@@ -243,14 +470,16 @@ def register_account(session: Session, username: str, email: str, password: str)
     existing_account = session.exec(stmt).first()
     if existing_account:
         raise DuplicateModel(model_name="account", field="email", value=email)
-    
-    # Hashing the password
-    salt = bcrypt.gensalt()
-    hashed_password = bcrypt.hashpw(password.encode(encoding="utf-8"), salt).decode(encoding="utf-8")
-    
+
+
+"""
+    Adding an account whose password is already hashed
+"""
+def add_account(session: Session, username: str, email: str, hashed_password: str):
     # Creating and adding the new account
     new_account = DBAccount(username=username, email=email, hashed_password=hashed_password)
     session.add(new_account)
+    bump_versions(session, ACCOUNTS_VERSION)
     session.commit()
     session.refresh(new_account)
     
@@ -264,10 +493,37 @@ def get_verified_user(session: Session, username: str, password: str):
     stmt = select(DBAccount).where(DBAccount.username == username)
     account = session.exec(stmt).one_or_none()
     if account is not None and verify_password(password, account.hashed_password):
+        rehash_password_if_needed(session, account, password)
         return account
     raise InvalidCredentials()
 
 
+"""
+    Rehashing the password of an account that just logged in when its hash was made with another
+    cost factor than the configured one. The login goes ahead with the old hash if the hashing
+    pool is too busy to redo it now.
+"""
+def rehash_password_if_needed(session: Session, account: DBAccount, password: str):
+    if not hashing.hasher.needs_rehash(account.hashed_password):
+        return
+    try:
+        hashed_password = hash_password(password)
+    except ServiceOverloaded:
+        return
+    set_password_hash(session, account, hashed_password)
+
+
+"""
+    Storing a new password hash for an account
+"""
+def set_password_hash(session: Session, account: DBAccount, hashed_password: str):
+    account.hashed_password = hashed_password
+    session.add(account)
+    session.commit()
+    cache.account_cache.invalidate(account.id)
+    session.refresh(account)
+
+
 """
     Updating the username or email of an account
 """
@@ -292,8 +548,13 @@ def update_account(session: Session, id: int, username: str = None, email: str =
             raise DuplicateModel(model_name="account", field="email", value=email)
         account.email = email
     
+    # Usernames are also listed in the accounts of every chat the account belongs to
     session.add(account)
+    if username is not None:
+        record_membership_changes(session, "update", DBChatMembership.account_id == id)
+    bump_versions(session, ACCOUNTS_VERSION, *member_chat_version_keys(session, id))
     session.commit()
+    cache.account_cache.invalidate(id)
     session.refresh(account)
 
     return account
@@ -307,27 +568,718 @@ def update_password(session: Session, id: int, old_pwd: str, new_pwd: str):
 
     if not verify_password(old_pwd, account.hashed_password):
         raise InvalidCredentials()
-    else:
-        account.hashed_password = hash_password(new_pwd)
-    session.add(account)
-    session.commit()
+    set_password_hash(session, account, hash_password(new_pwd))
 
 
 """
-    Deleting the current account
+    Deleting the current account. An owner can't be deleted, except of chats being purged: they
+    keep their owner until their messages are gone, so the account is then left to the job
+    returned, which finishes their purge and deletes it (see finish_account_deletion).
 """
-def delete_account(session: Session, id: int):
+def delete_account(session: Session, id: int) -> DBJob | None:
     account = account_exists(session, id)
 
-    stmt = select(DBChat).where(DBChat.owner_id == id)
-    chats = session.exec(stmt).first()
-
-    if chats:
+    owned = select(DBChat.id).where(DBChat.owner_id == id)
+    if session.exec(owned.where(~_being_purged(DBChat.id))).first() is not None:
         raise ChatOwnerRemovalError()
+    if session.exec(owned).first() is not None:
+        stmt = (
+            select(DBJob)
+            .where(DBJob.kind == DELETE_ACCOUNT)
+            .where(DBJob.target_id == id)
+            .where(DBJob.status != JOB_DONE)
+        )
+        job = session.exec(stmt).first() or enqueue_job(session, DELETE_ACCOUNT, id, account_id=id)
+        session.commit()
+        return job
+    remove_account(session, account)
+    return None
+
+
+"""
+    Deleting an account that owns no chat
+"""
+def remove_account(session: Session, account: DBAccount):
+    # The account's messages stay behind without an author
+    record_message_changes(session, "update", DBMessage.account_id == account.id)
+    record_membership_changes(session, "delete", DBChatMembership.account_id == account.id)
+    bump_versions(session, ACCOUNTS_VERSION, *member_chat_version_keys(session, account.id))
+    session.delete(account)
+    session.commit()
+    cache.account_cache.invalidate(account.id)
+
+
+# ------------------------------------ Version Counters ------------------------------------
+
+ACCOUNTS_VERSION = "accounts"
+CHATS_VERSION = "chats"
+
+
+"""
+    Getting the key of the version counter covering a chat's messages and accounts
+"""
+def chat_version_key(chat_id: int) -> str:
+    return f"chat:{chat_id}"
+
+
+"""
+    Getting the version counter keys of every chat an account is a member of
+"""
+def member_chat_version_keys(session: Session, account_id: int) -> list[str]:
+    stmt = select(DBChatMembership.chat_id).where(DBChatMembership.account_id == account_id)
+    return [chat_version_key(chat_id) for chat_id in session.exec(stmt)]
+
+
+"""
+    Getting the current value of a version counter, 0 if it was never bumped
+"""
+def get_version(session: Session, key: str) -> int:
+    stmt = select(DBVersion.version).where(DBVersion.key == key)
+    return session.exec(stmt).first() or 0
+
+
+"""
+    Getting the version of a chat's counter in the same query that checks the chat exists, so an
+    unknown chat is not found before any ETag is compared
+"""
+def get_chat_version(session: Session, chat_id: int) -> int:
+    stmt = (
+        select(DBChat.id, DBVersion.version)
+        .outerjoin(DBVersion, DBVersion.key == chat_version_key(chat_id))
+        .where(DBChat.id == chat_id)
+        .where(~_being_purged(DBChat.id))
+    )
+    row = session.exec(stmt).first()
+    if row is None:
+        raise ModelDNE(model_name="chat", model_id=chat_id)
+    return row.version or 0
+
+
+"""
+    Incrementing version counters as part of the caller's transaction
+"""
+def bump_versions(session: Session, *keys: str):
+    stmt = insert(DBVersion).values(version=1)
+    stmt = stmt.on_conflict_do_update(
+        index_elements=[DBVersion.key],
+        set_={"version": DBVersion.version + 1},
+    )
+    session.exec(stmt, params=[{"key": key} for key in keys])
+
+
+"""
+    Setting a counter to a given value as part of the caller's transaction
+"""
+def set_version(session: Session, key: str, version: int):
+    stmt = insert(DBVersion).values(key=key, version=version)
+    stmt = stmt.on_conflict_do_update(index_elements=[DBVersion.key], set_={"version": version})
+    session.exec(stmt)
+
+# -------------------------------------- Change Log --------------------------------------
+
+COMPACTED_THROUGH = "changes.compacted_through"
+CHANGE_COLUMNS = ["chat_id", "entity", "entity_id", "op", "account_id", "created_at"]
+
+
+"""
+    Appending a change to the log as part of the caller's transaction. account_id is set on
+    membership changes, so the member can see them even after leaving the chat.
+"""
+def record_change(session: Session, chat_id: int, entity: str, entity_id: int, op: str, account_id: int | None = None):
+    session.add(DBChange(chat_id=chat_id, entity=entity, entity_id=entity_id, op=op, account_id=account_id))
+
+
+"""
+    Appending a change for every membership matching the condition, in a single statement
+"""
+def record_membership_changes(session: Session, op: str, condition):
+    rows = select(
+        DBChatMembership.chat_id,
+        literal("membership"),
+        DBChatMembership.account_id,
+        literal(op),
+        DBChatMembership.account_id,
+        literal(datetime.now(), DateTime),
+    ).where(condition)
+    session.exec(insert(DBChange).from_select(CHANGE_COLUMNS, rows))
+
+
+"""
+    Appending a change for every message matching the condition, in a single statement
+"""
+def record_message_changes(session: Session, op: str, condition):
+    rows = select(
+        DBMessage.chat_id,
+        literal("message"),
+        DBMessage.id,
+        literal(op),
+        literal(None),
+        literal(datetime.now(), DateTime),
+    ).where(condition)
+    session.exec(insert(DBChange).from_select(CHANGE_COLUMNS, rows))
+
+
+"""
+    Getting the changes visible to an account after the since token: those of the chats it is
+    a member of, and its own membership changes. Returns the changes and whether there are more.
+"""
+def get_changes(session: Session, account_id: int, since: int, limit: int = SYNC_PAGE_SIZE) -> tuple[list[DBChange], bool]:
+    if since < get_version(session, COMPACTED_THROUGH):
+        raise SyncTokenExpired()
+
+    member_chats = select(DBChatMembership.chat_id).where(DBChatMembership.account_id == account_id)
+    stmt = (
+        select(DBChange)
+        .where(DBChange.id > since)
+        .where(or_(DBChange.chat_id.in_(member_chats), DBChange.account_id == account_id))
+        .order_by(DBChange.id)
+        .limit(limit + 1)
+    )
+    changes = list(session.exec(stmt))
+    return changes[:limit], len(changes) > limit
+
+
+"""
+    Getting the id of the newest change, the token to sync from after a full fetch
+"""
+def get_change_log_head(session: Session) -> int:
+    stmt = select(func.max(DBChange.id))
+    return max(session.exec(stmt).one() or 0, get_version(session, COMPACTED_THROUGH))
+
+
+"""
+    Getting the current state of the chats, messages and accounts that changes refer to,
+    keyed by id. Deleted entities are missing.
+"""
+def get_changed_entities(session: Session, changes: list[DBChange]) -> tuple[dict, dict, dict]:
+    ids = {"chat": set(), "message": set(), "membership": set()}
+    for change in changes:
+        if change.op != "delete":
+            ids[change.entity].add(change.entity_id)
+
+    chats = session.exec(select(DBChat).where(DBChat.id.in_(ids["chat"]))) if ids["chat"] else []
+    messages = session.exec(select(DBMessage).where(DBMessage.id.in_(ids["message"]))) if ids["message"] else []
+    accounts = session.exec(select(DBAccount).where(DBAccount.id.in_(ids["membership"]))) if ids["membership"] else []
+    return (
+        {chat.id: chat for chat in chats},
+        {message.id: message for message in messages},
+        {account.id: account for account in accounts},
+    )
+
+
+"""
+    Deleting the changes older than the retention window in batches, and recording how far the
+    log was compacted so that older sync tokens are refused instead of silently missing changes
+"""
+def compact_changes(session: Session, retention: timedelta) -> int:
+    cutoff = datetime.now() - retention
+    stmt = select(func.max(DBChange.id)).where(DBChange.created_at < cutoff)
+    compact_through = session.exec(stmt).one()
+    if compact_through is None:
+        return 0
+
+    lower = get_version(session, COMPACTED_THROUGH)
+    deleted = 0
+    while lower < compact_through:
+        upper = min(lower + COMPACTION_BATCH_SIZE, compact_through)
+        result = session.exec(delete(DBChange).where(DBChange.id > lower).where(DBChange.id <= upper))
+        set_version(session, COMPACTED_THROUGH, upper)
+        session.commit()
+        deleted += result.rowcount
+        lower = upper
+    return deleted
+
+# ------------------------------------- Message Search -------------------------------------
+
+messages_fts = table("messages_fts", column("rowid"), column("text"), column("rank"))
+
+# Marks around the matched terms in snippets
+SNIPPET_START = "["
+SNIPPET_END = "]"
+SNIPPET_TOKENS = 12
+
+
+"""
+    Turning what the user typed into an FTS5 query: every word must appear, and the last one
+    may be the start of a word, so results show up while typing. Quoting each word keeps FTS5
+    operators and punctuation from being read as query syntax.
+"""
+def search_expression(q: str) -> str | None:
+    terms = ['"' + term.replace('"', '""') + '"' for term in q.split()]
+    if not terms:
+        return None
+    terms[-1] += "*"
+    return " ".join(terms)
+
+
+"""
+    Encoding the position after a search hit (or chat) as a cursor, and reading it back
+"""
+def encode_search_cursor(rank: float, id: int) -> str:
+    return f"{rank!r}:{id}"
+
+def decode_search_cursor(cursor: str) -> tuple[float, int]:
+    try:
+        rank, id = cursor.split(":")
+        return float(rank), int(id)
+    except ValueError:
+        raise InvalidCursor(cursor)
+
+
+"""
+    The MATCH condition and the snippet function for the search index
+"""
+def _match(fts, expression: str):
+    return literal_column(fts.name).op("MATCH")(expression)
+
+def _snippet(fts):
+    return func.snippet(literal_column(fts.name), 0, SNIPPET_START, SNIPPET_END, "…", SNIPPET_TOKENS)
+
+
+"""
+    Getting a page of the messages of a chat that match a search, best match first, with a
+    snippet around the matched terms. FTS5's rank is the bm25 score, lower being better, so the
+    pages are ordered by (rank, id) and the cursor is the last pair of a page.
+"""
+def search_messages(
+    session: Session,
+    chat_id: int,
+    q: str,
+    cursor: str | None = None,
+    limit: int = SEARCH_PAGE_SIZE,
+) -> tuple[list[tuple[DBMessage, float, str]], str | None]:
+    chat_exists(session, chat_id)
+    expression = search_expression(q)
+    if expression is None:
+        return [], None
+
+    rank = messages_fts.c.rank
+    stmt = (
+        select(DBMessage, rank, _snippet(messages_fts))
+        .join(messages_fts, messages_fts.c.rowid == DBMessage.id)
+        .where(_match(messages_fts, expression))
+        .where(DBMessage.chat_id == chat_id)
+    )
+    if cursor is not None:
+        after_rank, after_id = decode_search_cursor(cursor)
+        stmt = stmt.where(or_(rank > after_rank, and_(rank == after_rank, DBMessage.id > after_id)))
+    stmt = stmt.order_by(rank, DBMessage.id).limit(limit + 1)
+    hits = [tuple(row) for row in session.exec(stmt)]
+
+    has_more = len(hits) > limit
+    hits = hits[:limit]
+    next_cursor = encode_search_cursor(hits[-1][1], hits[-1][0].id) if has_more else None
+    return hits, next_cursor
+
+
+"""
+    Searching every chat the account is a member of. The matches are joined with the account's
+    memberships inside the query, so only matches in its chats are ever read, whatever the number
+    of chats. Chats come best match first with their number of hits, a page of chats at a time
+    with a (best rank, chat id) cursor, each with its best few hits.
+"""
+def search_chats(
+    session: Session,
+    account_id: int,
+    q: str,
+    cursor: str | None = None,
+    limit: int = SEARCH_CHATS_PAGE_SIZE,
+    hits_per_chat: int = SEARCH_HITS_PER_CHAT,
+) -> tuple[list[tuple[DBChat, int, list[tuple[DBMessage, float, str]]]], str | None]:
+    expression = search_expression(q)
+    if expression is None:
+        return [], None
+
+    # The page of chats, with their hit counts and best rank
+    rank = messages_fts.c.rank
+    best = func.min(rank)
+    stmt = (
+        select(DBMessage.chat_id, func.count(), best)
+        .select_from(messages_fts)
+        .join(DBMessage, DBMessage.id == messages_fts.c.rowid)
+        .join(DBChatMembership, and_(DBChatMembership.chat_id == DBMessage.chat_id, DBChatMembership.account_id == account_id))
+        .where(_match(messages_fts, expression))
+        .group_by(DBMessage.chat_id)
+    )
+    if cursor is not None:
+        after_rank, after_chat_id = decode_search_cursor(cursor)
+        stmt = stmt.having(or_(best > after_rank, and_(best == after_rank, DBMessage.chat_id > after_chat_id)))
+    stmt = stmt.order_by(best, DBMessage.chat_id).limit(limit + 1)
+    groups = list(session.exec(stmt))
+
+    has_more = len(groups) > limit
+    groups = groups[:limit]
+    next_cursor = encode_search_cursor(groups[-1][2], groups[-1][0]) if has_more else None
+    if not groups:
+        return [], next_cursor
+    chat_ids = [chat_id for chat_id, _, _ in groups]
+
+    # The best hits of each of those chats; snippets are only made for the hits that are kept
+    position = func.row_number().over(partition_by=DBMessage.chat_id, order_by=(rank, DBMessage.id))
+    top_hits = (
+        select(DBMessage.id.label("id"), position.label("position"))
+        .select_from(messages_fts)
+        .join(DBMessage, DBMessage.id == messages_fts.c.rowid)
+        .where(_match(messages_fts, expression))
+        .where(DBMessage.chat_id.in_(chat_ids))
+        .subquery("top_hits")
+    )
+    stmt = (
+        select(DBMessage, rank, _snippet(messages_fts))
+        .select_from(top_hits)
+        .join(messages_fts, messages_fts.c.rowid == top_hits.c.id)
+        .join(DBMessage, DBMessage.id == top_hits.c.id)
+        .where(_match(messages_fts, expression))
+        .where(top_hits.c.position <= hits_per_chat)
+        .order_by(top_hits.c.position)
+    )
+    hits = {chat_id: [] for chat_id in chat_ids}
+    for message, hit_rank, snippet in session.exec(stmt):
+        hits[message.chat_id].append((message, hit_rank, snippet))
+
+    chats = {chat.id: chat for chat in session.exec(select(DBChat).where(DBChat.id.in_(chat_ids)))}
+    return [(chats[chat_id], count, hits[chat_id]) for chat_id, count, _ in groups], next_cursor
+
+
+"""
+    Reindexing every message for search, in batches of ids that each commit on their own so
+    writers are never held up for long. Each batch replaces whatever the index holds for its
+    ids, so it is safe to run while messages are written; messages newer than the start of the
+    rebuild are indexed by the triggers.
+"""
+def rebuild_message_search(session: Session, batch_size: int = SEARCH_REBUILD_BATCH_SIZE, progress=None) -> int:
+    head = session.exec(select(func.max(DBMessage.id))).one() or 0
+    indexed = 0
+    lower = 0
+    while lower < head:
+        upper = min(lower + batch_size, head)
+        session.exec(delete(messages_fts).where(messages_fts.c.rowid > lower).where(messages_fts.c.rowid <= upper))
+        messages = select(DBMessage.id, DBMessage.text).where(DBMessage.id > lower).where(DBMessage.id <= upper)
+        result = session.exec(messages_fts.insert().from_select(["rowid", "text"], messages))
+        session.commit()
+        indexed += result.rowcount
+        lower = upper
+        if progress is not None:
+            progress(indexed, upper, head)
+    return indexed
+
+# -------------------------------------- Chat Export --------------------------------------
+
+"""
+    Reading a batch of a chat's messages for an export, the first limit after the id after in id
+    order, as plain rows rather than models since a chat can have millions of them
+"""
+def export_messages(session: Session, chat_id: int, after: int = 0, limit: int = EXPORT_BATCH_SIZE) -> list:
+    stmt = (
+        select(DBMessage.id, DBMessage.chat_id, DBMessage.account_id, DBMessage.text, DBMessage.created_at)
+        .where(DBMessage.chat_id == chat_id)
+        .where(DBMessage.id > after)
+        .order_by(DBMessage.id)
+        .limit(limit)
+    )
+    return session.exec(stmt).all()
+
+# ------------------------------------- History Import -------------------------------------
+
+"""
+    Getting the ids of the accounts with the given usernames, leaving out the ones that don't exist
+"""
+def get_account_ids_by_username(session: Session, usernames: list[str]) -> dict[str, int]:
+    stmt = select(DBAccount.username, DBAccount.id).where(DBAccount.username.in_(usernames))
+    return dict(session.exec(stmt).all())
+
+
+"""
+    Getting which of the accounts are members of a chat
+"""
+def get_chat_member_ids(session: Session, chat_id: int, account_ids: list[int]) -> set[int]:
+    stmt = (
+        select(DBChatMembership.account_id)
+        .where(DBChatMembership.chat_id == chat_id)
+        .where(DBChatMembership.account_id.in_(account_ids))
+    )
+    return set(session.exec(stmt))
+
+
+"""
+    Getting how far an import from a source got, if it was started
+"""
+def get_import_checkpoint(session: Session, source: str) -> DBImportCheckpoint | None:
+    return session.get(DBImportCheckpoint, source)
+
+
+"""
+    Inserting a batch of imported (text, account_id, created_at) messages into a chat with
+    their change log entries, and moving the source's checkpoint past them, all in one
+    transaction: a batch is either imported and checkpointed, or neither. Returns the new ids.
+"""
+def import_messages(
+    session: Session,
+    chat_id: int,
+    messages: list[tuple[str, int | None, datetime]],
+    source: str,
+    offset: int,
+    lines: int,
+) -> list[int]:
+    now = datetime.now()
+    rows = [
+        {"text": text, "account_id": account_id, "chat_id": chat_id, "created_at": created_at}
+        for text, account_id, created_at in messages
+    ]
+    ids = []
+    if rows:
+        ids = sorted(session.exec(insert(DBMessage).returning(DBMessage.id), params=rows).scalars())
+        session.exec(insert(DBChange), params=[
+            {"chat_id": chat_id, "entity": "message", "entity_id": id, "op": "insert", "created_at": now}
+            for id in ids
+        ])
+        bump_versions(session, chat_version_key(chat_id))
+
+    checkpoint = {"chat_id": chat_id, "offset": offset, "lines": lines, "imported": len(ids), "updated_at": now}
+    stmt = insert(DBImportCheckpoint).values(source=source, **checkpoint)
+    stmt = stmt.on_conflict_do_update(
+        index_elements=[DBImportCheckpoint.source],
+        set_={**checkpoint, "imported": DBImportCheckpoint.imported + len(ids)},
+    )
+    session.exec(stmt)
+    session.commit()
+    return ids
+
+# ------------------------------------- Background Jobs -------------------------------------
+
+PURGE_CHAT = "purge_chat"
+DELETE_ACCOUNT = "delete_account"
+COMPACT_CHANGE_LOG = "compact_change_log"
+REBUILD_SEARCH_INDEX = "rebuild_search_index"
+JOB_PENDING = "pending"
+JOB_RUNNING = "running"
+JOB_DONE = "done"
+JOB_FAILED = "failed"
+JOB_MAX_ATTEMPTS = 5
+ACCOUNT_DELETION_RECHECK = timedelta(seconds=5)
+
+
+"""
+    Adding a job to the queue, to be run by the job workers once the transaction commits
+"""
+def enqueue_job(
+    session: Session,
+    kind: str,
+    target_id: int | None = None,
+    max_attempts: int = JOB_MAX_ATTEMPTS,
+    run_at: datetime | None = None,
+    account_id: int | None = None,
+) -> DBJob:
+    job = DBJob(
+        kind=kind,
+        target_id=target_id,
+        account_id=account_id,
+        max_attempts=max_attempts,
+        run_at=run_at or datetime.now(),
+    )
+    session.add(job)
+    session.flush()
+    return job
+
+
+"""
+    Queueing a job of a kind to run at run_at, unless one is already waiting to run, and
+    committing. For recurring jobs: when two processes schedule one at the same time, the next
+    run of either finds the other's waiting and doesn't schedule another.
+"""
+def schedule_job(session: Session, kind: str, run_at: datetime) -> DBJob:
+    stmt = select(DBJob).where(DBJob.status == JOB_PENDING).where(DBJob.kind == kind)
+    job = session.exec(stmt).first() or enqueue_job(session, kind, run_at=run_at)
+    session.commit()
+    return job
+
+
+"""
+    Taking the next due job for a worker, or the given job if it is due: a pending job whose
+    run_at has come, or a running one whose lease expired with the worker that had it. Done in
+    one UPDATE, so two workers (in any process) never get the same job.
+"""
+def lease_job(session: Session, worker_id: str, lease: timedelta, job_id: int | None = None) -> DBJob | None:
+    now = datetime.now()
+    due = select(DBJob.id).where(or_(
+        (DBJob.status == JOB_PENDING) & (DBJob.run_at <= now),
+        (DBJob.status == JOB_RUNNING) & (DBJob.leased_until < now),
+    ))
+    if job_id is not None:
+        due = due.where(DBJob.id == job_id)
+    due = due.order_by(DBJob.run_at).limit(1)
+
+    stmt = (
+        update(DBJob)
+        .where(DBJob.id == due.scalar_subquery())
+        .values(status=JOB_RUNNING, leased_by=worker_id, leased_until=now + lease, attempts=DBJob.attempts + 1, updated_at=now)
+        .returning(DBJob)
+    )
+    job = session.exec(stmt).scalars().first()
+    session.commit()
+    return job
+
+
+"""
+    Pushing back the end of a job's lease while its worker is still on it. Returns False when
+    the lease was lost to another worker.
+"""
+def extend_lease(session: Session, job_id: int, worker_id: str, lease: timedelta) -> bool:
+    stmt = (
+        update(DBJob)
+        .where(DBJob.id == job_id)
+        .where(DBJob.leased_by == worker_id)
+        .where(DBJob.status == JOB_RUNNING)
+        .values(leased_until=datetime.now() + lease)
+    )
+    extended = session.exec(stmt).rowcount
+    session.commit()
+    return extended > 0
+
+
+"""
+    Marking a job as done by the worker holding it
+"""
+def complete_job(session: Session, job_id: int, worker_id: str):
+    stmt = (
+        update(DBJob)
+        .where(DBJob.id == job_id)
+        .where(DBJob.leased_by == worker_id)
+        .values(status=JOB_DONE, leased_until=None, error=None, updated_at=datetime.now())
+    )
+    session.exec(stmt)
+    session.commit()
+
+
+"""
+    Recording a failed attempt at a job: it is retried after `backoff` doubled for every
+    attempt before this one, or fails for good once it has used up its attempts
+"""
+def fail_job(session: Session, job_id: int, worker_id: str, error: str, backoff: timedelta):
+    job = get_job(session, job_id)
+    if job.leased_by != worker_id:
+        return
+    now = datetime.now()
+    if job.attempts >= job.max_attempts:
+        job.status = JOB_FAILED
     else:
-        session.delete(account)
+        job.status = JOB_PENDING
+        job.run_at = now + backoff * 2 ** (job.attempts - 1)
+    job.error, job.leased_until, job.updated_at = error, None, now
+    session.commit()
+
+
+"""
+    Putting a job its worker can't run yet back on the queue for delay, giving back the attempt
+    it was leased with
+"""
+def defer_job(session: Session, job_id: int, worker_id: str, delay: timedelta, reason: str):
+    now = datetime.now()
+    stmt = (
+        update(DBJob)
+        .where(DBJob.id == job_id)
+        .where(DBJob.leased_by == worker_id)
+        .values(status=JOB_PENDING, run_at=now + delay, attempts=DBJob.attempts - 1, leased_until=None, error=reason, updated_at=now)
+    )
+    session.exec(stmt)
+    session.commit()
+
+
+"""
+    Queueing failed jobs again with a fresh set of attempts: the given jobs, every failed job of
+    a kind, or every failed job. Returns the ids of the jobs queued again.
+"""
+def retry_jobs(session: Session, job_ids: list[int] | None = None, kind: str | None = None) -> list[int]:
+    now = datetime.now()
+    stmt = update(DBJob).where(DBJob.status == JOB_FAILED)
+    if job_ids is not None:
+        stmt = stmt.where(DBJob.id.in_(job_ids))
+    if kind is not None:
+        stmt = stmt.where(DBJob.kind == kind)
+    stmt = stmt.values(status=JOB_PENDING, attempts=0, run_at=now, updated_at=now).returning(DBJob.id)
+    ids = sorted(session.exec(stmt).scalars())
+    session.commit()
+    return ids
+
+
+"""
+    Getting a background job. Given an account_id, only one started for that account: the others
+    are reported as not found, so their existence isn't given away either.
+"""
+def get_job(session: Session, job_id: int, account_id: int | None = None) -> DBJob:
+    job = session.get(DBJob, job_id)
+    if job is None or (account_id is not None and job.account_id != account_id):
+        raise ModelDNE(model_name="job", model_id=job_id)
+    return job
+
+
+"""
+    Whether the chat is being purged, which hides it until its job is done
+"""
+def _being_purged(chat_id):
+    return (
+        select(DBJob.id)
+        .where(DBJob.kind == PURGE_CHAT)
+        .where(DBJob.target_id == chat_id)
+        .where(DBJob.status != JOB_DONE)
+        .exists()
+    )
+
+
+"""
+    Deleting the messages of a chat being purged in batches, each committed on its own with the
+    job's progress, then the chat itself. A job that failed or was cut short picks up where it
+    stopped when run again.
+"""
+def purge_chat(session: Session, job_id: int, batch_size: int = CHAT_PURGE_BATCH_SIZE) -> DBJob:
+    job = get_job(session, job_id)
+    chat_id = job.target_id
+    remaining = session.exec(select(func.count(DBMessage.id)).where(DBMessage.chat_id == chat_id)).one()
+    job.total, job.updated_at = job.done + remaining, datetime.now()
+    session.commit()
+
+    deleted = batch_size
+    while deleted == batch_size:
+        batch = select(DBMessage.id).where(DBMessage.chat_id == chat_id).limit(batch_size)
+        deleted = session.exec(delete(DBMessage).where(DBMessage.id.in_(batch))).rowcount
+        job.done += deleted
+        job.updated_at = datetime.now()
         session.commit()
 
+    session.exec(delete(DBChat).where(DBChat.id == chat_id))
+    session.commit()
+    return job
+
+
+"""
+    Deleting an account that owned chats being purged, once their purge jobs are done. The
+    purges are left to their own jobs, so each chat is only ever purged by the worker holding
+    its lease: until they are done the deletion is deferred, and the ones that had failed for
+    good are queued again, since the account can't go before its chats.
+"""
+def finish_account_deletion(session: Session, job_id: int):
+    job = get_job(session, job_id)
+    stmt = (
+        select(DBJob.id, DBJob.status)
+        .join(DBChat, DBChat.id == DBJob.target_id)
+        .where(DBJob.kind == PURGE_CHAT)
+        .where(DBJob.status != JOB_DONE)
+        .where(DBChat.owner_id == job.target_id)
+    )
+    purges = session.exec(stmt).all()
+    if purges:
+        failed = [id for id, status in purges if status == JOB_FAILED]
+        if failed:
+            retry_jobs(session, failed)
+        raise JobDeferred(ACCOUNT_DELETION_RECHECK, f"Waiting for {len(purges)} chat purges")
+
+    account = session.get(DBAccount, job.target_id)
+    if account is None:
+        return
+    # A chat it created since
+    if session.exec(select(DBChat.id).where(DBChat.owner_id == account.id)).first() is not None:
+        raise ChatOwnerRemovalError()
+    remove_account(session, account)
 
 # ------------------------------------ Helper Functions ------------------------------------
 
@@ -336,7 +1288,8 @@ def delete_account(session: Session, id: int):
     If chat with chat_id doesn't exist, raise ModelDNE exception
 """
 def chat_exists(session: Session, chat_id: int):
-    chat = session.get(DBChat, chat_id)
+    stmt = select(DBChat).where(DBChat.id == chat_id).where(~_being_purged(DBChat.id))
+    chat = session.exec(stmt).first()
     if chat is None:
         raise ModelDNE(model_name="chat", model_id=chat_id)
     return chat
@@ -357,7 +1310,8 @@ def account_exists(session: Session, account_id: int):
     Checking if an account is a member of the chat
 """
 def account_in_chat_membership(session, chat_id, account_id):
-    account = session.get(DBAccount, account_id)
+    # No need to look the account up: foreign keys are on (sqlite_foreign_keys), so a membership
+    # can only reference an existing account, and memberships go with a deleted account
     stmt = (
         select(DBChatMembership)
         .where(DBChatMembership.account_id == account_id)
@@ -365,12 +1319,20 @@ def account_in_chat_membership(session, chat_id, account_id):
     )
     membership = session.exec(stmt).first()
 
-    if membership is None or account is None:
+    if membership is None:
         raise ChatMembershipError(account_id = account_id, chat_id = chat_id)
     else:
         return membership
 
 
+"""
+    Checking if a chat has more than a number of messages, without counting them all
+"""
+def has_more_messages(session: Session, chat_id: int, count: int) -> bool:
+    stmt = select(DBMessage.id).where(DBMessage.chat_id == chat_id).offset(count).limit(1)
+    return session.exec(stmt).first() is not None
+
+
 """
     Checking if a name already exists
 """
@@ -385,18 +1347,8 @@ def check_duplicate_chat_name(session: Session, name: str):
     Checking if the owner exists in the chat membership
 """
 def owner_exists_in_membership(session: Session, chat_id, chat_owner_id):
-    # Check if account exists (ChatMembershipError)
+    # Raises ChatMembershipError when the new owner isn't a member of the chat
     account_in_chat_membership(session, chat_id, chat_owner_id)
-    
-    # If account exists, check if it is a member of the chat
-    stmt = (
-        select(DBChatMembership)
-        .where(DBChatMembership.account_id == chat_owner_id)
-        .where(DBChatMembership.chat_id == chat_id)
-    )
-    membership = session.exec(stmt).first()
-    if membership is None:
-        raise ChatMembershipError(account_id=chat_owner_id, chat_id=chat_id)
 
 
 """
@@ -420,26 +1372,21 @@ def is_account_chat_owner(session: Session, chat: DBChat, account_id: int):
 """
     Deleting all messages associated with a chat membership
 """
-def delete_all_messages(session: Session, chat_id: int, account_id: int):
-    stmt = (
-        select(DBMessage)
-        .where(DBMessage.chat_id == chat_id)
-        .where(DBMessage.account_id == account_id)
-    )
-    messages = session.exec(stmt).all()
-    for message in messages:
-        message.account_id = None
+def delete_all_messages(session: Session, chat_id: int, *account_ids: int):
+    condition = (DBMessage.chat_id == chat_id) & DBMessage.account_id.in_(account_ids)
+    record_message_changes(session, "update", condition)
+    session.exec(update(DBMessage).where(condition).values(account_id=None))
 
 
 """
-    Using bcrypt to hash a password
+    Using bcrypt to hash a password, on the password hashing pool
 """
 def hash_password(password: str) -> str:
-    return bcrypt.hashpw(password.encode("utf-8"), bcrypt.gensalt()).decode("utf-8")
+    return hashing.hasher.hash(password)
 
 
 """
-    Using bcrypt to verify the password
+    Using bcrypt to verify the password, on the password hashing pool
 """
 def verify_password(password: str, hashed_password: str) -> bool:
-    return bcrypt.checkpw(password.encode("utf-8"), hashed_password.encode("utf-8"))
\ No newline at end of file
+    return hashing.hasher.check(password, hashed_password)
\ No newline at end of file
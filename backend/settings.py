@@ -0,0 +1,88 @@
+"""Application settings, read from environment variables or a .env file.
+
+Args:
+    settings (Settings): The settings of the running application
+"""
+
+import os
+
+from pydantic import Field
+from pydantic_settings import BaseSettings, SettingsConfigDict
+
+
+class Settings(BaseSettings):
+    model_config = SettingsConfigDict(env_file=".env", extra="ignore")
+
+    # database: SQLAlchemy URL (the routes reach the same database through aiosqlite), SQL
+    # statement logging and the connection pool of each engine
+    database_url: str = "sqlite:///backend/database/development.db"
+    database_echo: bool = False
+    database_pool_size: int = 5
+    database_max_overflow: int = 10
+
+    # SQLite pragmas set on every connection; None keeps SQLite's default
+    sqlite_journal_mode: str | None = "wal"
+    sqlite_synchronous: str | None = "normal"
+    sqlite_mmap_size: int | None = 256 * 1024 * 1024
+    # negative values are in KiB
+    sqlite_cache_size: int | None = -64000
+    # milliseconds
+    sqlite_busy_timeout: int | None = 5000
+    sqlite_temp_store: str | None = "memory"
+    sqlite_foreign_keys: bool | None = True
+
+    # realtime events: "memory" keeps them in this process, "sqlite" shares them
+    # between the workers on this machine through a log in event_broker_path
+    event_broker: str = "memory"
+    event_broker_path: str = "backend/database/events.db"
+    event_broker_poll_interval: float = 0.005
+    event_broker_retention: float = 60.0
+
+    # delta sync: how long the change log is kept, and how often it is compacted (seconds)
+    change_log_retention: float = 30 * 24 * 3600
+    change_log_compaction_interval: float = 3600
+
+    # password hashing: processes in the pool (0 hashes in the request thread), how many
+    # more requests may wait for them, and the Retry-After sent when that is exceeded
+    password_hash_workers: int = Field(default_factory=lambda: os.cpu_count() or 1)
+    password_hash_queue_size: int = 16
+    password_hash_retry_after: int = 1
+    # bcrypt cost factor; hashes made with a lower cost are redone on the next login
+    bcrypt_rounds: int = Field(default=12, ge=4, le=31)
+
+    # authentication caches: entries per worker and seconds an entry is kept (a token is never
+    # kept past its expiry)
+    token_cache_size: int = 10000
+    token_cache_ttl: float = 300
+    account_cache_size: int = 10000
+    account_cache_ttl: float = 30
+
+    # metrics: a directory shared by the workers to add up their metrics at /metrics (each
+    # worker only reports its own without it), and how often each worker writes there (seconds)
+    metrics_dir: str | None = None
+    metrics_write_interval: float = 5.0
+
+    # most messages accepted by one POST /chats/{chat_id}/messages/batch
+    message_batch_size_max: int = 1000
+    # most accounts added to or removed from a chat by one /chats/{chat_id}/accounts/batch
+    membership_batch_size_max: int = 10000
+
+    # deleting a chat with more messages than this answers 202 and purges them in the background
+    chat_purge_threshold: int = 10000
+
+    # background jobs: workers per process, how long a job stays with a worker that stopped
+    # renewing its lease, how often idle workers look for due jobs, and the wait before the
+    # first retry of a failed job, doubled for every retry after it (seconds)
+    job_workers: int = 2
+    job_lease_seconds: float = 60.0
+    job_poll_interval: float = 1.0
+    job_retry_backoff: float = 5.0
+
+    # group commit: hand new messages to one writer per process, which commits up to
+    # group_commit_max_size of them at once after waiting group_commit_max_delay seconds for more
+    message_group_commit: bool = False
+    group_commit_max_delay: float = 0.002
+    group_commit_max_size: int = 500
+
+
+settings = Settings()
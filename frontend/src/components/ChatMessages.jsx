@@ -1,11 +1,13 @@
 // This is for ChatMessages
+import { useEffect } from 'react';
 import { useParams } from 'react-router-dom';
-import { useQuery } from '@tanstack/react-query';
+import { useQuery, useQueryClient } from '@tanstack/react-query';
 import axios from 'axios';
 
 
 const ChatMessages = () => {
   const { chatId } = useParams();
+  const queryClient = useQueryClient();
 
   // Getting all the accounts to map account_id to usernames
   const { data: accountsData } = useQuery({
@@ -34,6 +36,21 @@ const ChatMessages = () => {
     enabled: !!chatId, // if teh chatID is avaliable, run this. Else don't.
   });
 
+  // Applying pushed message events to the cached messages instead of refetching the chat
+  useEffect(() => {
+    if (!chatId) return;
+    const socket = new WebSocket(`ws://localhost:8000/chats/${chatId}/ws`);
+    socket.onmessage = (event) => {
+      const { type, message } = JSON.parse(event.data);
+      queryClient.setQueryData(['messages', chatId], (messages = []) => {
+        const others = messages.filter((m) => m.id !== message.id);
+        if (type === 'message.deleted') return others;
+        return [...others, message].sort((a, b) => a.id - b.id);
+      });
+    };
+    return () => socket.close();
+  }, [chatId, queryClient]);
+
   const formatDate = (dateString) => {
     return new Date(dateString).toLocaleString();
   };